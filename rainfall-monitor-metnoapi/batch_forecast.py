@@ -0,0 +1,117 @@
+"""
+Run the pipeline for several countries (one settings file each) in a single process:
+
+    python batch_forecast.py --settings_file settings-mwi.yml --settings_file settings-civ.yml
+
+The countries share the connections to the API (and its rate limit), the forecast cache, the basemaps,
+the Azure client and the processes drawing the figures. The shapefiles are prepared one country at a time,
+after which the countries run side by side. Every country gets its own result: a failing country does not stop the others.
+"""
+import os
+import json
+import time
+import shutil
+import datetime
+import traceback
+import yaml
+import click
+from concurrent.futures import ThreadPoolExecutor
+from rainfall_forecast import SharedResources, PipelineRun, prepare_inputs, run_pipeline, finish
+
+
+def run_country(run, preview=False, resume=False):
+    """
+    all stages of a single country (its shapefiles are ready); returns its status
+    """
+    start = time.perf_counter()
+    try:
+        run_pipeline(run, preview=preview, inputs_ready=True, resume=resume)
+        finish(run, remove_temp=False)
+        return country_status(run, 'ok', start)
+    except Exception as e:
+        traceback.print_exc()
+        try:
+            run.write_metrics('failed')
+        except Exception:
+            traceback.print_exc()
+        return country_status(run, 'failed', start, e)
+
+
+def country_status(run, status, start, error=None):
+    return {'country': run.country.upper(),
+            'settings_file': run.settings_file,
+            'status': status,
+            'seconds': round(time.perf_counter() - start, 1),
+            'output': run.local_output,
+            'error': None if error is None else f"{type(error).__name__}: {error}"}
+
+
+@click.command()
+@click.option("--settings_file", type = click.Path(exists=True, dir_okay=False), required = True, multiple = True, help = "YAML file with the settings of a country (repeat for every country)" )
+@click.option('--remove_temp', is_flag=True, default=False, show_default = True, help = "remove the intermediate files once all countries are done")
+@click.option('--store_in_cloud', is_flag=True, default=False, show_default = True, help = "Store the outputs in Azure's cloud storage")
+@click.option('--preview', is_flag=True, default=False, show_default = True, help = "quick check: render maps and bar plots at low resolution (mapSettings: previewDpi)")
+@click.option('--timestamp', type = str, default = None, help = "run to work on (YYYYMMDDHH, default: now)")
+@click.option('--countries_at_once', type = int, default = 2, show_default = True, help = "number of countries running side by side")
+@click.option('--plot_workers', type = int, default = os.cpu_count(), show_default = True, help = "processes drawing the figures of all countries")
+@click.option('--status_file', type = str, default = None, help = "write the result of every country into this JSON file")
+@click.option('--resume', is_flag=True, default=False, show_default = True, help = "continue a failed batch (same --timestamp): per country, skip the stages it completed and fetch only the missing points")
+def batch_forecast(settings_file, remove_temp, store_in_cloud, preview, timestamp, countries_at_once, plot_workers, status_file, resume):
+    """
+    run the rainfall forecast pipeline for several countries in one process
+    """
+    now_stamp = timestamp or datetime.datetime.today().strftime(format="%Y%m%d%H")
+
+    # --- one session for all countries: as many connections as their workers together, the strictest rate limit ---
+    api_settings = []
+    for filename in settings_file:
+        with open(filename,'r') as f:
+            api_settings.append(yaml.safe_load(f)['METnoAPI'])
+    rate_limits = [api['requests_per_second'] for api in api_settings if api.get('requests_per_second')]
+    shared = SharedResources(max_workers=sum(max(1, api.get('max_workers', 1)) for api in api_settings),
+                             requests_per_second=min(rate_limits) if rate_limits else None,
+                             plot_workers=plot_workers)
+
+    # --- the outputs of every country in their own folder: <output_dir>/<country>/<now_stamp> ---
+    runs = [PipelineRun(filename, now_stamp, store_in_cloud, shared=shared, output_per_country=True)
+            for filename in settings_file]
+
+    # --- 0. shapefiles: one country at a time (they share the download and the input folder) ---
+    statuses = {}
+    for run in runs:
+        start = time.perf_counter()
+        try:
+            prepare_inputs(run)
+        except Exception as e:
+            traceback.print_exc()
+            statuses[run.settings_file] = country_status(run, 'failed', start, e)
+
+    # --- 1.-4. the countries side by side (figures drawn by the shared processes) ---
+    ready = [run for run in runs if run.settings_file not in statuses]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, countries_at_once)) as pool:
+            for status in pool.map(lambda run: run_country(run, preview, resume), ready):
+                statuses[status['settings_file']] = status
+    finally:
+        shared.close()
+
+    # (the checkpoints of the countries that succeeded are removed by finish(), those of the failed ones are kept: --resume)
+    if remove_temp:
+        if os.path.exists('./temp/'):
+            shutil.rmtree('./temp/')
+        print("removed temporary files")
+
+    # --- result per country ---
+    statuses = [statuses[run.settings_file] for run in runs]
+    for status in statuses:
+        print(f"{status['country']}: {status['status']} in {status['seconds']} s ({status['error'] or status['output']})")
+    if status_file is not None:
+        with open(status_file, 'w') as f:
+            json.dump(statuses, f, indent=2)
+    failed = [status['country'] for status in statuses if status['status'] != 'ok']
+    if failed:
+        raise click.ClickException(f"{len(failed)} of {len(statuses)} countries failed: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    batch_forecast()
@@ -0,0 +1,321 @@
+"""
+Benchmark of the pipeline stages on synthetic input, served by the local stand-in of met.no (metno_stub_server.py).
+
+Generates a regular grid of forecast points and a tiling of admin polygons at the requested scales,
+then times every stage (fetch, rasterize, zonal, daily, plot, upload) of collect_rainfall_data.
+The outputs are kept in memory and uploaded to a stand-in of Azure's blob storage
+(or to a real emulator such as Azurite, with --azure_connection_string):
+
+    python benchmark.py run --points 400 --points 1600 --polygons 10 --polygons 100 --days 3 --days 9 --report benchmark.json
+    python benchmark.py compare benchmark_main.json benchmark.json
+"""
+import contextlib
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import click
+import yaml
+
+from metno_stub_server import running_stub_server
+from rainfall_forecast import (PipelineRun, fetch_forecasts, rasterize_forecasts, zonal_statistics_per_admin,
+                               daily_aggregates_and_triggers, daily_aggregates_of_locations,
+                               plot_bar_charts, plot_maps)
+from utils import MemoryStorage, AzureBlobStorage, azure_blob, azure_core
+
+
+STAGES = ["fetch", "fetch_cached", "rasterize", "zonal", "daily", "plot", "upload"]
+
+# synthetic area: starts at this corner, grid points 0.1 degree apart (as the real grids)
+WEST, NORTH, RESOLUTION = 30.0, -10.0, 0.1
+
+
+def synthetic_points(n_points):
+    """
+    GeoJSON (dict) with a square grid of about n_points forecast points, in the layout of the real points files
+    """
+    side = math.ceil(math.sqrt(n_points))
+    features = []
+    for idx in range(n_points):
+        row, col = divmod(idx, side)
+        left, top = round(WEST + col * RESOLUTION, 4), round(NORTH - row * RESOLUTION, 4)
+        features.append({"type": "Feature",
+                         "properties": {"id": idx, "left": left, "top": top,
+                                        "right": round(left + RESOLUTION, 4), "bottom": round(top - RESOLUTION, 4)},
+                         "geometry": {"type": "Point", "coordinates": [left, top]}})
+    return {"type": "FeatureCollection",
+            "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
+            "features": features}
+
+
+def synthetic_polygons(n_polygons, n_points, admin_lvl="adm1"):
+    """
+    GeoJSON (dict) with n_polygons rectangles tiling the area of the grid of n_points (one admin level)
+    """
+    side = math.ceil(math.sqrt(n_points))
+    rows = math.ceil(n_points / side)
+    west, east = WEST - RESOLUTION / 2, WEST + (side - 0.5) * RESOLUTION
+    north, south = NORTH + RESOLUTION / 2, NORTH - (rows - 0.5) * RESOLUTION
+    n_cols = math.ceil(math.sqrt(n_polygons))
+    n_rows = math.ceil(n_polygons / n_cols)
+    width, height = (east - west) / n_cols, (north - south) / n_rows
+    features = []
+    for idx in range(n_polygons):
+        row, col = divmod(idx, n_cols)
+        x0, y0 = west + col * width, north - row * height
+        ring = [[x0, y0], [x0 + width, y0], [x0 + width, y0 - height], [x0, y0 - height], [x0, y0]]
+        features.append({"type": "Feature",
+                         "properties": {f"{admin_lvl.upper()}_EN": f"Area {idx}",
+                                        f"{admin_lvl.upper()}_PCODE": f"BM{idx:05d}"},
+                         "geometry": {"type": "Polygon", "coordinates": [ring]}})
+    return {"type": "FeatureCollection",
+            "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}},
+            "features": features}
+
+
+def synthetic_settings(workdir, n_points, base_url, plot_workers=1, memory_budget_mb=False):
+    """
+    settings file (based on settings-template.yml) pointing to the synthetic input in workdir
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings-template.yml"), "r") as f:
+        settings = yaml.safe_load(f)
+    side = math.ceil(math.sqrt(n_points))
+    rows = math.ceil(n_points / side)
+    settings["METnoAPI"].update({"user-agent": "rainfall-monitor-benchmark",
+                                 "download_dir": os.path.join(workdir, "downloads"),
+                                 "cache_dir": os.path.join(workdir, "cache"),
+                                 "requests_per_second": None,
+                                 "base_url": base_url})
+    settings["geoCoordinates"].update({"country_code": "BMK",
+                                       "locations_of_interest": "bmk_forecast_points.geojson",
+                                       "adm1": "bmk_adm1.geojson", "adm2": False, "adm3": False, "adm4": False,
+                                       "basemap": False})
+    settings["rainfallThreshold"].update({"one_day": 50, "three_day": 150})
+    settings["mapSettings"].update({"locationName": "Benchmark",
+                                    "bboxWest": WEST - RESOLUTION, "bboxEast": WEST + side * RESOLUTION,
+                                    "bboxNorth": NORTH + RESOLUTION, "bboxSouth": NORTH - rows * RESOLUTION,
+                                    "plotWorkers": plot_workers})
+    settings["localStorage"].update({"main_dir": workdir, "input_dir": "input-shape/"})
+    settings["processing"] = {"memory_budget_mb": memory_budget_mb, "checkpoint_dir": os.path.join(workdir, "checkpoints")}
+    settings_file = os.path.join(workdir, "settings-benchmark.yml")
+    with open(settings_file, "w") as f:
+        yaml.safe_dump(settings, f)
+    return settings_file
+
+
+class BlobContainerStandIn:
+    """
+    in-process stand-in for an Azure ContainerClient (the calls made by CloudUploader), keeping the blobs in memory
+
+    latency: seconds per request (stand-in for the round trip to the storage account)
+    """
+
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.blobs = {}
+        self._lock = threading.Lock()
+
+    def get_blob_client(self, name):
+        return BlobStandIn(self, name)
+
+
+class BlobStandIn:
+
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+
+    def get_blob_properties(self):
+        time.sleep(self.container.latency)
+        with self.container._lock:
+            if self.name not in self.container.blobs:
+                raise azure_core.exceptions.ResourceNotFoundError(f"{self.name} not found")
+            data, content_settings = self.container.blobs[self.name]
+        return types.SimpleNamespace(size=len(data), content_settings=content_settings)
+
+    def upload_blob(self, data, overwrite=False, content_settings=None):
+        time.sleep(self.container.latency)
+        data = data if isinstance(data, bytes) else data.read()
+        with self.container._lock:
+            self.container.blobs[self.name] = (data, content_settings)
+
+
+@contextlib.contextmanager
+def timed(timings, stage, verbose=False):
+    # seconds spent in the stage (the pipeline's own output is hidden unless verbose)
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+        yield
+    timings[stage] = time.perf_counter() - start
+
+
+def benchmark_scale(server, container_client, n_points, n_polygons, days, plot_workers=1, dpi=72, memory_budget_mb=False, verbose=False):
+    """
+    run all stages once on fresh synthetic input; returns the scale and the seconds per stage
+    """
+    server.forecast_days = days
+    timings = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, "input-shape"))
+        for basename, geojson in [("bmk_forecast_points.geojson", synthetic_points(n_points)),
+                                  ("bmk_adm1.geojson", synthetic_polygons(n_polygons, n_points))]:
+            with open(os.path.join(workdir, "input-shape", basename), "w") as f:
+                json.dump(geojson, f)
+        settings_file = synthetic_settings(workdir, n_points, server.base_url, plot_workers, memory_budget_mb)
+        now_stamp = datetime.datetime.utcnow().strftime(format="%Y%m%d%H")
+        run = PipelineRun(settings_file, now_stamp, storage=MemoryStorage())
+
+        with timed(timings, "fetch", verbose):
+            rainfall_gdf, forecast_store = fetch_forecasts(run)
+        with timed(timings, "fetch_cached", verbose):
+            # all points served from the forecast cache
+            rainfall_gdf, forecast_store = fetch_forecasts(run, save=False)
+        with timed(timings, "rasterize", verbose):
+            grid_index, rainfall_array = rasterize_forecasts(run, rainfall_gdf, forecast_store)
+        with timed(timings, "zonal", verbose):
+            rainfall_by_admin = zonal_statistics_per_admin(run, grid_index, rainfall_array)
+        with timed(timings, "daily", verbose):
+            daily_by_admin = daily_aggregates_and_triggers(run, rainfall_by_admin)
+            daily_rainfall_arr = daily_aggregates_of_locations(run, rainfall_gdf, grid_index, forecast_store=forecast_store)
+        with timed(timings, "plot", verbose):
+            with run.plot_pool() as plot_pool:
+                plot_bar_charts(run, daily_by_admin, plot_pool, dpi=dpi)
+                plot_maps(run, daily_rainfall_arr, plot_pool, dpi=dpi)
+        with timed(timings, "upload", verbose):
+            cloud_storage = AzureBlobStorage(f"benchmark/{now_stamp}", container_client=container_client)
+            for name, data in run.storage.files.items():
+                cloud_storage.write_bytes(name, data)
+            cloud_storage.close()
+
+    return {"points": n_points,
+            "polygons": n_polygons,
+            "days": days,
+            "timesteps": int(rainfall_array.shape[0]),
+            "rows": len(forecast_store),
+            "outputs": len(run.storage.files),
+            "megabytes": round(sum(map(len, run.storage.files.values())) / 1024**2, 2),
+            "seconds": {stage: round(timings[stage], 4) for stage in STAGES}}
+
+
+def code_version():
+    # the commit the benchmark ran on (None outside of a git checkout)
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--points", type=int, multiple=True, default=[400], show_default=True, help="number of grid points (repeat the option to compare scales)")
+@click.option("--polygons", type=int, multiple=True, default=[10], show_default=True, help="number of admin polygons (repeat the option)")
+@click.option("--days", type=click.IntRange(min=4), multiple=True, default=[9], show_default=True, help="length of the forecasts, sets the number of timesteps (repeat the option; the rasters start at day 3)")
+@click.option("--repeat", type=int, default=1, show_default=True, help="runs per scale; the fastest time per stage is reported")
+@click.option("--latency", type=float, default=0., show_default=True, help="simulated round trip per API request (seconds)")
+@click.option("--upload_latency", type=float, default=0.01, show_default=True, help="simulated round trip per request to the blob storage stand-in (seconds)")
+@click.option("--azure_connection_string", type=str, default=None, help="upload to this blob storage instead (e.g. Azurite: 'UseDevelopmentStorage=true')")
+@click.option("--plot_workers", type=int, default=1, show_default=True, help="processes drawing the figures")
+@click.option("--dpi", type=int, default=72, show_default=True, help="resolution of the figures")
+@click.option("--memory_budget_mb", type=float, default=None, help="process the long table in parts within this budget (processing: memory_budget_mb)")
+@click.option("--report", type=str, default=None, help="write the results as JSON into this file (default: print them)")
+@click.option("--verbose", is_flag=True, default=False, help="show the output of the pipeline")
+def run(points, polygons, days, repeat, latency, upload_latency, azure_connection_string, plot_workers, dpi, memory_budget_mb, report, verbose):
+    """
+    time every stage of the pipeline for every combination of points, polygons and days
+    """
+    if azure_connection_string is not None:
+        container_client = azure_blob.BlobServiceClient.from_connection_string(azure_connection_string) \
+                                     .get_container_client("benchmark")
+        if not container_client.exists():
+            container_client.create_container()
+    else:
+        container_client = BlobContainerStandIn(latency=upload_latency)
+
+    results = []
+    with running_stub_server(latency=latency) as server:
+        for n_points in points:
+            for n_polygons in polygons:
+                for n_days in days:
+                    runs = [benchmark_scale(server, container_client, n_points, n_polygons, n_days,
+                                            plot_workers=plot_workers, dpi=dpi,
+                                            memory_budget_mb=memory_budget_mb or False, verbose=verbose)
+                            for _ in range(max(1, repeat))]
+                    result = runs[0]
+                    result["seconds"] = {stage: min(r["seconds"][stage] for r in runs) for stage in STAGES}
+                    results.append(result)
+                    print(f"points={n_points} polygons={n_polygons} days={n_days} timesteps={result['timesteps']}: "
+                          + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in result["seconds"].items()),
+                          file=sys.stderr)
+
+    benchmark = {"version": code_version(),
+                 "created": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                 "python": platform.python_version(),
+                 "platform": platform.platform(),
+                 "cpus": os.cpu_count(),
+                 "options": {"repeat": repeat, "latency": latency, "upload_latency": upload_latency,
+                             "upload_to": "azure" if azure_connection_string else "stand-in",
+                             "plot_workers": plot_workers, "dpi": dpi, "memory_budget_mb": memory_budget_mb},
+                 "results": results}
+    if report is None:
+        print(json.dumps(benchmark, indent=2))
+    else:
+        with open(report, "w") as f:
+            json.dump(benchmark, f, indent=2)
+        print(f"written: {report}", file=sys.stderr)
+
+
+@cli.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("report", type=click.Path(exists=True, dir_okay=False))
+@click.option("--tolerance", type=float, default=0.25, show_default=True, help="slow-down that counts as a regression (0.25: 25%% slower)")
+@click.option("--min_seconds", type=float, default=0.05, show_default=True, help="ignore stages faster than this in both reports (noise)")
+def compare(baseline, report, tolerance, min_seconds):
+    """
+    compare two benchmark reports scale by scale (fails when a stage became slower than the tolerance)
+    """
+    with open(baseline) as f:
+        old = json.load(f)
+    with open(report) as f:
+        new = json.load(f)
+    print(f"{old['version']} -> {new['version']}")
+
+    old_results = {(r["points"], r["polygons"], r["days"]): r for r in old["results"]}
+    regressions = []
+    for result in new["results"]:
+        scale = (result["points"], result["polygons"], result["days"])
+        if scale not in old_results:
+            continue
+        print(f"points={scale[0]} polygons={scale[1]} days={scale[2]}")
+        for stage, seconds in result["seconds"].items():
+            old_seconds = old_results[scale]["seconds"].get(stage)
+            if old_seconds is None:
+                continue
+            ratio = seconds / old_seconds if old_seconds else float("inf")
+            flag = ""
+            if max(seconds, old_seconds) >= min_seconds and ratio > 1 + tolerance:
+                flag = "  <-- slower"
+                regressions.append((scale, stage))
+            print(f"  {stage:13s} {old_seconds:8.3f} s -> {seconds:8.3f} s  ({ratio:5.2f}x){flag}")
+    if regressions:
+        raise click.ClickException(f"{len(regressions)} stage(s) slower than the tolerance ({tolerance:.0%})")
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,174 @@
+"""
+Keep the pipeline running as a service that polls met.no and only recomputes what received new data:
+
+    python forecast_daemon.py --settings_file settings-mwi.yml
+
+Kept between the polls: the shapefiles (only downloaded again when changed), the zone masks, the grid index,
+the map layers, the HTTP session, the Azure client and the plotting processes (with the figures they drew).
+After every poll:
+- no grid point received new data: nothing is computed or written
+- same forecast times, but new data for some points: the outputs of the current run (folder) are updated,
+  only the zonal statistics of the changed zones and timepoints and the maps of the changed days are made again
+- new forecast times (a new model run): outputs in a new folder, named after the time of the poll
+The next poll is timed on the "Expires" of the forecasts (met.no's update cadence).
+"""
+import time
+import datetime
+import traceback
+import yaml
+import click
+from rainfall_forecast import *
+
+
+class ForecastDaemon:
+    """
+    state of the service, kept between the polls
+    ----
+    settings_file: YAML file with global settings
+    store_in_cloud: write the outputs to Azure's cloud storage
+    preview: render maps and bar plots at low resolution
+    """
+
+    def __init__(self, settings_file, store_in_cloud=False, preview=False):
+        self.settings_file = settings_file
+        self.store_in_cloud = store_in_cloud
+        self.preview = preview
+        with open(settings_file,'r') as f:
+            settings = yaml.safe_load(f)
+        self.shared = SharedResources(max_workers=settings['METnoAPI'].get('max_workers', 1),
+                                      requests_per_second=settings['METnoAPI'].get('requests_per_second', None),
+                                      plot_workers=settings['mapSettings'].get('plotWorkers', 1))
+        self.forecast_cache = None
+        # run whose outputs are being updated
+        self.now_stamp = None
+        self.reset()
+
+    def reset(self):
+        # forget everything derived from the shapefiles and the grid: the next poll starts over
+        self.zones = {}
+        self.layers = None
+        self.grid_index = None
+        self.last = None
+
+    def cycle(self, now_stamp):
+        """
+        poll met.no once and bring the outputs up to date
+        returns 'unchanged', 'updated' (outputs of the current run) or 'new run'
+        """
+        run = PipelineRun(self.settings_file, now_stamp, self.store_in_cloud, shared=self.shared)
+        if prepare_inputs(run):
+            self.reset()
+        self.forecast_cache = run.forecast_cache()
+        self.forecast_cache.start_run()
+        # (no checkpoints: the service does not resume runs, it polls again)
+        rainfall_gdf, forecast_store = fetch_forecasts(run, save=False, record_progress=False)
+        # (a single country: nobody else is fetching from the cache)
+        self.forecast_cache.evict()
+
+        # --- which points received new data ---
+        digests = forecast_store.point_digests()
+        locations = forecast_store.points[['latitude', 'longtitude']].to_numpy()
+        last = self.last
+        if last is not None and not np.array_equal(locations, last['locations']):
+            print("the grid points changed: starting over")
+            self.reset()
+            last = None
+        if last is not None:
+            n_changed = int((digests != last['digests']).sum())
+            if n_changed == 0:
+                print("no new data")
+                return 'unchanged'
+            print(f"new data for {n_changed} of {len(digests)} points")
+        if self.grid_index is None:
+            self.grid_index = GridIndex(forecast_store.points)
+
+        # --- same forecast times: update the outputs of the current run, otherwise a new run ---
+        times = np.unique(forecast_store.time_of_prediction)
+        same_run = last is not None and np.array_equal(times, last['times'])
+        if not same_run:
+            self.now_stamp = now_stamp
+        run = PipelineRun(self.settings_file, self.now_stamp, self.store_in_cloud, shared=self.shared, metrics=run.metrics)
+
+        save_forecasts(run, rainfall_gdf, forecast_store)
+        _, rainfall_array = rasterize_forecasts(run, rainfall_gdf, forecast_store, grid_index=self.grid_index)
+        rainfall_by_admin = zonal_statistics_per_admin(
+            run, self.grid_index, rainfall_array,
+            zones=self.zones,
+            previous=(last['rainfall_array'], last['rainfall_by_admin']) if last is not None else None)
+        daily_by_admin = daily_aggregates_and_triggers(run, rainfall_by_admin)
+        daily_rainfall_arr = daily_aggregates_of_locations(run, rainfall_gdf, self.grid_index, forecast_store=forecast_store)
+
+        # --- figures: only those whose data changed (a new run: all) ---
+        if self.layers is None:
+            self.layers = map_layers(run.settings, run.local_input_dir, crs=daily_rainfall_arr.rio.crs)
+        if same_run:
+            days, _ = changed_bands(last['daily_rainfall_arr'], daily_rainfall_arr)
+            bar_charts = {admin_lvl: daily for admin_lvl, daily in daily_by_admin.items()
+                          if admin_lvl not in last['daily_by_admin'] or not daily.equals(last['daily_by_admin'][admin_lvl])}
+        else:
+            days = np.ones(daily_rainfall_arr.shape[0], dtype=bool)
+            bar_charts = daily_by_admin
+        dpi = run.plot_dpi(self.preview)
+        with run.plot_pool() as plot_pool:
+            plot_bar_charts(run, bar_charts, plot_pool, dpi=dpi)
+            if days.any():
+                plot_maps(run, daily_rainfall_arr[days], plot_pool, dpi=dpi, layers=self.layers)
+        print(f"{len(bar_charts)} bar plot(s) and {int(days.sum())} of {len(days)} maps made")
+        finish(run, remove_temp=False)
+
+        self.last = dict(digests=digests,
+                         locations=locations,
+                         times=times,
+                         rainfall_array=rainfall_array,
+                         rainfall_by_admin=rainfall_by_admin,
+                         daily_by_admin=daily_by_admin,
+                         daily_rainfall_arr=daily_rainfall_arr)
+        return 'updated' if same_run else 'new run'
+
+    def seconds_to_next_poll(self, min_interval, max_interval):
+        """
+        poll again when the first of the forecasts expires (met.no may have new data by then),
+        but not sooner than min_interval and not later than max_interval seconds from now
+        """
+        expiry = self.forecast_cache.earliest_expiry if self.forecast_cache is not None else None
+        if expiry is None:
+            return max_interval
+        seconds = (expiry - datetime.datetime.utcnow()).total_seconds()
+        return min(max(seconds, min_interval), max_interval)
+
+    def close(self):
+        self.shared.close()
+
+
+@click.command()
+@click.option("--settings_file", type = str, required = True, default = './src/settings-mwi.yml', show_default = True, help = "YAML file with global settings (input/output file names, etc.)" )
+@click.option('--store_in_cloud', is_flag=True, default=False, show_default = True, help = "Store the outputs in Azure's cloud storage (localStorage: keep_local_copy for a local copy as well)")
+@click.option('--preview', is_flag=True, default=False, show_default = True, help = "render maps and bar plots at low resolution (mapSettings: previewDpi)")
+@click.option('--min_interval', type = float, default = 300, show_default = True, help = "seconds between two polls, at least")
+@click.option('--max_interval', type = float, default = 3600, show_default = True, help = "seconds between two polls, at most")
+@click.option('--cycles', type = int, default = None, help = "stop after this many polls (default: keep running)")
+def forecast_daemon(settings_file, store_in_cloud, preview, min_interval, max_interval, cycles):
+    """
+    run the rainfall forecast pipeline as a service: poll met.no and only recompute what received new data
+    """
+    daemon = ForecastDaemon(settings_file, store_in_cloud, preview)
+    cycle = 0
+    try:
+        while cycles is None or cycle < cycles:
+            now_stamp = datetime.datetime.today().strftime(format="%Y%m%d%H")
+            try:
+                print(f"poll {cycle + 1}: {daemon.cycle(now_stamp)}")
+            except Exception:
+                # e.g. met.no or the cloud storage not reachable: tried again at the next poll
+                traceback.print_exc()
+            cycle += 1
+            if cycles is None or cycle < cycles:
+                seconds = daemon.seconds_to_next_poll(min_interval, max_interval)
+                print(f"next poll in {seconds:.0f} s")
+                time.sleep(seconds)
+    finally:
+        daemon.close()
+
+
+if __name__ == '__main__':
+    forecast_daemon()
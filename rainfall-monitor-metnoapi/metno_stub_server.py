@@ -0,0 +1,230 @@
+"""
+Local stand-in for the MET Norway LocationForecast 2.0 API.
+
+Serves synthetic (but deterministic) forecasts in the same JSON layout as api.met.no,
+so the grid-point fetcher can be exercised and timed without touching the real service:
+
+    python metno_stub_server.py serve --port 8080 --latency 0.15
+    python metno_stub_server.py measure --points input-shape/mwi_forecast_points.geojson --workers 1 --workers 8
+"""
+import datetime
+import json
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import click
+
+
+HTTP_DATETIME_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+API_PATH = "/weatherapi/locationforecast/2.0/"
+
+
+def synthetic_forecast(lat, lon, issued, days=9):
+    """
+    build a LocationForecast-style JSON document for one point
+
+    Mimics the layout of the "complete" product: hourly steps for the first 60 hours,
+    6-hourly steps up to `days` (~9 for met.no) days ahead. Rainfall is random, but seeded on the
+    (rounded) coordinates and the model run, so repeated calls return the same numbers.
+    """
+    rng = random.Random(f"{lat:.4f},{lon:.4f},{issued:%Y%m%d%H}")
+    timeseries = []
+    step_time = issued
+    last_time = issued + datetime.timedelta(days=days)
+    while step_time <= last_time:
+        hours_ahead = (step_time - issued).total_seconds() / 3600.
+        data = {"instant": {"details": {"air_temperature": round(rng.uniform(15, 30), 1)}}}
+        if hours_ahead < 60:
+            data["next_1_hours"] = {"summary": {"symbol_code": "rain"},
+                                    "details": {"precipitation_amount": round(rng.expovariate(2.), 1)}}
+            step = 1
+        else:
+            step = 6
+        if step_time + datetime.timedelta(hours=6) <= last_time:
+            data["next_6_hours"] = {"summary": {"symbol_code": "rain"},
+                                    "details": {"precipitation_amount": round(rng.expovariate(0.5), 1)}}
+        if step_time + datetime.timedelta(hours=12) <= last_time:
+            data["next_12_hours"] = {"summary": {"symbol_code": "rain"},
+                                     "details": {"probability_of_precipitation": round(rng.uniform(0, 100), 1)}}
+        timeseries.append({"time": step_time.strftime("%Y-%m-%dT%H:%M:%SZ"), "data": data})
+        step_time += datetime.timedelta(hours=step)
+
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [lon, lat, 0]},
+        "properties": {
+            "meta": {
+                "updated_at": issued.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "units": {"air_temperature": "celsius",
+                          "precipitation_amount": "mm",
+                          "probability_of_precipitation": "%"},
+            },
+            "timeseries": timeseries,
+        },
+    }
+
+
+class StubForecastServer(ThreadingHTTPServer):
+    """
+    threaded HTTP server answering LocationForecast requests
+
+    latency: seconds to wait before answering (stand-in for the round trip to api.met.no)
+    expires_after: seconds until a served forecast expires (met.no uses ~30 minutes)
+    model_run_hours: cadence at which a "new model run" (new Last-Modified) appears
+    forecast_days: length of the served forecasts (sets the number of timesteps)
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0., expires_after=1800, model_run_hours=1, forecast_days=9):
+        super().__init__(address, StubForecastHandler)
+        self.latency = latency
+        self.expires_after = expires_after
+        self.model_run_hours = model_run_hours
+        self.forecast_days = forecast_days
+        self.counts = {"requests": 0, "not_modified": 0}
+        self._counts_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{API_PATH}"
+
+    def current_model_run(self):
+        now = datetime.datetime.utcnow()
+        hour = now.hour - now.hour % self.model_run_hours
+        return now.replace(hour=hour, minute=0, second=0, microsecond=0)
+
+    def count(self, key):
+        with self._counts_lock:
+            self.counts[key] += 1
+
+
+class StubForecastHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if not url.path.startswith(API_PATH) or "lat" not in query or "lon" not in query:
+            self.send_error(400, "expected /weatherapi/locationforecast/2.0/<type>?lat=..&lon=..")
+            return
+
+        self.server.count("requests")
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        issued = self.server.current_model_run()
+        headers = {
+            "Last-Modified": issued.strftime(HTTP_DATETIME_FORMAT),
+            "Expires": (datetime.datetime.utcnow()
+                        + datetime.timedelta(seconds=self.server.expires_after)).strftime(HTTP_DATETIME_FORMAT),
+        }
+
+        # --- conditional request: nothing new since the client's copy ---
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = datetime.datetime.strptime(if_modified_since, HTTP_DATETIME_FORMAT)
+            except ValueError:
+                since = None
+            if since is not None and since >= issued:
+                self.server.count("not_modified")
+                self.send_response(304)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        lat = round(float(query["lat"][0]), 4)
+        lon = round(float(query["lon"][0]), 4)
+        body = json.dumps(synthetic_forecast(lat, lon, issued, self.server.forecast_days)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep the console quiet: one line per grid point is just noise
+        pass
+
+
+@contextmanager
+def running_stub_server(host="127.0.0.1", port=0, **server_kwargs):
+    """
+    start a StubForecastServer in a background thread, yield it and shut it down afterwards
+    (port=0 picks a free port; use `server.base_url` to point the fetcher at it)
+    """
+    server = StubForecastServer((host, port), **server_kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--host", type=str, default="127.0.0.1", show_default=True)
+@click.option("--port", type=int, default=8080, show_default=True)
+@click.option("--latency", type=float, default=0., show_default=True, help="seconds to wait before answering each request")
+def serve(host, port, latency):
+    """
+    run the stand-in server in the foreground (set `METnoAPI: base_url` to the printed URL)
+    """
+    server = StubForecastServer((host, port), latency=latency)
+    print(f"serving LocationForecast stand-in at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@cli.command()
+@click.option("--points", type=str, required=True, help="GeoJSON with the grid points (as used for `locations_of_interest`)")
+@click.option("--workers", type=int, multiple=True, default=[1, 8], show_default=True, help="worker counts to compare (repeat the option)")
+@click.option("--requests_per_second", type=float, default=None, help="global request ceiling")
+@click.option("--latency", type=float, default=0.1, show_default=True, help="simulated round trip per request (seconds)")
+def measure(points, workers, requests_per_second, latency):
+    """
+    time API_requests_at_gridpoints against the stand-in server for several worker counts
+    """
+    from utils import API_requests_at_gridpoints
+
+    with running_stub_server(latency=latency) as server:
+        for max_workers in workers:
+            # fresh download dir for every run, otherwise later runs are served from the first one's files
+            with tempfile.TemporaryDirectory() as download_dir:
+                start = time.perf_counter()
+                rainfall_gdf = API_requests_at_gridpoints(
+                    filename_gridpoints=points,
+                    save_to_file=None,
+                    destination_dir=download_dir,
+                    USER_AGENT="rainfall-monitor-stub",
+                    max_workers=max_workers,
+                    requests_per_second=requests_per_second,
+                    base_url=server.base_url)
+                elapsed = time.perf_counter() - start
+            n_points = rainfall_gdf[['latitude', 'longtitude']].drop_duplicates().shape[0]
+            print(f"workers={max_workers:3d}: {n_points} points in {elapsed:.2f} s "
+                  f"({n_points / elapsed:.1f} points/s)")
+
+
+if __name__ == '__main__':
+    cli()
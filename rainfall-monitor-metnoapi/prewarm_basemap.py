@@ -0,0 +1,36 @@
+"""
+Fill the local basemap store (`mapSettings: basemapCacheDir`) with the tiles of the map bounding box,
+so the daily maps can be plotted without downloading (or without network access at all):
+
+    python prewarm_basemap.py --settings_file settings-mwi.yml
+"""
+import os
+import yaml
+import click
+from utils import BasemapCache
+
+
+@click.command()
+@click.option("--settings_file", type = str, required = True, default = './src/settings-mwi.yml', show_default = True, help = "YAML file with global settings (input/output file names, etc.)" )
+@click.option("--zoom", type = str, multiple = True, help = "zoom level(s) to store, e.g. --zoom 8 --zoom 9 (default: `basemapZoom` from the settings)")
+def prewarm_basemap(settings_file, zoom):
+    """
+    download the basemap tiles of the map bounding box into the local basemap store
+    """
+    with open(settings_file,'r') as f:
+        settings = yaml.safe_load(f)
+    map_settings = settings['mapSettings']
+    bbox = (map_settings['bboxWest'], map_settings['bboxSouth'], map_settings['bboxEast'], map_settings['bboxNorth'])
+
+    for zoom_level in zoom or [map_settings.get('basemapZoom', 'auto')]:
+        basemap_cache = BasemapCache(
+            cache_dir=map_settings.get('basemapCacheDir', os.path.join(settings['localStorage']['main_dir'], 
+                                                                       settings['localStorage']['input_dir'], 
+                                                                       'basemap')),
+            source=map_settings.get('basemapSource', 'OpenStreetMap.Mapnik'),
+            zoom=zoom_level if zoom_level == 'auto' else int(zoom_level))
+        print(f"stored: {basemap_cache.fetch(bbox)}")
+
+
+if __name__ == '__main__':
+    prewarm_basemap()
@@ -5,247 +5,902 @@ Obtain a single long-format CSV-file with columns:
 
 |area_name| total_rainfall_mm| avg_rainfall_mm| max_rainfall_mm| min_rainfall_mm| time_of_prediction
 
+Without a command the whole pipeline runs. The stages can also be run one at a time
+(fetch, rasterize, zonal, daily, plot, upload): each stage reads what the previous one wrote
+into the local output folder of the run (`--timestamp`).
 
 -------> first version created by: Misha Klein, August 2022
 """
-import numpy as np
-import pandas as pd
-from tqdm import tqdm
+import time
+_import_start = time.perf_counter()
 import os
+import sys
 import glob
+import json
+import functools
 import shutil
+import threading
+import subprocess
 import yaml
 import click
 import datetime
-from utils import * 
+from utils import *
+# the heavy libraries (geopandas, rasterio, matplotlib, ...) are only imported by the stage that needs them
+IMPORT_SECONDS = time.perf_counter() - _import_start
 
+# should not be imported before a stage uses them (checked by `startup`)
+HEAVY_MODULES = ['geopandas', 'rasterio', 'xarray', 'rioxarray', 'matplotlib', 'seaborn',
+                 'contextily', 'azure.storage.blob', 'metno_locationforecast', 'requests']
 
-@click.command()
-@click.option("--settings_file", type = str, required = True, default = './src/settings-mwi.yml', show_default = True, help = "YAML file with global settings (input/output file names, etc.)" )
-@click.option('--remove_temp', is_flag=True, default=False, show_default = True, help = "remove the intermediate files created by the pipeline? (default: keep temp/ folder)")
-@click.option('--store_in_cloud', is_flag=True, default=False, show_default = True, help = "Store final CSV in Azure's cloud storage")
-def collect_rainfall_data(settings_file, remove_temp, store_in_cloud):
-    """
-    Uses Metno weather API (LocationForecast) to retrieve rainfall predictions (approx. until ~10days in advance).
-    Aggregate the predicted rainfall in mm (for every timepoint available through the API) over catchment areas.
-    Obtain a single long-format CSV-file with columns:
+# rough memory use per grid point, to size the parts processed at once with `processing: memory_budget_mb`
+BYTES_PER_TABLE_ROW = 500       # a row of the long table (pandas/geopandas), with the copies made along the way
+BYTES_PER_FORECAST = 1024**2    # a parsed forecast (JSON) waiting to be stored
 
-    |area_name| total_rainfall_mm| avg_rainfall_mm| max_rainfall_mm| min_rainfall_mm| time_of_prediction
+# settings that do not change the outputs (left out of the checkpoint keys)
+NOT_IN_CHECKPOINT_KEYS = ['max_workers', 'requests_per_second', 'download_dir', 'cache_dir', 'cache_max_age_hours',
+                          'cache_max_mb', 'plotWorkers', 'previewDpi', 'user-agent', 'memory_budget_mb', 'checkpoint_dir']
+
+
+class SharedResources:
+    """
+    resources shared by the runs of several countries in one process (see batch_forecast.py)
+    ----
+    max_workers: connections to the API kept open (for all countries together)
+    requests_per_second: ceiling on the API calls of all countries together (None = no limit)
+    plot_workers: processes drawing the figures of all countries (1: draw in this process)
     """
 
-    now_stamp = datetime.datetime.today().strftime(format="%Y%m%d%H")
-    # now_stamp = '2023070708'
+    def __init__(self, max_workers=8, requests_per_second=None, plot_workers=1):
+        self.session = create_http_session(max_workers)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.plot_executor = plot_process_pool(plot_workers) if plot_workers > 1 else None
+        self._forecast_caches = {}
+        self._lock = threading.Lock()
+
+    def forecast_cache(self, cache_dir, max_age_hours=None, max_size_mb=None):
+        # one ForecastCache per folder (the counts are kept per run)
+        with self._lock:
+            if cache_dir not in self._forecast_caches:
+                self._forecast_caches[cache_dir] = ForecastCache(cache_dir, max_age_hours, max_size_mb)
+            return self._forecast_caches[cache_dir]
+
+    def close(self):
+        self.session.close()
+        if self.plot_executor is not None:
+            self.plot_executor.shutdown()
+        for forecast_cache in self._forecast_caches.values():
+            forecast_cache.evict()
+
+
+class PipelineRun:
+    """
+    settings, folders and output filenames of a single run of the pipeline
+    ----
+    settings_file: YAML file with global settings
+    now_stamp: identifier of the run (YYYYMMDDHH), also the name of its output folder
+    store_in_cloud: write the outputs to Azure's cloud storage
+    shared: SharedResources of a batch of countries (default: the run creates its own)
+    output_per_country: local outputs in <output_dir>/<country>/<now_stamp> (as in the cloud) instead of <output_dir>/<now_stamp>
+    storage: output storage to use instead of the one following from the settings (e.g. MemoryStorage)
+    metrics: RunMetrics to add the stages of this run to (default: new ones)
+    profile_dir: write a cProfile of every stage into this folder
+    """
 
-    # --- unpack settings ---
-    with open(settings_file,'r') as f:
-        settings = yaml.safe_load(f)
-    USER_AGENT = settings['METnoAPI']['user-agent']
-    download_dir = settings['METnoAPI']['download_dir']
-    
-    country = settings['geoCoordinates']['country_code'].lower() # allow user to either enter "MWI" or "mwi"
-    file_points_api_calls = settings['geoCoordinates']['locations_of_interest']
-
-
-    # --- Azure Cloud Storage settings--- 
-    cloud_path = settings['AzureCloudStorage']['main_dir']
-    cloud_input_shape_dirname = settings['AzureCloudStorage']['input_dir']
-    input_shape_file = settings['AzureCloudStorage']['input_shape_file']
-    cloud_input_shape_file = os.path.join(cloud_path, country, 
-                                          cloud_input_shape_dirname, 
-                                          input_shape_file)
-    cloud_output = os.path.join(cloud_path, country, 
-                                     f"{now_stamp}")
-
-    
-    # --- Local Storage settings --- 
-    local_path = settings['localStorage']['main_dir']
-    local_input_dir = os.path.join(local_path, 
-                                   settings['localStorage']['input_dir'])
-    local_output = os.path.join(local_path,
-                                settings['localStorage']['output_dir'],
-                                f"{now_stamp}")
-    local_raw_output = os.path.join(local_output,  
-                                    settings['localStorage']['raw_output'])
-    
-    if not os.path.exists(local_output):
-        os.makedirs(local_output)
-    if not os.path.exists(local_raw_output):
-        os.makedirs(local_raw_output)
-    if not os.path.exists('./temp'):
-        os.mkdir('./temp')
-        os.mkdir('./temp/downloads')
-
-
-    # ---- output filenames ---- 
-    file_geotable = "_".join([f"{now_stamp}", 
-                              settings['outputFiles']['geojson_raw']])
-    file_raster = "_".join([f"{now_stamp}",
-                            settings['outputFiles']['tif_raw']])
-    file_trigger = "_".join([f"{now_stamp}",
-                             settings['outputFiles']['trigger_status']])
-    file_zonal_stats = "_".join([f"{now_stamp}",
-                                 settings['outputFiles']['csv_zonal']])
-    file_zonal_daily = "_".join([f"{now_stamp}",
-                                 settings['outputFiles']['csv_zonal_daily']])
-    file_raster_daily = "_".join([f"{now_stamp}",
-                                  settings['outputFiles']['tif_raw_daily']])
-    file_png_bar_plot_daily = "_".join([f"{now_stamp}",
-                                        settings['outputFiles']['png_bar_plot_daily_by_admin']])
-
-    # --- fetch thresholds ----  
-    rainfall_thresholds = settings['rainfallThreshold']
-
-    ########################
-    # start pipeline here  #
-    ########################
-    # --- 0. unzip shapefiles from archives (if not already done) ---     
-    download_from_azure_cloud_storage( 
-        cloud_filename=cloud_input_shape_file,
-        local_filename=input_shape_file)
+    def __init__(self, settings_file, now_stamp, store_in_cloud=False, shared=None, output_per_country=False, storage=None,
+                 metrics=None, profile_dir=None):
+        self.settings_file = settings_file
+        self.now_stamp = now_stamp
+        self.store_in_cloud = store_in_cloud
+        self.shared = shared
+
+        # --- unpack settings ---
+        with open(settings_file,'r') as f:
+            self.settings = settings = yaml.safe_load(f)
+        self.country = settings['geoCoordinates']['country_code'].lower() # allow user to either enter "MWI" or "mwi"
+        self.file_points_api_calls = settings['geoCoordinates']['locations_of_interest']
+
+        # --- Azure Cloud Storage settings---
+        cloud_path = settings['AzureCloudStorage']['main_dir']
+        cloud_input_shape_dirname = settings['AzureCloudStorage']['input_dir']
+        self.input_shape_file = settings['AzureCloudStorage']['input_shape_file']
+        self.cloud_input_shape_file = os.path.join(cloud_path, self.country,
+                                                   cloud_input_shape_dirname,
+                                                   self.input_shape_file)
+        self.cloud_output = os.path.join(cloud_path, self.country,
+                                         f"{now_stamp}")
+
+        # --- Local Storage settings ---
+        local_path = settings['localStorage']['main_dir']
+        self.local_input_dir = os.path.join(local_path,
+                                            settings['localStorage']['input_dir'])
+        self.local_output = os.path.join(local_path,
+                                         settings['localStorage']['output_dir'],
+                                         self.country if output_per_country else '',
+                                         f"{now_stamp}")
+        # raw outputs go into this sub-folder of the output folder
+        self.raw_output = settings['localStorage']['raw_output']
+
+        # ---- output filenames ----
+        output_files = settings['outputFiles']
+        self.file_geotable = "_".join([f"{now_stamp}", output_files['geojson_raw']])
+        self.file_raster = "_".join([f"{now_stamp}", output_files['tif_raw']])
+        self.file_trigger = "_".join([f"{now_stamp}", output_files['trigger_status']])
+        self.file_zonal_stats = "_".join([f"{now_stamp}", output_files['csv_zonal']])
+        self.file_zonal_daily = "_".join([f"{now_stamp}", output_files['csv_zonal_daily']])
+        self.file_raster_daily = "_".join([f"{now_stamp}", output_files['tif_raw_daily']])
+        self.file_png_bar_plot_daily = "_".join([f"{now_stamp}", output_files['png_bar_plot_daily_by_admin']])
+        self.file_run_report = "_".join([f"{now_stamp}", output_files.get('json_run_report', 'run_report.json')])
+        self.file_trigger_report = "_".join([f"{now_stamp}", output_files.get('json_trigger_report', 'trigger_report.json')])
+
+        # --- fetch thresholds ----
+        self.rainfall_thresholds = rainfall_thresholds = settings['rainfallThreshold']
+        self.percentile_col = f"q{rainfall_thresholds['agg_percentile']}"
+        # evaluate thresholds on the daily sum of the mean (default) or of the percentile per area
+        self.trigger_col = self.percentile_col if rainfall_thresholds.get('trigger_statistic', 'mean') == 'percentile' else 'mean'
+        self.trigger_thresholds = TriggerThresholds.from_settings(rainfall_thresholds)
+
+        # Fetch from settings what admin levels you want to use:
+        # You put either 'TRUE' or 'FALSE' in settings.
+        self.admin_levels = [f"adm{i}" for i in range(1,5) if settings['geoCoordinates'][f"adm{i}"]]
+        self._storage = storage
+
+        # --- very large areas: the long table is processed in parts of grid points within this budget ---
+        self.memory_budget_mb = settings.get('processing', {}).get('memory_budget_mb', False)
+        # --- nested admin levels: zonal statistics of the finest level only, the coarser ones combined from them ---
+        self.rollup_admin_levels = settings.get('processing', {}).get('rollup_admin_levels', False)
+
+        # --- completed stages and fetched points, to resume a failed run (--resume) ---
+        # (outside of ./temp, which --remove_temp deletes: keep it on persistent storage, next to the forecast cache)
+        self.checkpoint_dir = os.path.join(settings.get('processing', {}).get('checkpoint_dir') or './checkpoints',
+                                           self.country, f"{now_stamp}")
+
+        # --- timings and counts per stage (run report and Prometheus textfile) ---
+        self.prometheus_dir = settings.get('monitoring', {}).get('prometheus_dir', False)
+        self.metrics = metrics or RunMetrics(labels={'country': self.country}, profile_dir=profile_dir)
+
+    @property
+    def storage(self):
+        """
+        output storage: local folder, cloud or both (every output is written once, straight to its destination)
+        """
+        if self._storage is None:
+            storages = []
+            if not self.store_in_cloud or self.settings['localStorage'].get('keep_local_copy', True):
+                storages.append(LocalStorage(self.local_output))
+            if self.store_in_cloud:
+                # all outputs of a run in a single cloud folder
+                storages.append(AzureBlobStorage(self.cloud_output,
+                                                 max_workers=self.settings['AzureCloudStorage'].get('upload_workers', 4),
+                                                 flatten=True))
+            storage = storages[0] if len(storages) == 1 else MultiStorage(storages)
+            # the outputs of every stage are recorded for its checkpoint (only with a local copy to resume from)
+            self._storage = RecordingStorage(storage) if self.keeps_local_copy else storage
+        return self._storage
+
+    @property
+    def keeps_local_copy(self):
+        return (self._storage is None or isinstance(self._storage, RecordingStorage)) and \
+            (not self.store_in_cloud or self.settings['localStorage'].get('keep_local_copy', True))
+
+    def local_file(self, *names):
+        """
+        output of an earlier stage of this run (in the local output folder)
+        """
+        filename = os.path.join(self.local_output, *names)
+        if not os.path.exists(filename):
+            raise click.ClickException(f"{filename} not found: run the previous stage first (with a local copy of the outputs)")
+        return filename
+
+    def admin_shapefile(self, admin_lvl):
+        # Will now be "mwi_catchment.geojson" , "mwi_adm3.geojson" etc.
+        return os.path.join(self.local_input_dir, f"{self.country}_{admin_lvl}.geojson")
+
+    def zonal_stats_file(self, admin_lvl):
+        return "_".join([self.file_zonal_stats, admin_lvl])+'.csv'
+
+    def zonal_daily_file(self, admin_lvl):
+        return "_".join([self.file_zonal_daily, admin_lvl])+'.csv'
+
+    def bar_plot_file(self, admin_lvl):
+        return "_".join([self.file_png_bar_plot_daily, admin_lvl])+'.png'
+
+    def forecast_cache(self):
+        # the forecast cache should live outside of ./temp to be re-used by the next run
+        api_settings = self.settings['METnoAPI']
+        cache_settings = dict(cache_dir=api_settings.get('cache_dir', api_settings['download_dir']),
+                              max_age_hours=api_settings.get('cache_max_age_hours', None),
+                              max_size_mb=api_settings.get('cache_max_mb', None))
+        if self.shared is not None:
+            return self.shared.forecast_cache(**cache_settings)
+        return ForecastCache(**cache_settings)
+
+    def plot_pool(self):
+        # bar plots and maps are rendered in worker processes while the pipeline continues
+        return PlotPool(max_workers=self.settings['mapSettings'].get('plotWorkers', 1),
+                        executor=self.shared.plot_executor if self.shared is not None else None)
+
+    def plot_dpi(self, preview):
+        return self.settings['mapSettings'].get('previewDpi', 72) if preview else 300
+
+    @property
+    def chunked(self):
+        return bool(self.memory_budget_mb)
+
+    def chunk_points(self, forecast_store):
+        # grid points whose part of the long table fits in the memory budget
+        rows_per_point = len(forecast_store) / max(1, len(forecast_store.points))
+        return points_per_chunk(self.memory_budget_mb, rows_per_point * BYTES_PER_TABLE_ROW)
+
+    def checkpoints(self):
+        # StageCheckpoints of the run (None without a local copy of the outputs: nothing to resume from)
+        if not self.keeps_local_copy:
+            return None
+        return StageCheckpoints(os.path.join(self.checkpoint_dir, 'stages.json'), self.local_output)
+
+    def fetch_progress(self, resume=False):
+        return FetchProgress(os.path.join(self.checkpoint_dir, 'fetched_points.txt'), resume=resume)
+
+    def remove_checkpoints(self):
+        # once the run succeeded there is nothing left to resume
+        if os.path.exists(self.checkpoint_dir):
+            shutil.rmtree(self.checkpoint_dir)
+        # (and the folder of the country, once no other run of it has checkpoints)
+        try:
+            os.rmdir(os.path.dirname(self.checkpoint_dir))
+        except OSError:
+            pass
+
+    def settings_key(self, *sections):
+        # the settings of the given sections that change the outputs (for the checkpoint keys)
+        return {section: {key: value for key, value in self.settings.get(section, {}).items()
+                          if key not in NOT_IN_CHECKPOINT_KEYS}
+                for section in sections}
+
+    def input_digests(self, *filenames):
+        # content of input files (for the checkpoint keys)
+        return {os.path.basename(filename): file_md5(filename).hex() if os.path.exists(filename) else None
+                for filename in filenames}
+
+    def write_metrics(self, status='ok'):
+        """
+        run report (JSON, with the other outputs), Prometheus textfile (monitoring: prometheus_dir) and the profiles (if any)
+        """
+        self.metrics.set(**self.storage.metrics())
+        report = dict(run=self.now_stamp, settings_file=self.settings_file, **self.metrics.report(status))
+        self.storage.write_bytes(self.file_run_report, json.dumps(report, indent=2).encode())
+        self.storage.close()
+        if self.prometheus_dir:
+            print(f"metrics: {self.metrics.write_prometheus(self.prometheus_dir, status)}")
+        for filename in self.metrics.write_profiles():
+            print(f"profile: {filename}")
+        return report
+
+
+def stage(name):
+    # time the stage (and profile it, see --profile_dir) in the metrics of the run
+    def decorator(stage_function):
+        @functools.wraps(stage_function)
+        def timed_stage(run, *args, **kwargs):
+            with run.metrics.stage(name):
+                return stage_function(run, *args, **kwargs)
+        return timed_stage
+    return decorator
+
+
+########################
+# stages of the pipeline
+########################
+@stage('inputs')
+def prepare_inputs(run):
+    # --- 0. unzip shapefiles from archives (if not already done) ---
+    # (only transferred when the archive in the cloud changed, and only unzipped again if so)
+    # returns whether new shapefiles were downloaded
+    downloaded = download_from_azure_cloud_storage(
+        cloud_filename=run.cloud_input_shape_file,
+        local_filename=run.input_shape_file)
+    if downloaded:
+        print(f"downloaded: {run.input_shape_file}")
+    else:
+        print(f"up to date: {run.input_shape_file}")
 
     unzip_shapefiles(dirname='./')
+    return downloaded
 
 
+@stage('fetch')
+def fetch_forecasts(run, save=True, resume=False, record_progress=True):
     # -- 1. Get predictions on grid ---
+    # resume: the points an earlier attempt of this run fetched are not requested again
+    # record_progress: keep the fetched points in the checkpoints of the run (for --resume; not needed by the service)
+    settings = run.settings
+    forecast_cache = run.forecast_cache()
+    fetch_counts = FetchCounts()
+    progress = run.fetch_progress(resume) if record_progress else None
+    if progress is not None and len(progress):
+        print(f"resuming: {len(progress)} points fetched earlier")
+
     print("weather predictions for gridpoints...")
-    rainfall_gdf = API_requests_at_gridpoints(
-        filename_gridpoints = os.path.join(local_input_dir, 
-                                           file_points_api_calls), 
-        destination_dir = download_dir,
-        save_to_file= os.path.join(local_raw_output,
-                                   file_geotable), 
-        USER_AGENT=USER_AGENT
-        )
-    # rainfall_gdf = gpd.read_file(os.path.join(local_raw_output,
-    #                                           file_geotable))
-    print(f"created: {file_geotable}")
+    try:
+        forecast_store = API_requests_to_forecast_store(
+            filename_gridpoints = os.path.join(run.local_input_dir,
+                                               run.file_points_api_calls),
+            destination_dir = forecast_cache.cache_dir,
+            USER_AGENT=settings['METnoAPI']['user-agent'],
+            max_workers=settings['METnoAPI'].get('max_workers', 1),
+            requests_per_second=settings['METnoAPI'].get('requests_per_second', None),
+            base_url=settings['METnoAPI'].get('base_url', None),
+            forecast_type=settings['METnoAPI'].get('forecast_type', 'complete'),
+            variables=settings['METnoAPI'].get('variables') or ['precipitation_amount'],
+            cache=forecast_cache,
+            session=run.shared.session if run.shared is not None else None,
+            rate_limiter=run.shared.rate_limiter if run.shared is not None else None,
+            progress=progress,
+            chunk_points=points_per_chunk(run.memory_budget_mb, BYTES_PER_FORECAST),
+            counts=fetch_counts,
+            # a shared cache is only trimmed once all countries are done (SharedResources.close())
+            evict=run.shared is None
+            )
+    finally:
+        if progress is not None:
+            progress.close()
+    fetched = fetch_counts.counts
+    run.metrics.count(api_requests=fetched['revalidated'] + fetched['miss'],
+                      forecast_cache_hits=fetched['hit'],
+                      forecast_cache_revalidated=fetched['revalidated'],
+                      forecast_cache_misses=fetched['miss'],
+                      bytes_downloaded=fetched['bytes_downloaded'])
+    served = fetched['hit'] + fetched['revalidated'] + fetched['miss']
+    # served without downloading the forecast again
+    run.metrics.set(forecast_cache_hit_rate=round((fetched['hit'] + fetched['revalidated']) / served, 4) if served else None)
+    # (chunked: no long table as a whole, the next stages work from the store part by part)
+    rainfall_gdf = None if run.chunked else forecast_store.to_geodataframe()
+    run.metrics.set(grid_points=len(forecast_store.points), forecast_rows=len(forecast_store))
+    if save:
+        save_forecasts(run, rainfall_gdf, forecast_store)
     print("--"*8 + "\n"*2)
+    return rainfall_gdf, forecast_store
+
+
+def save_forecasts(run, rainfall_gdf, forecast_store=None):
+    if rainfall_gdf is None:
+        write_raw_forecast_in_chunks(
+            (part.to_geodataframe() for part in forecast_store.chunks(run.chunk_points(forecast_store))),
+            save_to_file=os.path.join(run.raw_output, run.file_geotable),
+            storage=run.storage,
+            bbox=forecast_store.points.total_bounds)
+    else:
+        write_raw_forecast(rainfall_gdf,
+                           save_to_file=os.path.join(run.raw_output, run.file_geotable),
+                           storage=run.storage)
+    print(f"created: {run.file_geotable}")
+
+
+@stage('load')
+def load_forecasts(run, from_raw=None):
+    # -- 1. (or) the predictions of an earlier run (--from_raw) or of the fetch stage of this run ---
+    from_raw = from_raw or run.local_file(run.raw_output, run.file_geotable)
+    print(f"loading weather predictions from {from_raw}...")
+    if run.chunked:
+        rainfall_gdf = None
+        forecast_store = read_raw_forecast_store(from_raw, chunk_rows=points_per_chunk(run.memory_budget_mb, BYTES_PER_TABLE_ROW))
+    else:
+        rainfall_gdf = read_raw_forecast(from_raw)
+        forecast_store = ForecastStore.from_geodataframe(rainfall_gdf)
+    run.metrics.set(grid_points=len(forecast_store.points), forecast_rows=len(forecast_store))
+    print("--"*8 + "\n"*2)
+    return rainfall_gdf, forecast_store
 
 
+@stage('rasterize')
+def rasterize_forecasts(run, rainfall_gdf, forecast_store, save=True, grid_index=None):
     # --- 2. Save as TIF file ---
-    print("save into TIF format....")
-    tif_path = os.path.join(local_raw_output,
-                            file_raster)
-    rainfall_array = gdf_to_rasterfile(
-        rainfall_gdf, 
-        save_to_file=tif_path
-        )
-    print(f"created: {file_raster}")
+    print("save into TIF format...." if save else "rasterize predictions....")
+    if grid_index is None:
+        grid_index = GridIndex(forecast_store.points)
+    if rainfall_gdf is None:
+        rainfall_array = store_to_rasterfile(
+            forecast_store,
+            save_to_file=os.path.join(run.raw_output, run.file_raster) if save else None,
+            grid_index=grid_index,
+            storage=run.storage,
+            chunk_points=run.chunk_points(forecast_store)
+            )
+    else:
+        rainfall_array = gdf_to_rasterfile(
+            rainfall_gdf,
+            save_to_file=os.path.join(run.raw_output, run.file_raster) if save else None,
+            grid_index=grid_index,
+            storage=run.storage
+            )
+    if save:
+        print(f"created: {run.file_raster}")
     print("--"*8 + "\n"*2)
-
-    #---- 3. Aggregate by admin boundary and by day ------
-    # Fetch from settings what admin levels you want to use: 
-    admin_levels = [f"adm{i}" for i in range(1,5)]
-    percentile_col = f"q{rainfall_thresholds['agg_percentile']}"
-    for admin_lvl in admin_levels:
-         # You put either 'TRUE' or 'FALSE' in settings. 
-        if settings['geoCoordinates'][admin_lvl]:  
-            # Will now be "mwi_catchment.geojson" , "mwi_adm3.geojson" etc.
-            basename = f"{country}_{admin_lvl}.geojson"
-            file_admin_shapefile = os.path.join(local_input_dir, 
-                                                basename)
-
-            #---- 3.1 aggregate by admin ------
-            rainfall_by_admin = pd.DataFrame()
-            for band_idx, timepoint in tqdm(enumerate(rainfall_array.time_of_prediction)):
-                # aggregate by admin boundary: 
-
-                print(f"performing zonal statistics {admin_lvl} ....")
-                raster_path = os.path.join(local_raw_output, 
-                                           file_raster)
-                by_admin = zonal_statistics(rasterfile=raster_path,
-                                            shapefile= file_admin_shapefile,
-                                            minval=0.,  # rainfall cannot be negative
-                                            aggregate_by=[np.mean, np.std, np.max, np.min],
-                                            nameKey = "_".join([admin_lvl.upper(), 'EN']), 
-                                            pcodeKey = "_".join([admin_lvl.upper(), 'PCODE']), 
-                                            band=band_idx
-                                            )
-
-                rename_dict = {"value_1": "mean",
-                               "value_2": "std",
-                               "value_3": "max",
-                               "value_4": "min",
-                               "value_5": percentile_col}
-                by_admin.rename(rename_dict, axis='columns', inplace=True)
-                by_admin['time_of_prediction'] = pd.to_datetime(timepoint.values)
-                rainfall_by_admin = pd.concat([rainfall_by_admin, by_admin])
-
-            rainfall_by_admin.reset_index(drop=True, inplace=True)
-            filename_zonal_stats_admin = "_".join([file_zonal_stats,admin_lvl])+'.csv'
-            rainfall_by_admin.to_csv(
-                os.path.join(local_raw_output,filename_zonal_stats_admin), 
-                index=False)
-            print(f"created: {filename_zonal_stats_admin}")
-
-
-            print(f"determining daily aggregates for {admin_lvl} ...")
-            #---- 3.2 Aggregate by day ------
-            file_zonal_daily_admin = "_".join([file_zonal_daily,admin_lvl])+'.csv'
-            file_bar_plot_admin = "_".join([file_png_bar_plot_daily, admin_lvl])+'.png'
-            rainfall_by_admin_by_day, by_admin_by_day = \
-                daily_aggregates_per_admin(
-                rainfall_by_admin, 
-                settings,
-                rainfall_thresholds=rainfall_thresholds, 
-                save_to_file=os.path.join(local_raw_output,file_zonal_daily_admin), 
-                save_fig_to_png=os.path.join(local_output,file_bar_plot_admin),
-                destination_fldr=local_output,
-                timestamp=now_stamp
-                )
-            print(f"created: {file_zonal_daily_admin}")
+    return grid_index, rainfall_array
+
+
+@stage('zonal')
+def zonal_statistics_per_admin(run, grid_index, rainfall_array, zones=None, previous=None):
+    #---- 3.1 aggregate by admin ------
+    # zones: ZonalStatistics per admin level kept between runs (filled with the ones made here)
+    # previous: (rainfall_array, rainfall_by_admin) of an earlier run on the same grid: only what changed is recomputed
+    zones = {} if zones is None else zones
+    rainfall_by_admin = {}
+    aggregate_by = ['mean', 'std', 'max', 'min', run.percentile_col]
+    # rolled up: the finest level first (with the pixel sums and counts the coarser levels are combined from)
+    finest = run.admin_levels[-1] if run.rollup_admin_levels and len(run.admin_levels) > 1 else None
+    for admin_lvl in sorted(run.admin_levels, key=lambda admin_lvl: admin_lvl != finest):
+        # aggregate by admin boundary (all timepoints at once):
+        print(f"performing zonal statistics {admin_lvl} ....")
+        if finest is not None and admin_lvl != finest:
+            if admin_lvl not in zones:
+                zones[admin_lvl] = rollup_zones(run, zones[finest], admin_lvl, finest)
+            print(f"combined from {finest}")
+            rainfall_by_admin[admin_lvl] = zones[admin_lvl].combine(rainfall_by_admin[finest], rainfall_array,
+                                                                    aggregate_by=aggregate_by,
+                                                                    minval=0.)
+            write_zonal_statistics(run, admin_lvl, rainfall_by_admin[admin_lvl])
+            continue
+
+        if admin_lvl not in zones:
+            zones[admin_lvl] = ZonalStatistics(shapefile=run.admin_shapefile(admin_lvl),
+                                               grid_index=grid_index,
+                                               nameKey = "_".join([admin_lvl.upper(), 'EN']),
+                                               pcodeKey = "_".join([admin_lvl.upper(), 'PCODE'])
+                                               )
+        computed_by = aggregate_by + ['sum', 'count'] if admin_lvl == finest else aggregate_by
+        if previous is not None and admin_lvl in previous[1] and all(metric in previous[1][admin_lvl] for metric in computed_by):
+            rainfall_by_admin[admin_lvl], recomputed = zones[admin_lvl].update(previous[1][admin_lvl], previous[0], rainfall_array,
+                                                                              aggregate_by=computed_by,
+                                                                              minval=0.)
+            print(f"recomputed {recomputed} of {rainfall_array.shape[0] * zones[admin_lvl].n_zones} statistics")
+        else:
+            rainfall_by_admin[admin_lvl] = zones[admin_lvl].compute(rainfall_array,
+                                                                    aggregate_by=computed_by,
+                                                                    minval=0.  # rainfall cannot be negative
+                                                                    )
+        # (the sums and counts are only kept in memory)
+        write_zonal_statistics(run, admin_lvl, rainfall_by_admin[admin_lvl].drop(columns=[metric for metric in computed_by 
+                                                                                          if metric not in aggregate_by]))
+    print("--"*8 + "\n"*2)
+    return {admin_lvl: rainfall_by_admin[admin_lvl] for admin_lvl in run.admin_levels}
+
+
+def write_zonal_statistics(run, admin_lvl, rainfall_of_admin):
+    filename_zonal_stats_admin = run.zonal_stats_file(admin_lvl)
+    run.storage.write_bytes(
+        os.path.join(run.raw_output,filename_zonal_stats_admin),
+        rainfall_of_admin.to_csv(index=False).encode())
+    print(f"created: {filename_zonal_stats_admin}")
+
+
+def rollup_zones(run, finest_zones, admin_lvl, finest):
+    # --- the areas of a coarser admin level, made up of those of the finest level (by parent pcode, no rasterizing) ---
+    parents = gpd.read_file(run.admin_shapefile(admin_lvl), ignore_geometry=True)
+    children = gpd.read_file(run.admin_shapefile(finest), ignore_geometry=True)
+    pcode_key = "_".join([admin_lvl.upper(), 'PCODE'])
+    parent_of_zone = parent_zones(finest_zones.pcodes,
+                                  parents[pcode_key].to_numpy(),
+                                  parent_keys=children[pcode_key].to_numpy() if pcode_key in children else None)
+    if (parent_of_zone < 0).any():
+        print(f"{int((parent_of_zone < 0).sum())} area(s) of {finest} not in any area of {admin_lvl}")
+    return finest_zones.rollup(parent_of_zone,
+                               names=parents["_".join([admin_lvl.upper(), 'EN'])].to_numpy(),
+                               pcodes=parents[pcode_key].to_numpy())
+
+
+@stage('load')
+def load_zonal_statistics(run):
+    # --- 3.1 (or) the zonal statistics written by the zonal stage of this run ---
+    return {admin_lvl: pd.read_csv(run.local_file(run.raw_output, run.zonal_stats_file(admin_lvl)),
+                                   parse_dates=['time_of_prediction'],
+                                   float_precision='round_trip')
+            for admin_lvl in run.admin_levels}
+
+
+@stage('daily')
+def daily_aggregates_and_triggers(run, rainfall_by_admin, plot_pool=None, dpi=300):
+    #---- 3.2 Aggregate by day and check the thresholds ------
+    # (the bar plots are only made when a plot pool is given)
+    daily_by_admin = {}
+    for admin_lvl, rainfall_of_admin in rainfall_by_admin.items():
+        print(f"determining daily aggregates for {admin_lvl} ...")
+        daily_by_admin[admin_lvl] = daily_aggregates(rainfall_of_admin, aggregate_by=run.trigger_col, groupby=['name'])
+
+    # --- all thresholds, for the areas of all admin levels at once ---
+    print("check thresholds...")
+    triggers = run.trigger_thresholds.evaluate(daily_by_admin)
+
+    for admin_lvl, rainfall_by_admin_by_day in daily_by_admin.items():
+        rainfall_by_admin_by_day['trigger'] = triggers.daily_trigger(admin_lvl)
+        file_zonal_daily_admin = run.zonal_daily_file(admin_lvl)
+        file_bar_plot_admin = run.bar_plot_file(admin_lvl) if plot_pool is not None else None
+        daily_aggregates_per_admin(
+            rainfall_by_admin_by_day,
+            run.settings,
+            save_to_file=os.path.join(run.raw_output,file_zonal_daily_admin),
+            save_fig_to_png=file_bar_plot_admin,
+            timestamp=run.now_stamp,
+            plot_pool=plot_pool,
+            dpi=dpi,
+            storage=run.storage
+            )
+        print(f"created: {file_zonal_daily_admin}")
+        if file_bar_plot_admin is not None:
             print(f"bar plot: {file_bar_plot_admin}")
 
-            
-            print(f"check thresholds for {admin_lvl}...")
-            check_threshold(rainfall_by_admin_by_day, 
-                            'ONE-DAY', 
-                            save_to_file=os.path.join(local_output,file_trigger))
-            check_threshold(by_admin_by_day, 
-                            'THREE-DAY', 
-                            save_to_file=os.path.join(local_output,file_trigger))
-            print("--"*8 + "\n"*2)
-
-
-   # ---- 4. display daily aggegrates (determine values for all locations requested by API for plotting purposes) --- 
+    trigger_states = triggers.states()
+    print("\n".join(trigger_states))
+    print("--"*8 + "\n"*2)
+    if trigger_states:
+        run.storage.write_bytes(run.file_trigger + '.txt',
+                                "".join(f"{state}\n" for state in trigger_states).encode())
+    run.storage.write_bytes(run.file_trigger_report,
+                            json.dumps(triggers.report(timestamp=run.now_stamp, statistic=run.trigger_col),
+                                       indent=2).encode())
+    return daily_by_admin
+
+
+@stage('load')
+def load_daily_statistics(run):
+    # --- 3.2 (or) the daily totals written by the daily stage of this run ---
+    return {admin_lvl: pd.read_csv(run.local_file(run.raw_output, run.zonal_daily_file(admin_lvl)),
+                                   float_precision='round_trip')
+            for admin_lvl in run.admin_levels}
+
+
+@stage('daily')
+def daily_aggregates_of_locations(run, rainfall_gdf, grid_index, save=True, forecast_store=None):
+   # ---- 4. display daily aggegrates (determine values for all locations requested by API for plotting purposes) ---
     print(f"determining daily aggregates for every location....")
-
-
-    daily_rainfall_arr = \
-        daily_aggregates_per_location(
-            rainfall_gdf, 
-            save_to_file=os.path.join(local_raw_output, file_raster_daily))
+    if rainfall_gdf is None:
+        return daily_aggregates_per_location_in_chunks(
+            forecast_store,
+            save_to_file=os.path.join(run.raw_output, run.file_raster_daily) if save else None,
+            grid_index=grid_index,
+            storage=run.storage,
+            chunk_points=run.chunk_points(forecast_store))
+    return daily_aggregates_per_location(
+        rainfall_gdf,
+        save_to_file=os.path.join(run.raw_output, run.file_raster_daily) if save else None,
+        grid_index=grid_index,
+        storage=run.storage)
+
+
+@stage('plot')
+def plot_bar_charts(run, daily_by_admin, plot_pool, dpi=300):
+    production_time = pd.to_datetime(run.now_stamp, format="%Y%m%d%H").strftime(format="%H:00 %d-%m-%Y")
+    for admin_lvl, rainfall_by_admin_by_day in daily_by_admin.items():
+        plot_pool.submit(run.storage, run.bar_plot_file(admin_lvl),
+                         plot_daily_bar_chart, rainfall_by_admin_by_day, run.settings['mapSettings'], production_time, dpi)
+        print(f"bar plot: {run.bar_plot_file(admin_lvl)}")
+
+
+@stage('plot')
+def plot_maps(run, daily_rainfall_arr, plot_pool, dpi=300, layers=None):
     print("creating PNG images .....")
     plot_rainfall_map_per_day(
         rainfall_da=daily_rainfall_arr,
-        settings=settings,
-        shapefile_fldr=local_input_dir,
-        destination_fldr=local_output,
-        timestamp=now_stamp)
+        settings=run.settings,
+        shapefile_fldr=run.local_input_dir,
+        destination_fldr='',
+        timestamp=run.now_stamp,
+        plot_pool=plot_pool,
+        dpi=dpi,
+        storage=run.storage,
+        layers=layers)
+
+
+def run_pipeline(run, from_raw=None, preview=False, inputs_ready=False, resume=False):
+    """
+    all stages of a run, in memory (the outputs are written on the way)
+    ----
+    from_raw: start from the raw forecast table of an earlier run instead of the API
+    preview: render maps and bar plots at low resolution
+    inputs_ready: the shapefiles were already downloaded and unzipped (stage 0 is skipped)
+    resume: continue an earlier attempt of this run: skip the stages it completed, fetch only the missing points
+    """
+    if not inputs_ready:
+        prepare_inputs(run)
+    checkpoints = run.checkpoints()
+    admin_shapefiles = run.input_digests(*[run.admin_shapefile(admin_lvl) for admin_lvl in run.admin_levels])
+
+    if from_raw is not None:
+        rainfall_gdf, forecast_store = load_forecasts(run, from_raw)
+        forecasts = run.input_digests(from_raw)
+    else:
+        (rainfall_gdf, forecast_store), forecasts = checkpointed_stage(
+            run, checkpoints, resume, 'fetch',
+            content_key(run.now_stamp, run.settings_key('METnoAPI', 'geoCoordinates'),
+                        run.input_digests(os.path.join(run.local_input_dir, run.file_points_api_calls))),
+            compute=lambda: fetch_forecasts(run, resume=resume),
+            load=lambda: load_forecasts(run))
+
+    (grid_index, rainfall_array), raster = checkpointed_stage(
+        run, checkpoints, resume, 'rasterize',
+        content_key(forecasts),
+        compute=lambda: rasterize_forecasts(run, rainfall_gdf, forecast_store),
+        load=lambda: rasterize_forecasts(run, rainfall_gdf, forecast_store, save=False))
 
-    print(f"wrote PNG files into: {local_output}")
+    #---- 3. Aggregate by admin boundary and by day ------
+    rainfall_by_admin, zonal_stats = checkpointed_stage(
+        run, checkpoints, resume, 'zonal',
+        content_key(raster, admin_shapefiles, run.settings_key('geoCoordinates', 'rainfallThreshold')),
+        compute=lambda: zonal_statistics_per_admin(run, grid_index, rainfall_array),
+        load=lambda: load_zonal_statistics(run))
+
+    (daily_by_admin, daily_rainfall_arr), daily_stats = checkpointed_stage(
+        run, checkpoints, resume, 'daily',
+        content_key(zonal_stats, forecasts, run.settings_key('rainfallThreshold')),
+        compute=lambda: (daily_aggregates_and_triggers(run, rainfall_by_admin),
+                         daily_aggregates_of_locations(run, rainfall_gdf, grid_index, forecast_store=forecast_store)),
+        load=lambda: (load_daily_statistics(run),
+                      daily_aggregates_of_locations(run, rainfall_gdf, grid_index, save=False, forecast_store=forecast_store)))
+
+    # ---- 4. figures ---
+    dpi = run.plot_dpi(preview)
+    checkpointed_stage(
+        run, checkpoints, resume, 'plot',
+        content_key(daily_stats, admin_shapefiles, dpi, run.settings_key('mapSettings', 'geoCoordinates')),
+        compute=lambda: make_figures(run, daily_by_admin, daily_rainfall_arr, dpi),
+        load=lambda: None)
+    print(f"wrote PNG files into: {run.local_output}")
     print("--"*8 + "\n"*2)
 
 
-    # # --- write output files to cloud if needed  ---
-    # NOTE: It is assumed you wrote all files into the same directory on local 
-    if store_in_cloud:
-        output_files = [f for f in glob.glob(f'{local_output}/**', recursive=True) if os.path.isfile(f)]
-        for file_on_local in output_files:
-            file_in_cloud = os.path.join(cloud_output, 
-                                         file_on_local.split('/')[-1])
-            write_to_azure_cloud_storage(local_filename=file_on_local, 
-                                         cloud_filename=file_in_cloud)
-            print(f"created: {file_in_cloud} in Azure datalake")
+def make_figures(run, daily_by_admin, daily_rainfall_arr, dpi=300):
+    # bar plots and maps, rendered by the plot pool (waits until all are written)
+    with run.plot_pool() as plot_pool:
+        plot_bar_charts(run, daily_by_admin, plot_pool, dpi=dpi)
+        plot_maps(run, daily_rainfall_arr, plot_pool, dpi=dpi)
+        # the figures still being drawn
+        with run.metrics.stage('plot'):
+            plot_pool.wait()
+
+
+def checkpointed_stage(run, checkpoints, resume, name, key, compute, load):
+    """
+    run a stage and record its checkpoint, or (resume, completed earlier with the same key) load what it wrote instead 
+    ----
+    checkpoints: StageCheckpoints of the run (None: no checkpoints, the stage always runs)
+    key: content_key() of the inputs and settings of the stage
+    compute, load: functions returning the result of the stage (load: from its outputs)
+    returns the result and {name: MD5} of the outputs of the stage (for the keys of the next stages)
+    """
+    if checkpoints is None:
+        return compute(), key
+    outputs = checkpoints.completed(name, key) if resume else None
+    if outputs is not None:
+        print(f"{name}: completed earlier, skipped")
+        run.metrics.count(stages_skipped=1)
+        if run.store_in_cloud:
+            # written again: only what did not reach the cloud yet is uploaded (identical blobs are skipped)
+            for output_name in outputs:
+                with open(os.path.join(run.local_output, output_name), 'rb') as f:
+                    run.storage.write_bytes(output_name, f.read())
+        result = load()
+        run.storage.take_written()
+        return result, outputs
+    run.storage.take_written()
+    result = compute()
+    outputs = run.storage.take_written()
+    checkpoints.record(name, key, outputs)
+    return result, outputs
+
+
+def finish(run, remove_temp):
+    # --- wait for the outputs still being written (uploads to the cloud run in the background) ---
+    with run.metrics.stage('upload'):
+        run.storage.close()
+    if run.storage.summary():
+        print(run.storage.summary())
         print("--"*8 + "\n"*2)
 
+    run.write_metrics()
+    print(run.metrics.summary())
+    print(f"created: {run.file_run_report}")
+
+    # --- the run succeeded: nothing left to resume (with or without --remove_temp) ---
+    run.remove_checkpoints()
+
     if remove_temp:
-        shutil.rmtree('./temp/')
+        if os.path.exists('./temp/'):
+            shutil.rmtree('./temp/')
         print("removed temporary files")
 
     print("done")
-    return
+
+
+########################
+# command line
+########################
+@click.group(invoke_without_command=True)
+@click.option("--settings_file", type = str, required = True, default = './src/settings-mwi.yml', show_default = True, help = "YAML file with global settings (input/output file names, etc.)" )
+@click.option('--remove_temp', is_flag=True, default=False, show_default = True, help = "remove the intermediate files created by the pipeline? (default: keep temp/ folder)")
+@click.option('--store_in_cloud', is_flag=True, default=False, show_default = True, help = "Store the outputs in Azure's cloud storage (localStorage: keep_local_copy for a local copy as well)")
+@click.option('--from_raw', '--from-raw', 'from_raw', type = str, default = None, help = "skip the API requests: start from the raw forecast table (.parquet/.geojson) of an earlier run")
+@click.option('--preview', is_flag=True, default=False, show_default = True, help = "quick check: render maps and bar plots at low resolution (mapSettings: previewDpi)")
+@click.option('--timestamp', type = str, default = None, help = "run to work on (YYYYMMDDHH, default: now), to run the stages of a run one at a time")
+@click.option('--profile_dir', type = str, default = None, help = "profile every stage: <stage>.prof files in this folder, hottest functions in the run report")
+@click.option('--resume', is_flag=True, default=False, show_default = True, help = "continue a failed run (same --timestamp): skip the stages it completed, fetch only the points it did not fetch yet")
+@click.pass_context
+def collect_rainfall_data(ctx, settings_file, remove_temp, store_in_cloud, from_raw, preview, timestamp, profile_dir, resume):
+    """
+    Uses Metno weather API (LocationForecast) to retrieve rainfall predictions (approx. until ~10days in advance).
+    Aggregate the predicted rainfall in mm (for every timepoint available through the API) over catchment areas.
+    Obtain a single long-format CSV-file with columns:
+
+    |area_name| total_rainfall_mm| avg_rainfall_mm| max_rainfall_mm| min_rainfall_mm| time_of_prediction
+
+    Without a command, all stages are run (same as `all`).
+    """
+    if ctx.invoked_subcommand == 'startup':
+        return
+
+    now_stamp = timestamp or datetime.datetime.today().strftime(format="%Y%m%d%H")
+    # now_stamp = '2023070708'
+    ctx.obj = dict(run=PipelineRun(settings_file, now_stamp, store_in_cloud, profile_dir=profile_dir),
+                   remove_temp=remove_temp,
+                   from_raw=from_raw,
+                   preview=preview,
+                   resume=resume)
+    if ctx.invoked_subcommand is None:
+        ctx.invoke(run_all)
+
+
+@collect_rainfall_data.command(name='all')
+@click.pass_obj
+def run_all(obj):
+    """
+    run all stages (in memory): fetch, rasterize, zonal, daily, plot
+    """
+    run = obj['run']
+    try:
+        run_pipeline(run, from_raw=obj['from_raw'], preview=obj['preview'], resume=obj['resume'])
+    except Exception:
+        # the failure shows in the run report and in Prometheus as well
+        run.write_metrics('failed')
+        raise
+    finish(run, obj['remove_temp'])
+
+
+@collect_rainfall_data.command()
+@click.pass_obj
+def fetch(obj):
+    """
+    stage 1: download the predictions for the grid points (raw forecast table)
+    """
+    run = obj['run']
+    prepare_inputs(run)
+    fetch_forecasts(run)
+    finish(run, obj['remove_temp'])
+
+
+@collect_rainfall_data.command()
+@click.pass_obj
+def rasterize(obj):
+    """
+    stage 2: raw forecast table -> TIF file (one band per timepoint)
+    """
+    run = obj['run']
+    rasterize_forecasts(run, *load_forecasts(run, obj['from_raw']))
+    finish(run, obj['remove_temp'])
+
+
+@collect_rainfall_data.command()
+@click.pass_obj
+def zonal(obj):
+    """
+    stage 3: zonal statistics per admin area (CSV per admin level)
+    """
+    run = obj['run']
+    prepare_inputs(run)
+    grid_index, rainfall_array = rasterize_forecasts(run, *load_forecasts(run, obj['from_raw']), save=False)
+    zonal_statistics_per_admin(run, grid_index, rainfall_array)
+    finish(run, obj['remove_temp'])
+
+
+@collect_rainfall_data.command()
+@click.pass_obj
+def daily(obj):
+    """
+    stage 4: daily totals per admin area, trigger status, daily TIF of all locations
+    """
+    run = obj['run']
+    daily_aggregates_and_triggers(run, load_zonal_statistics(run))
+    rainfall_gdf, forecast_store = load_forecasts(run, obj['from_raw'])
+    daily_aggregates_of_locations(run, rainfall_gdf, GridIndex(forecast_store.points), forecast_store=forecast_store)
+    finish(run, obj['remove_temp'])
+
+
+@collect_rainfall_data.command()
+@click.pass_obj
+def plot(obj):
+    """
+    stage 5: bar plots of the daily totals per admin area, daily rainfall maps
+    """
+    run = obj['run']
+    prepare_inputs(run)
+    daily_by_admin = load_daily_statistics(run)
+    rainfall_gdf, forecast_store = load_forecasts(run, obj['from_raw'])
+    daily_rainfall_arr = daily_aggregates_of_locations(run, rainfall_gdf, GridIndex(forecast_store.points), save=False,
+                                                       forecast_store=forecast_store)
+
+    dpi = run.plot_dpi(obj['preview'])
+    plot_pool = run.plot_pool()
+    plot_bar_charts(run, daily_by_admin, plot_pool, dpi=dpi)
+    plot_maps(run, daily_rainfall_arr, plot_pool, dpi=dpi)
+    with run.metrics.stage('plot'):
+        plot_pool.close()
+    print(f"wrote PNG files into: {run.local_output}")
+    print("--"*8 + "\n"*2)
+
+    finish(run, obj['remove_temp'])
+
+
+@collect_rainfall_data.command()
+@click.pass_obj
+def upload(obj):
+    """
+    stage 6: copy the local output folder of the run to Azure's cloud storage (unchanged files are skipped)
+    """
+    run = obj['run']
+    output_files = [f for f in glob.glob(os.path.join(run.local_file(), '**'), recursive=True) if os.path.isfile(f)]
+    uploader = CloudUploader(azure_container_client(),
+                             max_workers=run.settings['AzureCloudStorage'].get('upload_workers', 4))
+    # all outputs of a run in a single cloud folder
+    uploader.upload_files([(file_on_local, os.path.join(run.cloud_output, os.path.basename(file_on_local)))
+                           for file_on_local in output_files])
+    print(uploader.summary())
+
+    run.remove_checkpoints()
+    if obj['remove_temp']:
+        if os.path.exists('./temp/'):
+            shutil.rmtree('./temp/')
+        print("removed temporary files")
+    print("done")
+
+
+# run by `startup` in a fresh interpreter: the command line with `--help`, then the heavy libraries it imported (last line)
+STARTUP_CHILD = """
+import os, runpy, sys, json
+# as `python rainfall_forecast.py --help`: the folder of the script first on the path
+sys.path.insert(0, os.path.dirname({script!r}))
+sys.argv = [{script!r}, '--help']
+try:
+    runpy.run_path({script!r}, run_name='__main__')
+except SystemExit:
+    pass
+print(json.dumps([name for name in {heavy_modules!r} if name in sys.modules]))
+"""
+
+
+@collect_rainfall_data.command()
+@click.option('--repeat', type = int, default = 5, show_default = True, help = "number of fresh starts to time")
+@click.option('--max_seconds', type = float, default = None, help = "fail when the fastest start takes longer (e.g. as a check in CI)")
+@click.option('--check_imports', is_flag=True, default=False, show_default = True, help = "fail when a heavy library is imported at start-up (e.g. as a check in CI)")
+def startup(repeat, max_seconds, check_imports):
+    """
+    time the start-up of the command line (a fresh interpreter running `--help`)
+    and list the heavy libraries that interpreter imported before any stage ran
+    """
+    child = STARTUP_CHILD.format(script=os.path.abspath(__file__), heavy_modules=HEAVY_MODULES)
+    timings = []
+    loaded = set()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', child], check=True, stdout=subprocess.PIPE, text=True)
+        timings.append(time.perf_counter() - start)
+        loaded.update(json.loads(result.stdout.strip().splitlines()[-1]))
+    loaded = [name for name in HEAVY_MODULES if name in loaded]
+
+    print(f"start-up: fastest {min(timings):.2f} s, slowest {max(timings):.2f} s ({repeat} runs); "
+          f"importing the pipeline: {IMPORT_SECONDS:.2f} s")
+    print(f"heavy libraries imported at start-up: {', '.join(loaded) if loaded else 'none'}")
+    if max_seconds is not None and min(timings) > max_seconds:
+        raise click.ClickException(f"start-up takes {min(timings):.2f} s (limit: {max_seconds:.2f} s)")
+    if check_imports and loaded:
+        raise click.ClickException(f"heavy libraries imported at start-up: {', '.join(loaded)}")
 
 
 if __name__ == '__main__':
-    collect_rainfall_data()
\ No newline at end of file
+    collect_rainfall_data()
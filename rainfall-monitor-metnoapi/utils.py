@@ -2,109 +2,699 @@
 Functions used by "rainfall_IBF_metno.py" 
 """
 
-from asyncore import write
-from email.policy import default
-import enum
-from mimetypes import common_types
-from threading import local
-import numpy as np
-import pandas as pd
-from metno_locationforecast import Place, Forecast
-import geopandas as gpd
-import rasterio
-import rasterstats
-import rioxarray
-import xarray as xr
-from tqdm import tqdm
 import os
-import glob
+import re
+import io
+import sys
+import json
+import time
+import hashlib
+import cProfile
+import datetime
+import pstats
+import contextlib
+import functools
+import importlib
+import threading
 import shutil
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pandas as pd
 import yaml
-from azure.storage.blob import BlobServiceClient
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import seaborn as sns 
-import cmocean
-import datetime
-import contextily as cx
+from tqdm import tqdm
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class LazyModule:
+    """
+    stand-in for a module that is imported the first time one of its attributes is used 
+    ----
+    name: module to import
+    also_import: submodules (or companion packages) imported along with it, 
+                 e.g. 'rasterio.mask' or 'rioxarray' (which registers the `.rio` accessor on xarray objects)
+
+    Keeps the start-up of the command line fast: a stage only pays for the libraries it actually uses. 
+    """
+
+    def __init__(self, name, *also_import):
+        self._name = name
+        self._also_import = also_import
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for name in self._also_import:
+                importlib.import_module(name)
+            self._module = module
+        return getattr(self._module, attribute)
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+
+# --- heavy libraries: imported on first use --- 
+metno = LazyModule('metno_locationforecast')
+requests = LazyModule('requests', 'requests.adapters')
+urllib3_retry = LazyModule('urllib3.util.retry')
+gpd = LazyModule('geopandas')
+rasterio = LazyModule('rasterio', 'rasterio.io', 'rasterio.features', 'rasterio.transform', 'rasterio.windows')
+xr = LazyModule('xarray', 'rioxarray')
+mpl = LazyModule('matplotlib', 'matplotlib.colors')
+plt = LazyModule('matplotlib.pyplot')
+sns = LazyModule('seaborn')
+cx = LazyModule('contextily')
+azure_blob = LazyModule('azure.storage.blob')
+azure_core = LazyModule('azure.core', 'azure.core.exceptions')
+pq = LazyModule('pyarrow.parquet')
+gpd_arrow = LazyModule('geopandas.io.arrow')
 
 
 def unzip_shapefiles(dirname):
     """
     Extract contents of the ".zip"-files to get all the information to load shapefiles
     ----
-    function will only unzip if needed 
+    function will only unzip if needed: the extracted folder is missing, or the archive changed since it was extracted 
+    (the MD5 of the extracted archive is kept next to it, in "<archive>.zip.extracted")
     """
     zipfiles = [os.path.join(dirname, file) for file in os.listdir(dirname) if file.endswith('.zip')]    
     for zipped in zipfiles: 
         extracted = os.path.splitext(zipped)[0]
-        if not os.path.exists(extracted):
-            with zipfile.ZipFile(zipped, 'r') as archive:
-                archive.extractall(extracted)
+        marker = zipped + '.extracted'
+        archive_md5 = file_md5(zipped).hex()
+        if os.path.exists(extracted) and os.path.exists(marker):
+            with open(marker, 'r') as f:
+                if f.read().strip() == archive_md5:
+                    continue
+        with zipfile.ZipFile(zipped, 'r') as archive:
+            archive.extractall(extracted)
+        with open(marker, 'w') as f:
+            f.write(archive_md5)
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces out requests to stay below a global ceiling of requests per second. 
+    ----
+    requests_per_second = None (or 0) disables the limit 
+    """
+    def __init__(self, requests_per_second=None):
+        self.interval = 1. / requests_per_second if requests_per_second else 0.
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        # --- reserve the next free slot, then sleep outside of the lock --- 
+        with self._lock:
+            slot = max(time.monotonic(), self._next_slot)
+            self._next_slot = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def create_http_session(max_workers=1):
+    """
+    single (pooled) HTTP session shared by all requests to the API 
+    ----
+    keeps connections to api.met.no alive between grid points and retries when being throttled (HTTP 429) 
+    """
+    retries = urllib3_retry.Retry(total=3, 
+                    backoff_factor=0.5, 
+                    status_forcelist=[429, 500, 502, 503, 504])
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, 
+                          pool_maxsize=max(1, max_workers), 
+                          max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class FetchCounts:
+    """
+    how the grid points of one run were served: 
+    - hit: forecast not expired yet, served from disk without any request 
+    - revalidated: forecast expired, but the API answered "304 Not Modified" to "If-Modified-Since" 
+    - miss: (new) forecast downloaded in full 
+    and the bytes downloaded (bodies of the responses) 
+    ----
+    Kept per run, not per ForecastCache: the countries of a batch share a cache while fetching side by side. 
+    """
+    def __init__(self):
+        self.counts = {'hit': 0, 'revalidated': 0, 'miss': 0, 'bytes_downloaded': 0}
+        self._lock = threading.Lock()
+
+    def record(self, status, nbytes=0):
+        with self._lock:
+            self.counts[status] += 1
+            self.counts['bytes_downloaded'] += nbytes
+
+    def summary(self):
+        return (f"forecast cache: {self.counts['hit']} hits, "
+                f"{self.counts['revalidated']} revalidated, "
+                f"{self.counts['miss']} misses")
+
+
+class ForecastCache:
+    """
+    Persistent store of the downloaded forecasts: one JSON file per grid point (as written by metno_locationforecast), 
+    including the "Expires" and "Last-Modified" headers returned by met.no. 
+    ----
+    max_age_hours: remove files that have not been used for this long 
+    max_size_mb: remove the least recently used files until the cache fits 
+
+    earliest_expiry: first moment (naive UTC, as metno_locationforecast) one of the served forecasts expires, 
+    i.e. when met.no may have new data 
+    """
+    def __init__(self, cache_dir, max_age_hours=None, max_size_mb=None):
+        self.cache_dir = cache_dir
+        self.max_age_hours = max_age_hours
+        self.max_size_mb = max_size_mb
+        self._lock = threading.Lock()
+        self.start_run()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def start_run(self):
+        """
+        reset the earliest expiry (e.g. between the cycles of forecast_daemon.py)
+        """
+        self.earliest_expiry = None
+
+    def path(self, forecast):
+        return os.path.join(self.cache_dir, forecast.file_name)
+
+    def save(self, forecast):
+        # write next to the final file first: runs sharing the cache never read a half-written forecast 
+        filename = self.path(forecast)
+        partial_file = f"{filename}.{os.getpid()}-{threading.get_ident()}.part"
+        with open(partial_file, 'w') as f:
+            f.write(forecast.json_string)
+        os.replace(partial_file, filename)
+
+    def record_expiry(self, forecast):
+        with self._lock:
+            if self.earliest_expiry is None or forecast.data.expires < self.earliest_expiry:
+                self.earliest_expiry = forecast.data.expires
+
+    def evict(self):
+        """
+        apply the age and size limits. Returns the number of files removed 
+        """
+        files = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.json')]
+        files = sorted(((os.stat(f), f) for f in files), key=lambda file: file[0].st_mtime)
+        removed = []
+        if self.max_age_hours is not None:
+            oldest_allowed = time.time() - self.max_age_hours * 3600
+            removed += [f for stat, f in files if stat.st_mtime < oldest_allowed]
+        if self.max_size_mb is not None:
+            size = sum(stat.st_size for stat, f in files if f not in removed)
+            for stat, f in files:
+                if size <= self.max_size_mb * 1024**2:
+                    break
+                if f not in removed:
+                    removed.append(f)
+                    size -= stat.st_size
+        for f in removed:
+            os.remove(f)
+        return len(removed)
+
+
+class ForecastArrays:
+    """
+    lean stand-in for the `data` of a metno Forecast(): only the configured variables, as arrays, 
+    instead of an Interval() with Variable() objects per timestep 
+    ----
+    last_modified, expires: from the response headers (naive UTC, as metno_locationforecast)
+    start_time: start of every interval (datetime64[s])
+    hours: length of every interval: the shortest window available (1, 6 or 12; 0 = none), as in metno_locationforecast 
+    values: {variable: float32 array}, NaN for the intervals without the variable
+    """
+    HTTP_DATETIME_FORMAT = "%a, %d %b %Y %H:%M:%S %Z"
+
+    def __init__(self, last_modified, expires, start_time, hours, values):
+        self.last_modified = last_modified
+        self.expires = expires
+        self.start_time = start_time
+        self.hours = hours
+        self.values = values
+
+    @classmethod
+    def from_json(cls, forecast_json, variables=('precipitation_amount',)):
+        """
+        pull the variables out of the stored response (status_code, headers and data, as metno_locationforecast stores it)
+        """
+        headers = forecast_json["headers"]
+        timeseries = forecast_json["data"]["properties"]["timeseries"]
+        times = []
+        hours = np.zeros(len(timeseries), dtype=np.uint8)
+        values = {variable: np.full(len(timeseries), np.nan, dtype=np.float32) for variable in variables}
+        for step, entry in enumerate(timeseries):
+            times.append(entry["time"].rstrip("Z"))
+            data = entry["data"]
+            details = data["instant"]["details"]
+            # --- the shortest window available: its variables take precedence over the instant ones --- 
+            for window, window_hours in (("next_1_hours", 1), ("next_6_hours", 6), ("next_12_hours", 12)):
+                if window in data:
+                    hours[step] = window_hours
+                    details = {**details, **data[window]["details"]}
+                    break
+            for variable, column in values.items():
+                if variable in details:
+                    column[step] = details[variable]
+        return cls(last_modified=datetime.datetime.strptime(headers["Last-Modified"], cls.HTTP_DATETIME_FORMAT),
+                   expires=datetime.datetime.strptime(headers["Expires"], cls.HTTP_DATETIME_FORMAT),
+                   start_time=np.array(times, dtype='datetime64[s]'),
+                   hours=hours,
+                   values=values)
+
+
+def fetch_forecast(session, place, USER_AGENT, cache, rate_limiter, base_url=None, progress=None, forecast_type="complete", counts=None, 
+                   variables=('precipitation_amount',)):
+    """
+    equivalent of Forecast.update(), but sending the request through a shared session 
+    ----
+    the forecast in the cache is re-used as long as it has not expired, 
+    after that the API is asked for new data using "If-Modified-Since"
+    progress: FetchProgress of the run (points it already served are re-used from the cache, expired or not)
+    forecast_type: "complete" or "compact" (same precipitation, without percentiles: a smaller response)
+    counts: FetchCounts of the run (how the point was served)
+    variables: the variables read from the response (see ForecastArrays)
+
+    The response is parsed into ForecastArrays (`forecast.data`), not into metno_locationforecast's objects. 
+    """
+    counts = counts or FetchCounts()
+    forecast = metno.Forecast(place=place,
+                        user_agent=USER_AGENT,
+                        forecast_type = forecast_type,
+                        save_location= cache.cache_dir,
+                        base_url=base_url
+                        )
+    
+    # --- use the earlier download if still valid --- 
+    cached_file = cache.path(forecast)
+    if os.path.exists(cached_file):
+        with open(cached_file) as f:
+            forecast.json_string = f.read()
+        forecast.json = json.loads(forecast.json_string)
+        forecast.data = ForecastArrays.from_json(forecast.json, variables)
+        if (progress is not None and forecast.file_name in progress) or not forecast._data_outdated():
+            os.utime(cached_file)  # mark as recently used (for eviction)
+            counts.record('hit')
+            cache.record_expiry(forecast)
+            if progress is not None:
+                progress.add(forecast.file_name)
+            return forecast
+
+    # --- retrieve latest available forecast from API --- 
+    rate_limiter.wait()
+    forecast.response = session.get(forecast.url, 
+                                    params=forecast.url_parameters, 
+                                    headers=forecast.url_headers, 
+                                    timeout=30)
+    if forecast.response.status_code == 304:
+        # --- nothing new: keep the data, only refresh the headers (new "Expires") --- 
+        forecast.json['headers'].update(forecast.response.headers)
+        forecast.json_string = json.dumps(forecast.json)
+        counts.record('revalidated')
+    else:
+        forecast.response.raise_for_status()
+        # --- let metno_locationforecast store the response (as Forecast.update() does) --- 
+        forecast._json_from_response()
+        counts.record('miss', len(forecast.response.content))
+    cache.save(forecast)
+    forecast.data = ForecastArrays.from_json(forecast.json, variables)
+    cache.record_expiry(forecast)
+    if progress is not None:
+        progress.add(forecast.file_name)
+    return forecast
+
+
+class FetchProgress:
+    """
+    partial-progress record of the API requests of a run: the cache file of every grid point served so far, one per line 
+    ----
+    filename: the record (appended to while the points come in)
+    resume: continue the record of an earlier (failed) attempt of the run, instead of starting a new one
+
+    A resumed run takes the points in the record from the forecast cache without asking the API at all 
+    (not even whether they expired): only the missing points are requested. 
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.done = set()
+        if resume and os.path.exists(filename):
+            with open(filename) as f:
+                self.done = set(line.strip() for line in f if line.strip())
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self._file = open(filename, 'a' if resume else 'w')
+        self._lock = threading.Lock()
+
+    def __contains__(self, file_name):
+        return file_name in self.done
+
+    def __len__(self):
+        return len(self.done)
 
+    def add(self, file_name):
+        with self._lock:
+            if file_name not in self.done:
+                self.done.add(file_name)
+                self._file.write(file_name + "\n")
+                self._file.flush()
 
-def API_requests_at_gridpoints(filename_gridpoints, save_to_file, destination_dir, USER_AGENT):
+    def close(self):
+        self._file.close()
+
+
+class ForecastStore:
+    """
+    Compact, columnar store of the forecasts at the grid points (the long format, one entry per point per interval): 
+    - rain_in_mm: float32 
+    - time_of_prediction: datetime64 (start of the interval) 
+    - predicted_hrs_ahead: small int (length of the interval in hours: 1, 6 or 12) 
+    - point_idx: integer index into `points` 
+    ----
+    The locations (latitude, longtitude, geometry) are kept once per grid point in `points` (as returned by read_grid()).
+    Use to_geodataframe() to get the long-format GeoDataFrame with one row per point per interval. 
+    """
+    # met.no reports precipitation in steps of 0.1 mm: used to undo float32 noise (0.30000001) when converting back
+    rain_decimals = 1
+
+    def __init__(self, points, point_idx, time_of_prediction, predicted_hrs_ahead, rain_in_mm):
+        self.points = points.reset_index(drop=True)
+        self.point_idx = np.asarray(point_idx, dtype=np.int32)
+        self.time_of_prediction = np.asarray(time_of_prediction, dtype='datetime64[s]')
+        self.predicted_hrs_ahead = np.asarray(predicted_hrs_ahead, dtype=np.uint8)
+        self.rain_in_mm = np.asarray(rain_in_mm, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.point_idx)
+
+    @classmethod
+    def from_forecasts(cls, points, forecasts, cell_of_point=None, variable='precipitation_amount'):
+        """
+        fill the store straight from the fetched forecasts (with their ForecastArrays as `data`)
+        ----
+        forecasts: one per forecast cell (see forecast_cells()), in the order of the cells
+        cell_of_point: cell of every point in `points` (default: one cell per point, in the same order)
+        variable: the variable stored as rain_in_mm (only the intervals that have it are kept)
+        """
+        cells = []
+        for forecast in forecasts:
+            data = forecast.data
+            rain_in_mm = data.values[variable]
+            keep = ~np.isnan(rain_in_mm)
+            cells.append((data.start_time[keep], data.hours[keep], rain_in_mm[keep]))
+        if cell_of_point is None:
+            cell_of_point = np.arange(len(cells))
+
+        if not len(cell_of_point):
+            return cls(points, [], [], [], [])
+        # --- fan the forecast of every cell out to its points (rows stay in the order of the points) --- 
+        lengths = np.array([len(cell[0]) for cell in cells])[cell_of_point]
+        point_idx = np.repeat(np.arange(len(cell_of_point), dtype=np.int32), lengths)
+        return cls(points, point_idx, *[np.concatenate([cells[cell][column] for cell in cell_of_point]) 
+                                        for column in range(3)])
+
+    @classmethod
+    def from_geodataframe(cls, rainfall_gdf):
+        """
+        build the store from the long-format GeoDataFrame (e.g. the raw output file of an earlier run)
+        """
+        locations = rainfall_gdf[['latitude', 'longtitude']]
+        points = rainfall_gdf.loc[~locations.duplicated(), ['latitude', 'longtitude', 'geometry']]
+        point_idx = pd.MultiIndex.from_frame(points[['latitude', 'longtitude']]).get_indexer(
+            pd.MultiIndex.from_frame(locations))
+        return cls(points, 
+                   point_idx, 
+                   pd.to_datetime(rainfall_gdf['time_of_prediction']).to_numpy(), 
+                   rainfall_gdf['predicted_hrs_ahead'].to_numpy(), 
+                   rainfall_gdf['rain_in_mm'].to_numpy())
+
+    def point_digests(self):
+        """
+        fingerprint (MD5) of the forecast at every grid point: compare with those of an earlier store 
+        to find the points that received new data 
+        """
+        order = np.argsort(self.point_idx, kind='stable')
+        bounds = np.searchsorted(self.point_idx[order], np.arange(len(self.points) + 1))
+        columns = [self.time_of_prediction[order], self.predicted_hrs_ahead[order], self.rain_in_mm[order]]
+        return np.array([hashlib.md5(b"".join(column[start:stop].tobytes() for column in columns)).hexdigest()
+                         for start, stop in zip(bounds[:-1], bounds[1:])])
+
+    def to_geodataframe(self):
+        """
+        long-format GeoDataFrame as produced by API_requests_at_gridpoints()
+        """
+        rainfall_gdf = gpd.GeoDataFrame(dict(self._columns(), 
+                                             geometry=self.points.geometry.values.take(self.point_idx)), 
+                                        crs=self.points.crs)
+        return rainfall_gdf
+
+    def to_dataframe(self):
+        # the long format without the geometry (much less memory)
+        return pd.DataFrame(self._columns())
+
+    def _columns(self):
+        return {'rain_in_mm': self.rain_in_mm.astype(np.float64).round(self.rain_decimals),
+                'time_of_prediction': self.time_of_prediction.astype('datetime64[ns]'),
+                'predicted_hrs_ahead': self.predicted_hrs_ahead.astype(np.float64),
+                'latitude': self.points['latitude'].to_numpy()[self.point_idx],
+                'longtitude': self.points['longtitude'].to_numpy()[self.point_idx]}
+
+    def chunks(self, chunk_points):
+        """
+        the store in parts of (at most) chunk_points grid points, in the order of the points 
+        (the rows of a point keep their order). The parts share `points` with the whole store 
+        """
+        if len(self.point_idx) and np.all(np.diff(self.point_idx) >= 0):
+            order = None  # already by point (as filled by from_forecasts()): parts are slices
+            sorted_idx = self.point_idx
+        else:
+            order = np.argsort(self.point_idx, kind='stable')
+            sorted_idx = self.point_idx[order]
+        for start in range(0, len(self.points), max(1, chunk_points)):
+            first, last = np.searchsorted(sorted_idx, [start, start + max(1, chunk_points)])
+            rows = slice(first, last) if order is None else order[first:last]
+            part = ForecastStore.__new__(ForecastStore)
+            part.points = self.points
+            part.point_idx = self.point_idx[rows]
+            part.time_of_prediction = self.time_of_prediction[rows]
+            part.predicted_hrs_ahead = self.predicted_hrs_ahead[rows]
+            part.rain_in_mm = self.rain_in_mm[rows]
+            yield part
+
+
+def forecast_cells(grid, decimals=4):
+    """
+    group the grid points by the forecast met.no returns for them: the API takes the coordinates to 4 decimals 
+    (as metno_locationforecast's Place() rounds them), points that round to the same coordinates get the same forecast
+    ----
+    return the coordinates of every cell (latitude, longtitude; in the order they first appear in the grid) 
+    and the cell of every grid point
+    """
+    # --- Python's round(), as Place(): the cells match the files in the forecast cache --- 
+    latitudes = [round(latitude, decimals) for latitude in grid['latitude'].to_numpy(dtype=np.float64)]
+    longtitudes = [round(longtitude, decimals) for longtitude in grid['longtitude'].to_numpy(dtype=np.float64)]
+    cell_of_point, cells = pd.MultiIndex.from_arrays([latitudes, longtitudes]).factorize()
+    return cells.to_frame(index=False, name=['latitude', 'longtitude']), cell_of_point
+
+
+def API_requests_to_forecast_store(filename_gridpoints, destination_dir, USER_AGENT, 
+                                   max_workers=1, requests_per_second=None, base_url=None, cache=None, 
+                                   session=None, rate_limiter=None, progress=None, chunk_points=None, 
+                                   forecast_type="complete", counts=None, evict=True, variables=('precipitation_amount',)):
+    """
+    use metno weather API to get rainfal predictions at specified set of points
+    ----
+    destination_dir: where to store the downloaded forecasts (used as a ForecastCache, unless `cache` is given)
+    max_workers: number of grid points requested concurrently (1 = one after the other)
+    requests_per_second: global ceiling on the number of API calls (None = no limit). met.no asks to stay below 20/s 
+    base_url: alternative LocationForecast URL (e.g. the local stand-in from "metno_stub_server.py")
+    session, rate_limiter: shared with other runs in the same process (default: created for this call)
+    progress: FetchProgress recording the points served (see fetch_forecast())
+    chunk_points: request the points in parts of this many (bounds the parsed forecasts held in memory; None: all at once)
+    forecast_type: LocationForecast product to request, "complete" or "compact" (see fetch_forecast())
+    counts: FetchCounts to record how the points were served in (default: printed only)
+    evict: apply the limits of the cache afterwards (not while other runs are still fetching from the same cache)
+    variables: the variables parsed from the responses; the first one is stored as the rainfall (rain_in_mm)
+
+    Only one request is made per forecast cell (see forecast_cells()): points closer together than the 
+    API's precision share the forecast of their cell.
+    
+    return a ForecastStore
+    """
+    grid = read_grid(filename_gridpoints)
+    cells, cell_of_point = forecast_cells(grid)
+    if len(cells) < len(grid):
+        print(f"{len(grid)} grid points in {len(cells)} forecast cells")
+
+    # --- create Place() objects (one per cell) --- 
+    points = [metno.Place(f"cell_{idx}", row.latitude, row.longtitude) for idx, row in enumerate(cells.itertuples())]
+
+    # --- retrieve forecasts (concurrently) through one pooled session --- 
+    if cache is None:
+        cache = ForecastCache(destination_dir)
+    own_session = session is None
+    if own_session:
+        session = create_http_session(max_workers)
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(requests_per_second)
+    chunk_points = max(1, chunk_points or len(points))
+    counts = counts or FetchCounts()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        def forecasts():
+            # the next part is only requested once the forecasts of the previous one are in the store 
+            for start in range(0, len(points), chunk_points):
+                yield from pool.map(lambda point: fetch_forecast(session, point, USER_AGENT, cache, rate_limiter, base_url, progress, forecast_type, counts, variables), 
+                                    points[start:start + chunk_points])
+
+        # --- results come back in the order of the cells --- 
+        forecast_store = ForecastStore.from_forecasts(grid, tqdm(forecasts(), total=len(points)), cell_of_point, variable=variables[0])
+    if own_session:
+        session.close()
+    print(counts.summary())
+    if evict:
+        cache.evict()
+    return forecast_store
+
+
+def API_requests_at_gridpoints(filename_gridpoints, save_to_file, destination_dir, USER_AGENT, **kwargs):
     """
     use metno weather API to get rainfal predictions at specified set of points
+    (see API_requests_to_forecast_store() for the options)
     
     return a GeoDataFrame
     (save this to file)
     """
-    grid = read_grid(filename_gridpoints)
-    lat = []
-    long = []
-    geometries = []
-    rain_in_mm = []
-    time_of_prediction = []
-    predicted_hrs_ahead = [] 
-
-    for idx,row in tqdm(grid.iterrows()): 
-
-        # --- create Place() object --- 
-        name = f"point_{idx}"
-        point = Place(name,row["latitude"], row["longtitude"])
-
-        # --- create Forecast() object ---- 
-        forecast = Forecast(place=point,
-                           user_agent=USER_AGENT,
-                           forecast_type = "complete",
-                           save_location= destination_dir
-                          )
-
-        # --- retrieve latest available forecast from API --- 
-        forecast.update()
-
-
-        # --- add data in long format --- 
-        for interval in forecast.data.intervals:
-            if "precipitation_amount" in interval.variables.keys():
-                prediction = interval.variables['precipitation_amount'].value
-                timestamp = interval.start_time
-                duration = interval.duration
-
-                rain_in_mm.append(prediction)
-                time_of_prediction.append(timestamp)
-                predicted_hrs_ahead.append(duration.seconds / 3600.)
-                lat.append(row["latitude"])
-                long.append(row["longtitude"])
-                geometries.append(row["geometry"])
-
-
-    # --- store long-format data as GeoDataFrame --- 
-    rainfall_gdf = gpd.GeoDataFrame()
-    rainfall_gdf['rain_in_mm'] = rain_in_mm
-    rainfall_gdf['time_of_prediction'] = time_of_prediction
-    rainfall_gdf['predicted_hrs_ahead'] = predicted_hrs_ahead
-    rainfall_gdf['latitude'] = lat
-    rainfall_gdf['longtitude'] = long
-    rainfall_gdf['geometry'] = geometries
+    rainfall_gdf = API_requests_to_forecast_store(filename_gridpoints, destination_dir, USER_AGENT, **kwargs).to_geodataframe()
     
     if save_to_file is not None:
-        rainfall_gdf.to_file(save_to_file , driver='GeoJSON')
+        write_raw_forecast(rainfall_gdf, save_to_file)
+    return rainfall_gdf
+
+
+def write_raw_forecast(rainfall_gdf, save_to_file, storage=None):
+    """
+    store the long-format table of predictions. The format follows the file extension: 
+    - ".parquet": GeoParquet (columnar and compressed: much smaller and faster to write/reload)
+    - anything else: GeoJSON 
+    ----
+    storage: output storage save_to_file is written to (default: local file system)
+    """
+    storage = storage or LocalStorage()
+    buffer = io.BytesIO()
+    if os.path.splitext(save_to_file)[1].lower() == '.parquet':
+        rainfall_gdf.to_parquet(buffer, index=False)
+    else:
+        # the layer name is what a file would be named after 
+        rainfall_gdf.to_file(buffer, 
+                             driver='GeoJSON', 
+                             layer=os.path.splitext(os.path.basename(save_to_file))[0])
+    storage.write_bytes(save_to_file, buffer.getvalue())
+
+
+def write_raw_forecast_in_chunks(rainfall_gdfs, save_to_file, storage=None, bbox=None, temp_dir='./temp'):
+    """
+    same as write_raw_forecast(), for a table that comes in parts (GeoDataFrames with the same columns): 
+    the parts are written one by one into a temporary file, so only one of them is in memory at a time
+    ----
+    bbox: bounds of all geometries, for the GeoParquet metadata (written with the first part)
+    """
+    storage = storage or LocalStorage()
+    os.makedirs(temp_dir, exist_ok=True)
+    temp_file = os.path.join(temp_dir, f"{os.getpid()}-{threading.get_ident()}-{os.path.basename(save_to_file)}")
+    try:
+        if os.path.splitext(save_to_file)[1].lower() == '.parquet':
+            writer = None
+            try:
+                for rainfall_gdf in rainfall_gdfs:
+                    table = gpd_arrow._geopandas_to_arrow(rainfall_gdf, index=False)
+                    if writer is None:
+                        metadata = dict(table.schema.metadata)
+                        if bbox is not None:
+                            geo = json.loads(metadata[b'geo'])
+                            geo['columns'][geo['primary_column']]['bbox'] = [float(value) for value in bbox]
+                            metadata[b'geo'] = json.dumps(geo).encode()
+                        writer = pq.ParquetWriter(temp_file, table.schema.with_metadata(metadata), compression='snappy')
+                    writer.write_table(table.replace_schema_metadata(writer.schema.metadata))
+            finally:
+                if writer is not None:
+                    writer.close()
+        else:
+            # GDAL appends the features of every part to the same FeatureCollection 
+            for part, rainfall_gdf in enumerate(rainfall_gdfs):
+                rainfall_gdf.to_file(temp_file, 
+                                     driver='GeoJSON', 
+                                     layer=os.path.splitext(os.path.basename(save_to_file))[0], 
+                                     mode='a' if part else 'w')
+        storage.write_file(save_to_file, temp_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def read_raw_forecast(filename):
+    """
+    reload the long-format table written by write_raw_forecast() (GeoParquet or GeoJSON)
+    """
+    if os.path.splitext(filename)[1].lower() == '.parquet':
+        rainfall_gdf = gpd.read_parquet(filename)
+    else:
+        rainfall_gdf = gpd.read_file(filename)
+    rainfall_gdf['time_of_prediction'] = pd.to_datetime(rainfall_gdf['time_of_prediction'])
     return rainfall_gdf
 
 
+def read_raw_forecast_store(filename, chunk_rows=None):
+    """
+    reload the table written by write_raw_forecast() straight into a ForecastStore
+    ----
+    chunk_rows: read a GeoParquet file in parts of this many rows, without the geometries 
+                (the points get theirs back from their coordinates, as in read_grid()). GeoJSON is read at once
+    """
+    if chunk_rows is None or os.path.splitext(filename)[1].lower() != '.parquet':
+        return ForecastStore.from_geodataframe(read_raw_forecast(filename))
+
+    parquet_file = pq.ParquetFile(filename)
+    geo = json.loads(parquet_file.schema_arrow.metadata[b'geo'])
+    columns = {key: [] for key in ['latitude', 'longtitude', 'time_of_prediction', 'predicted_hrs_ahead', 'rain_in_mm']}
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=list(columns)):
+        part = batch.to_pandas()
+        columns['latitude'].append(part['latitude'].to_numpy(dtype=np.float64))
+        columns['longtitude'].append(part['longtitude'].to_numpy(dtype=np.float64))
+        columns['time_of_prediction'].append(pd.to_datetime(part['time_of_prediction']).to_numpy().astype('datetime64[s]'))
+        columns['predicted_hrs_ahead'].append(part['predicted_hrs_ahead'].to_numpy().astype(np.uint8))
+        columns['rain_in_mm'].append(part['rain_in_mm'].to_numpy().astype(np.float32))
+    columns = {key: np.concatenate(parts) for key, parts in columns.items()}
+
+    # --- grid points in the order they first appear (as ForecastStore.from_geodataframe()) ---
+    point_idx, locations = pd.MultiIndex.from_arrays([columns['latitude'], columns['longtitude']]).factorize()
+    latitudes, longtitudes = locations.get_level_values(0).to_numpy(), locations.get_level_values(1).to_numpy()
+    points = gpd.GeoDataFrame({'latitude': latitudes, 'longtitude': longtitudes},
+                              geometry=gpd.points_from_xy(x=longtitudes, y=latitudes),
+                              crs=geo['columns'][geo['primary_column']].get('crs', 'OGC:CRS84'))
+    return ForecastStore(points, point_idx, columns['time_of_prediction'], columns['predicted_hrs_ahead'], columns['rain_in_mm'])
+
+
+def points_per_chunk(memory_budget_mb, bytes_per_point):
+    """
+    number of grid points to process at once to stay within the memory budget (None: no budget, all at once)
+    """
+    if not memory_budget_mb:
+        return None
+    return max(1, int(memory_budget_mb * 1024**2 // max(1, bytes_per_point)))
+
+
 def read_grid(dirname):
     """
     read in the grid and prep the table by dropping unnecessary columns etc. 
@@ -119,178 +709,804 @@ def read_grid(dirname):
     return grid 
 
 
-def gdf_to_rasterfile(rainfall_gdf, key_values='rain_in_mm', key_index='time_of_prediction',save_to_file = None):
+class GridIndex:
+    """
+    Position of the grid points in the raster, computed once from the points file (see read_grid()): 
+    - x / y: coordinates of the raster's columns / rows (north-up: the first row is the northernmost)
+    - transform: affine transform of the raster 
+    - crs: coordinate reference system of the points 
+    ----
+    Use to_cube() to scatter long-format values straight into a (time, y, x) array 
+    (or fill an empty_cube() part by part and wrap it with to_dataarray()). 
+    """
+    # coordinates in the points file are rounded to this many decimals (removes float noise from GIS exports)
+    decimals = 6
+
+    def __init__(self, points):
+        longtitudes = np.round(points['longtitude'].to_numpy(dtype=np.float64), self.decimals)
+        latitudes = np.round(points['latitude'].to_numpy(dtype=np.float64), self.decimals)
+        unique_x = np.unique(longtitudes)
+        unique_y = np.unique(latitudes)
+        self.res_x = np.diff(unique_x).min() if len(unique_x) > 1 else 1.
+        self.res_y = np.diff(unique_y).min() if len(unique_y) > 1 else 1.
+        self.west = unique_x[0]
+        self.north = unique_y[-1]
+
+        # --- regular grid from west to east and from north to south (also covers gaps in the points) --- 
+        self.width = int(np.rint((unique_x[-1] - self.west) / self.res_x)) + 1
+        self.height = int(np.rint((self.north - unique_y[0]) / self.res_y)) + 1
+        self.x = np.round(self.west + self.res_x * np.arange(self.width), self.decimals)
+        self.y = np.round(self.north - self.res_y * np.arange(self.height), self.decimals)
+        self.transform = rasterio.transform.from_origin(self.west - self.res_x / 2, 
+                                                        self.north + self.res_y / 2, 
+                                                        self.res_x, 
+                                                        self.res_y)
+        self.crs = points.crs if getattr(points, 'crs', None) is not None else "EPSG:4326"
+        self.row, self.col = self.locate(latitudes, longtitudes)
+
+    def locate(self, latitude, longtitude):
+        """
+        (row, col) in the raster of the given coordinates 
+        """
+        row = np.rint((self.north - np.asarray(latitude, dtype=np.float64)) / self.res_y).astype(np.intp)
+        col = np.rint((np.asarray(longtitude, dtype=np.float64) - self.west) / self.res_x).astype(np.intp)
+        return row, col
+
+    def to_cube(self, row, col, index_values, values, index_name='time_of_prediction', name=None):
+        """
+        scatter values into a preallocated (index, y, x) DataArray that carries the CRS and transform of the grid
+        (cells without a value are NaN)
+        """
+        labels, label_idx = np.unique(np.asarray(index_values), return_inverse=True)
+        values = np.asarray(values)
+        cube = self.empty_cube(len(labels), dtype=np.result_type(values.dtype, np.float32))
+        cube[label_idx, row, col] = values
+        return self.to_dataarray(cube, labels, index_name=index_name, name=name)
+
+    def empty_cube(self, n_labels, dtype=np.float64):
+        # (index, y, x) array of NaN
+        return np.full((n_labels, self.height, self.width), np.nan, dtype=dtype)
+
+    def to_dataarray(self, cube, labels, index_name='time_of_prediction', name=None):
+        """
+        wrap an (index, y, x) array into a DataArray that carries the CRS and transform of the grid
+        """
+        rainfall_array = xr.DataArray(cube, 
+                                      coords={index_name: labels, 'y': self.y, 'x': self.x},
+                                      dims=(index_name, 'y', 'x'), 
+                                      name=name)
+        rainfall_array.rio.write_crs(self.crs, inplace=True)
+        rainfall_array.rio.write_transform(self.transform, inplace=True)
+        return rainfall_array
+
+
+def changed_bands(previous_array, rainfall_array):
+    """
+    compare two (band, y, x) DataArrays on the same grid, band by band (bands are matched on their coordinate) 
+    ----
+    returns 
+    - changed: per band of rainfall_array, whether any of its pixels differs from previous_array (bands missing in previous_array: True)
+    - changed_pixels: (band, pixel) array telling which pixels differ
+    """
+    index_name = rainfall_array.dims[0]
+    values = rainfall_array.values.reshape(rainfall_array.shape[0], -1)
+    changed_pixels = np.ones(values.shape, dtype=bool)
+    position = pd.Index(previous_array[previous_array.dims[0]].values).get_indexer(rainfall_array[index_name].values)
+    known = position >= 0
+    if previous_array.shape[1:] == rainfall_array.shape[1:] and known.any():
+        previous_values = previous_array.values.reshape(previous_array.shape[0], -1)[position[known]]
+        changed_pixels[known] = ~((previous_values == values[known]) | (np.isnan(previous_values) & np.isnan(values[known])))
+    return changed_pixels.any(axis=1), changed_pixels
+
+
+def gdf_to_rasterfile(rainfall_gdf, key_values='rain_in_mm', key_index='time_of_prediction',save_to_file = None, grid_index = None, storage = None):
     """
     convert GeoDataFrame to xarray with dimensions and coordinates equal to latitude, longtitude and the time prediction
     
     Produce a geoTIF file with one band per timepoint 
+    ----
+    grid_index: GridIndex of the grid points (computed from the table if not given)
+    storage: output storage save_to_file is written to (default: local file system)
     """
     max_days_ahead = 3
 
-    # --- convert the GeoDataFrame into xarray (to have it as a 3D object with coordinates of lat, long and timepoint) ---- 
-    rainfall_array = rainfall_gdf.rename({'longtitude':'x', 'latitude':'y'}, axis ='columns')
+    index_values = rainfall_gdf[key_index].to_numpy()
     if 'predicted_hrs_ahead' in rainfall_gdf.columns:
-        rainfall_array['time_of_prediction'] = pd.to_datetime(rainfall_array['time_of_prediction'])
-        first_forecast_hour = rainfall_array['time_of_prediction'][0]
+        index_values = pd.to_datetime(rainfall_gdf['time_of_prediction']).to_numpy()
+        first_forecast_hour = index_values[0]
         last_forecast_hour = first_forecast_hour + pd.Timedelta(days= max_days_ahead)
-        forecast_hour_range = {
-            first_forecast_hour,
-            last_forecast_hour
-        }
-        # rainfall_array = rainfall_array[rainfall_array['predicted_hrs_ahead'] == 1.]
-        rainfall_array['included'] = np.where(rainfall_array['time_of_prediction'] >= last_forecast_hour, 1, 0)
-        rainfall_array = rainfall_array[rainfall_array['included']==1]
-    rainfall_array.set_index([key_index, 'y','x'], inplace = True)
-    rainfall_array = rainfall_array[key_values].to_xarray()
+        # rainfall_gdf = rainfall_gdf[rainfall_gdf['predicted_hrs_ahead'] == 1.]
+        included = index_values >= last_forecast_hour
+        rainfall_gdf = rainfall_gdf[included]
+        index_values = index_values[included]
+
+    # --- scatter the values straight into a (time, y, x) array (to have it as a 3D object with coordinates of lat, long and timepoint) ---- 
+    if grid_index is None:
+        grid_index = GridIndex(rainfall_gdf.drop_duplicates(['latitude', 'longtitude']))
+    row, col = grid_index.locate(rainfall_gdf['latitude'], rainfall_gdf['longtitude'])
+    rainfall_array = grid_index.to_cube(row, col, 
+                                        index_values, 
+                                        rainfall_gdf[key_values].to_numpy(), 
+                                        index_name=key_index, 
+                                        name=key_values)
     
     if save_to_file is not None:
-        rainfall_array.rio.to_raster(save_to_file)
+        write_raster(rainfall_array, save_to_file, storage)
     
     return rainfall_array
 
 
-def zonal_statistics(rasterfile, shapefile, 
-                    minval=-np.inf,
-                    maxval=+np.inf,
-                    aggregate_by=[np.mean, np.max,np.sum], 
-                    nameKey = None,
-                    pcodeKey = None,
-                    polygonKey = 'geometry',
-                    band = 1
-                    ): 
-    
-    '''
-    Perform zonal statistics on raster data ('.tif') , based on polygons defined in shape file ('.shp')
-    
+def store_to_rasterfile(forecast_store, save_to_file=None, grid_index=None, storage=None, chunk_points=None):
+    """
+    same as gdf_to_rasterfile(forecast_store.to_geodataframe(), ...), but scattering the values straight from the 
+    ForecastStore into the raster, chunk_points grid points at a time (the long table is never built as a whole)
+    """
+    max_days_ahead = 3
+
+    # --- the time steps kept: same selection as gdf_to_rasterfile() (from the first prediction of the table) ---
+    times = forecast_store.time_of_prediction
+    first_kept = times[0] + np.timedelta64(max_days_ahead, 'D') if len(times) else np.datetime64('NaT')
+    labels = np.unique(times[times >= first_kept])
+    if grid_index is None:
+        grid_index = GridIndex(forecast_store.points)
+    cube = grid_index.empty_cube(len(labels), dtype=np.float64)
+    for part in forecast_store.chunks(chunk_points or len(forecast_store.points)):
+        included = part.time_of_prediction >= first_kept
+        point_idx = part.point_idx[included]
+        row, col = grid_index.locate(part.points['latitude'].to_numpy()[point_idx], 
+                                     part.points['longtitude'].to_numpy()[point_idx])
+        cube[np.searchsorted(labels, part.time_of_prediction[included]), row, col] = \
+            part.rain_in_mm[included].astype(np.float64).round(ForecastStore.rain_decimals)
+    rainfall_array = grid_index.to_dataarray(cube, labels.astype('datetime64[ns]'), index_name='time_of_prediction', name='rain_in_mm')
+
+    if save_to_file is not None:
+        write_raster(rainfall_array, save_to_file, storage)
+    return rainfall_array
+
+
+def write_raster(rainfall_array, save_to_file, storage=None):
+    """
+    write a (band, y, x) DataArray as geoTIF into the storage (default: local file system)
+    """
+    storage = storage or LocalStorage()
+    # GDAL writes into memory, the storage takes it from there 
+    with rasterio.io.MemoryFile() as memory_file:
+        rainfall_array.rio.to_raster(memory_file.name, recalc_transform=False)
+        storage.write_bytes(save_to_file, memory_file.read())
+
+
+class ZonalStatistics:
+    """
+    Zonal statistics of a (band, y, x) raster cube over the polygons of a shape file 
+    ----
+    The polygons are rasterized to the grid once (pixels whose centre falls inside a polygon, or every pixel 
+    touched with all_touched=True). compute() then aggregates all bands and all zones at once on the in-memory cube. 
+    Overlapping polygons (e.g. catchments) are supported: a pixel counts for every zone it falls in. 
+
     INPUT:
-    - rasterfile: path to TIFF file 
-    - shapefile : path to .shp file 
-    - aggregate_by: A Python function that returns a single numnber. Will use this to aggregate values per polygon.
-    NOTE: Can also provide a list of functions if multiple metrics are disired.
-    - minval / maxval : Physical boundaries of quantity encoded in TIFF file. Values outside this range are usually reserved to denote special terrain/areas in image
+    - shapefile: path to the shape file (or a GeoDataFrame) 
+    - grid_index: GridIndex describing the raster (shape, transform and CRS) 
     - nameKey / pcodeKey : column names in shape file that contain unique identifiers for every polygon 
     - polygonKey : by default geopandas uses the 'geometry' column to store the polygons 
-    - band: index of band to read (for data with a single band: just keep default of band = 1)
-    
-    
-    OUTPUT:
-    table (DataFrame) with the one-number metric (aggregate) for every zone defined in the provided shape file
-    '''
-    
-    # handle supplying either one or mulitple metrics at once: 
-    if type(aggregate_by) != list:
-        aggregate_by = [aggregate_by]
-    aggregates_of_zones = [[] for i in range(len(aggregate_by))]
+    """
+    # besides these, "q<percentile>" (e.g. "q90") gives the percentile of the values within a zone 
+    statistics = ['mean', 'std', 'max', 'min', 'sum', 'count']
 
+    def __init__(self, shapefile, grid_index, nameKey=None, pcodeKey=None, polygonKey='geometry', all_touched=False):
+        shapeData = gpd.read_file(shapefile) if isinstance(shapefile, str) else shapefile
+        if shapeData.crs is not None and not shapeData.crs.equals(grid_index.crs):
+            shapeData = shapeData.to_crs(grid_index.crs)
+        self.names = shapeData[nameKey].to_numpy() if nameKey else None
+        self.pcodes = shapeData[pcodeKey].to_numpy() if pcodeKey else None
+        self.shape = (grid_index.height, grid_index.width)
+
+        # --- flat pixel indices of every zone, stored zone after zone --- 
+        self._set_zones([self._rasterize(shape, grid_index.transform, all_touched) for shape in shapeData[polygonKey]])
+
+    def _set_zones(self, pixels_of_zones):
+        self.n_zones = len(pixels_of_zones)
+        self.n_pixels = np.array([len(pixels) for pixels in pixels_of_zones], dtype=np.intp)
+        self.pixel_idx = np.concatenate(pixels_of_zones) if pixels_of_zones else np.empty(0, dtype=np.intp)
+        self.offsets = np.concatenate([[0], np.cumsum(self.n_pixels)[:-1]]).astype(np.intp)
+        self.zone_of_pixel = np.repeat(np.arange(self.n_zones), self.n_pixels)
+
+    def _rasterize(self, shape, transform, all_touched):
+        """
+        flat indices of the pixels covered by one polygon (only rasterized within its bounding box)
+        """
+        if shape is None or shape.is_empty:
+            return np.empty(0, dtype=np.intp)
+        window = rasterio.windows.from_bounds(*shape.bounds, transform=transform)
+        window = window.round_offsets(op='floor').round_lengths(op='ceil')
+        row_start, col_start = max(int(window.row_off) - 1, 0), max(int(window.col_off) - 1, 0)
+        row_stop = min(int(window.row_off + window.height) + 1, self.shape[0])
+        col_stop = min(int(window.col_off + window.width) + 1, self.shape[1])
+        if row_stop <= row_start or col_stop <= col_start:
+            return np.empty(0, dtype=np.intp)
+
+        window = rasterio.windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        inside = rasterio.features.geometry_mask([shape], 
+                                                 out_shape=(window.height, window.width), 
+                                                 transform=rasterio.windows.transform(window, transform), 
+                                                 all_touched=all_touched, 
+                                                 invert=True)
+        rows, cols = np.nonzero(inside)
+        return np.ravel_multi_index((rows + row_start, cols + col_start), self.shape)
+
+    def subset(self, zones):
+        """
+        ZonalStatistics of only the given zones (boolean mask or indices), without rasterizing again 
+        """
+        zones = np.flatnonzero(zones) if np.asarray(zones).dtype == bool else np.asarray(zones, dtype=np.intp)
+        sub = object.__new__(ZonalStatistics)
+        sub.names = self.names[zones] if self.names is not None else None
+        sub.pcodes = self.pcodes[zones] if self.pcodes is not None else None
+        sub.shape = self.shape
+        sub._set_zones([self.pixel_idx[start:start + n] for start, n in zip(self.offsets[zones], self.n_pixels[zones])])
+        return sub
+
+    def rollup(self, parent_of_zone, names=None, pcodes=None):
+        """
+        ZonalStatistics of coarser zones made up of these zones (e.g. admin 1 from admin 3), without rasterizing again 
+        ----
+        parent_of_zone: index of the coarser zone every zone belongs to (-1: none), see parent_zones()
+        names / pcodes: of the coarser zones 
+
+        The pixels of a coarser zone are those of its zones (which should not overlap). 
+        Use combine() to derive its statistics from those of its zones. 
+        """
+        parent_of_zone = np.asarray(parent_of_zone, dtype=np.intp)
+        n_parents = len(names) if names is not None else len(pcodes)
+        order = np.argsort(parent_of_zone, kind='stable')
+        bounds = np.searchsorted(parent_of_zone[order], np.arange(n_parents + 1))
+        rolled = object.__new__(ZonalStatistics)
+        rolled.names = np.asarray(names) if names is not None else None
+        rolled.pcodes = np.asarray(pcodes) if pcodes is not None else None
+        rolled.shape = self.shape
+        rolled._set_zones([np.concatenate([np.empty(0, dtype=np.intp)] + 
+                                          [self.pixel_idx[self.offsets[zone]:self.offsets[zone] + self.n_pixels[zone]] 
+                                           for zone in order[start:stop]]) 
+                           for start, stop in zip(bounds[:-1], bounds[1:])])
+        # zones (sorted by coarser zone), where every coarser zone starts, number of zones 
+        rolled.children = (order, bounds, self.n_zones)
+        return rolled
+
+    def combine(self, zone_stats, rainfall_array, aggregate_by=['mean', 'std', 'max', 'min'], minval=-np.inf, maxval=+np.inf):
+        """
+        same table as compute(rainfall_array, ...), for the coarser zones made by rollup(): 
+        mean (weighted by the pixel counts), std (combined variance), sum, count, max and min are combined 
+        from the statistics of the finer zones. Percentiles cannot be combined: they are computed from the pixels 
+        ----
+        zone_stats: compute() table of the finer zones (for the same bands), with at least 'sum', 'count' 
+                    and the other statistics in aggregate_by 
+        """
+        order, bounds, n_children = self.children
+        index_name = rainfall_array.dims[0]
+        n_bands = rainfall_array.shape[0]
+        percentiles = [metric for metric in aggregate_by if self.percentile_of(metric) is not None]
+        result = {metric: np.full((n_bands, self.n_zones), np.nan) for metric in aggregate_by}
+        count = np.zeros((n_bands, self.n_zones), dtype=np.int64)
+
+        # --- (band, finer zone) statistics, the finer zones sorted by coarser zone (those in none left out) --- 
+        def finer(metric):
+            return zone_stats[metric].to_numpy(dtype=np.float64).reshape(n_bands, n_children)[:, order[bounds[0]:bounds[-1]]]
+
+        nonempty = bounds[1:] > bounds[:-1]
+        if nonempty.any():
+            offsets = bounds[:-1][nonempty] - bounds[0]
+            n_finer = (bounds[1:] - bounds[:-1])[nonempty]
+            finer_count = finer('count')
+            finer_sum = np.nan_to_num(finer('sum'))
+            count[:, nonempty] = np.add.reduceat(finer_count, offsets, axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                total = np.add.reduceat(finer_sum, offsets, axis=1)
+                mean = total / count[:, nonempty]
+                if 'std' in aggregate_by:
+                    # --- within-zone variance plus the spread of the zone means around the combined mean --- 
+                    finer_mean = finer_sum / finer_count
+                    deviation = finer_count * (finer('std')**2 + (finer_mean - np.repeat(mean, n_finer, axis=1))**2)
+                    result['std'][:, nonempty] = np.sqrt(np.add.reduceat(np.nan_to_num(deviation), offsets, axis=1) / count[:, nonempty])
+            if 'mean' in aggregate_by:
+                result['mean'][:, nonempty] = mean
+            if 'sum' in aggregate_by:
+                result['sum'][:, nonempty] = total
+            if 'max' in aggregate_by:
+                result['max'][:, nonempty] = np.fmax.reduceat(finer('max'), offsets, axis=1)
+            if 'min' in aggregate_by:
+                result['min'][:, nonempty] = np.fmin.reduceat(finer('min'), offsets, axis=1)
+        if percentiles:
+            values = np.asarray(rainfall_array.values, dtype=np.float64).reshape(n_bands, -1)
+            for metric, percentile_values in zip(percentiles, self._percentiles_per_zone(values, percentiles, minval, maxval)):
+                result[metric] = percentile_values
+
+        # --- zones without any physical value get NaN --- 
+        for metric in aggregate_by:
+            if metric == 'count':
+                result[metric] = count
+            else:
+                result[metric][count == 0] = np.nan
+
+        zonalStats = pd.DataFrame()
+        if self.names is not None:
+            zonalStats['name'] = np.tile(self.names, n_bands)
+        if self.pcodes is not None:
+            zonalStats['pcode'] = np.tile(self.pcodes, n_bands)
+        for metric in aggregate_by:
+            zonalStats[metric] = result[metric].ravel()
+        zonalStats[index_name] = np.repeat(rainfall_array[index_name].values, self.n_zones)
+        return zonalStats
+
+    def update(self, previous_stats, previous_array, rainfall_array, aggregate_by=['mean', 'std', 'max', 'min'], minval=-np.inf, maxval=+np.inf):
+        """
+        same table as compute(rainfall_array, ...), re-using the rows of previous_stats (computed by compute() on previous_array) 
+        for the bands and zones whose pixels did not change. Only the zones with a changed pixel are recomputed, 
+        only for the bands in which something changed (new bands: all zones). 
+
+        returns the table and the number of (band, zone) statistics that were recomputed 
+        """
+        index_name = rainfall_array.dims[0]
+        n_bands = rainfall_array.shape[0]
+        changed, changed_pixels = changed_bands(previous_array, rainfall_array)
+        position = pd.Index(previous_array[previous_array.dims[0]].values).get_indexer(rainfall_array[index_name].values)
+        if len(previous_stats) != previous_array.shape[0] * self.n_zones:
+            # not the statistics of these zones: start over 
+            return self.compute(rainfall_array, aggregate_by, minval, maxval), n_bands * self.n_zones
+
+        # --- zones with a changed pixel, per band --- 
+        changed_zones = np.zeros((n_bands, self.n_zones), dtype=bool)
+        nonempty = self.n_pixels > 0
+        if nonempty.any():
+            changed_zones[:, nonempty] = np.logical_or.reduceat(changed_pixels[:, self.pixel_idx], self.offsets[nonempty], axis=1)
+        changed_zones[position < 0] = True
+        bands = changed_zones.any(axis=1)
+        zones = changed_zones.any(axis=0)
+
+        # --- start from the previous statistics of the same bands ---
+        result = {}
+        for metric in aggregate_by:
+            previous_values = previous_stats[metric].to_numpy().reshape(-1, self.n_zones)
+            result[metric] = np.full((n_bands, self.n_zones), np.nan, dtype=previous_values.dtype)
+            result[metric][position >= 0] = previous_values[position[position >= 0]]
+
+        # --- recompute the changed (bands x zones) --- 
+        if bands.any() and zones.any():
+            recomputed = self.subset(zones).compute(rainfall_array[bands], aggregate_by, minval, maxval)
+            for metric in aggregate_by:
+                values = recomputed[metric].to_numpy().reshape(bands.sum(), zones.sum())
+                if values.dtype != result[metric].dtype:
+                    result[metric] = result[metric].astype(np.result_type(result[metric].dtype, values.dtype))
+                result[metric][np.ix_(bands, zones)] = values
+
+        zonalStats = pd.DataFrame()
+        if self.names is not None:
+            zonalStats['name'] = np.tile(self.names, n_bands)
+        if self.pcodes is not None:
+            zonalStats['pcode'] = np.tile(self.pcodes, n_bands)
+        for metric in aggregate_by:
+            zonalStats[metric] = result[metric].ravel()
+        zonalStats[index_name] = np.repeat(rainfall_array[index_name].values, self.n_zones)
+        return zonalStats, int(bands.sum() * zones.sum())
+
+    def compute(self, rainfall_array, aggregate_by=['mean', 'std', 'max', 'min'], minval=-np.inf, maxval=+np.inf):
+        """
+        aggregate every band of the DataArray (band, y, x) per zone 
+        ----
+        - aggregate_by: names of the statistics (see ZonalStatistics.statistics), or "q<percentile>" such as "q90" 
+        - minval / maxval : Physical boundaries of the values. Values outside this range (and NaN) are ignored 
+
+        OUTPUT:
+        long-format table (DataFrame): one row per band per zone with columns name, pcode, <statistics>, <band coordinate>
+        """
+        percentiles = {metric: self.percentile_of(metric) for metric in aggregate_by if self.percentile_of(metric) is not None}
+        unknown = [metric for metric in aggregate_by if metric not in self.statistics and metric not in percentiles]
+        if unknown:
+            raise ValueError(f"unknown statistic(s) {unknown}, choose from {self.statistics} or 'q<percentile>'")
+
+        index_name = rainfall_array.dims[0]
+        n_bands = rainfall_array.shape[0]
+        result = {metric: np.full((n_bands, self.n_zones), np.nan) for metric in aggregate_by}
+        count = np.zeros((n_bands, self.n_zones), dtype=np.int64)
+
+        nonempty = self.n_pixels > 0
+        if nonempty.any():
+            # --- (band, pixel) values of all zones: only physical values are used --- 
+            values = np.asarray(rainfall_array.values, dtype=np.float64).reshape(n_bands, -1)[:, self.pixel_idx]
+            valid = (values >= minval) & (values <= maxval)
+            offsets = self.offsets[nonempty]
+
+            count[:, nonempty] = np.add.reduceat(valid, offsets, axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                total = np.add.reduceat(np.where(valid, values, 0.), offsets, axis=1)
+                mean = total / count[:, nonempty]
+                if 'std' in aggregate_by:
+                    deviation = np.where(valid, values - np.repeat(mean, self.n_pixels[nonempty], axis=1), 0.)
+                    result['std'][:, nonempty] = np.sqrt(np.add.reduceat(deviation**2, offsets, axis=1) / count[:, nonempty])
+            if 'mean' in aggregate_by:
+                result['mean'][:, nonempty] = mean
+            if 'sum' in aggregate_by:
+                result['sum'][:, nonempty] = total
+            if 'max' in aggregate_by:
+                result['max'][:, nonempty] = np.maximum.reduceat(np.where(valid, values, -np.inf), offsets, axis=1)
+            if 'min' in aggregate_by:
+                result['min'][:, nonempty] = np.minimum.reduceat(np.where(valid, values, np.inf), offsets, axis=1)
+            if percentiles:
+                # --- sort the pixels of every zone once, read all requested percentiles from that --- 
+                sorted_values = self._sort_per_zone(np.where(valid, values, np.inf))
+                for metric, percentile in percentiles.items():
+                    result[metric][:, nonempty] = self._percentile(sorted_values, count[:, nonempty], offsets, percentile)
+
+        # --- zones without any physical value get NaN --- 
+        for metric in aggregate_by:
+            if metric == 'count':
+                result[metric] = count
+            else:
+                result[metric][count == 0] = np.nan
         
-    
-    # ---- open the shape file and access info needed --- 
-    shapeData = gpd.read_file(shapefile)
-    shapes = list(shapeData[polygonKey])
-    if nameKey:
-        names = list(shapeData[nameKey])
-    if pcodeKey:
-        pcodes = list(shapeData[pcodeKey])
-        
-    # --- open the raster image data --- 
-    with rasterio.open(rasterfile, 'r') as src:
-        img = src.read(1)
-        
-        # --- for every polygon: mask raster image and calculate value --- 
-        for shape in shapes: 
-            out_image, out_transform = rasterio.mask.mask(src, [shape], crop=True)
-            
-            # --- show the masked image (shows non-zero value within boundaries, zero outside of boundaries shape) ----
-            img = out_image[band-1, :, :]
-
-            # --- Only use physical values  ----
-            data = img[(img >= minval) & (img <= maxval)]
-            
-            #--- determine metric: Must be a one-number metric for every polygon ---
-            for idx, metric in enumerate(aggregate_by):
-                aggregates_of_zones[idx].append( metric(data) )
-    
-    # --- store output --- 
-    zonalStats = pd.DataFrame()
-    if nameKey:
-        zonalStats['name'] = names
-    if pcodeKey:
-        zonalStats['pcode'] = pcodes
-        
-    for idx, metric in enumerate(aggregate_by):
-        zonalStats[f'value_{idx+1}'] = aggregates_of_zones[idx]    
-    return zonalStats
+        # --- store output --- 
+        zonalStats = pd.DataFrame()
+        if self.names is not None:
+            zonalStats['name'] = np.tile(self.names, n_bands)
+        if self.pcodes is not None:
+            zonalStats['pcode'] = np.tile(self.pcodes, n_bands)
+        for metric in aggregate_by:
+            zonalStats[metric] = result[metric].ravel()
+        zonalStats[index_name] = np.repeat(rainfall_array[index_name].values, self.n_zones)
+        return zonalStats
+
+    @staticmethod
+    def percentile_of(metric):
+        """
+        percentile requested by a statistic named "q<percentile>" (None for other statistics)
+        """
+        match = re.fullmatch(r'q(\d+(?:\.\d+)?)', str(metric))
+        if match and 0 <= float(match.group(1)) <= 100:
+            return float(match.group(1))
+        return None
 
+    def _sort_per_zone(self, values):
+        """
+        sort the (band, pixel) values within every zone: first by value, then (stable) by zone 
+        """
+        order = np.argsort(values, axis=1, kind='stable')
+        order = np.take_along_axis(order, np.argsort(self.zone_of_pixel[order], axis=1, kind='stable'), axis=1)
+        return np.take_along_axis(values, order, axis=1)
 
-def daily_aggregates(df, aggregate_by):
+    def _percentiles_per_zone(self, values, percentiles, minval, maxval):
+        """
+        percentiles (names "q<percentile>") per band per zone of the (band, pixel) values, zone by zone: 
+        only the values around the percentiles are put in place (np.partition), no full sort. 
+        Faster than compute() for a few large zones (e.g. coarser zones made by rollup())
+        """
+        n_bands = values.shape[0]
+        result = [np.full((n_bands, self.n_zones), np.nan) for metric in percentiles]
+        bands = np.arange(n_bands)
+        for zone in np.flatnonzero(self.n_pixels > 0):
+            zone_values = values[:, self.pixel_idx[self.offsets[zone]:self.offsets[zone] + self.n_pixels[zone]]]
+            valid = (zone_values >= minval) & (zone_values <= maxval)
+            count = valid.sum(axis=1)
+            positions = [self.percentile_of(metric) / 100. * np.maximum(count - 1, 0) for metric in percentiles]
+            kth = np.unique(np.concatenate([np.concatenate([np.floor(position), np.ceil(position)]) for position in positions])).astype(np.intp)
+            # --- invalid values to the end: the k-th smallest valid values are in place ---
+            ordered = np.partition(np.where(valid, zone_values, np.inf), kth, axis=1)
+            for values_of_metric, position in zip(result, positions):
+                lower = np.floor(position).astype(np.intp)
+                upper = np.ceil(position).astype(np.intp)
+                lower_values = ordered[bands, lower]
+                with np.errstate(invalid='ignore'):
+                    values_of_metric[:, zone] = lower_values + (ordered[bands, upper] - lower_values) * (position - lower)
+        return result
+
+    @staticmethod
+    def _percentile(sorted_values, count, offsets, percentile):
+        """
+        percentile per band per zone from the sorted values (linear interpolation, as np.percentile)
+        """
+        position = percentile / 100. * np.maximum(count - 1, 0)
+        lower = np.floor(position).astype(np.intp)
+        upper = np.ceil(position).astype(np.intp)
+        lower_values = np.take_along_axis(sorted_values, offsets + lower, axis=1)
+        upper_values = np.take_along_axis(sorted_values, offsets + upper, axis=1)
+        with np.errstate(invalid='ignore'):
+            return lower_values + (upper_values - lower_values) * (position - lower)
+
+
+def parent_zones(pcodes, parent_pcodes, parent_keys=None):
+    """
+    the coarser zone (e.g. admin 1) every zone (e.g. admin 3) lies in: index into parent_pcodes, -1 for none 
+    ----
+    parent_keys: pcode of the coarser zone of every zone (e.g. the ADM1_PCODE column of the admin 3 shape file). 
+                 Without them, the coarser zone is the one whose pcode is the longest prefix of the zone's pcode 
+                 (e.g. MW1 > MW104 > MW10401)
+    """
+    position = {str(pcode): idx for idx, pcode in enumerate(parent_pcodes)}
+    if parent_keys is not None:
+        return np.array([position.get(str(key), -1) for key in parent_keys], dtype=np.intp)
+    lengths = sorted(set(len(str(pcode)) for pcode in parent_pcodes), reverse=True)
+    return np.array([next((position[str(pcode)[:length]] for length in lengths if str(pcode)[:length] in position), -1) 
+                     for pcode in pcodes], dtype=np.intp)
+
+
+def daily_aggregates(df, aggregate_by, groupby=[], hours_per_day=24):
     """
     sum up predicted rainfall over 24 hour.
     Will continue to do such for however many days you have retreived a prediction for 
+    ----
+    groupby: columns identifying the series (e.g. ['name'] or ['latitude', 'longtitude']): all series are aggregated at once 
 
+    Every prediction is binned by its lead time (counted from the first prediction of its series) into 24 hour windows, 
+    labeled "hr-24", "hr-48", etc. The length of an interval is taken from 'predicted_hrs_ahead' (1 or 6 hours), 
+    or otherwise from the step to the next prediction. An interval that crosses the end of a day is split over both days 
+    in proportion to the hours that fall in each. 
     """
-    # start by resetting index as an ensurance (to make it work in combination with 'groupby' operation)
-    df.reset_index(inplace=True, drop=True)
-    
-    # initialize 
-    start_indx_hour = 0
-    hours_predicted_ahead = 24
-    one_block = datetime.timedelta(hours=hours_predicted_ahead)
-    daily_totals = pd.DataFrame()
-    
-    # let the algorithm automatically find how many days we have predictions for 
-    while start_indx_hour < len(df)-1:
-        
-        # index / timestamps of first and last predictions within a day 
-        first_hour = pd.to_datetime(df.time_of_prediction[start_indx_hour])
-        end_indx_hour  = np.where(pd.to_datetime(df.time_of_prediction)<=first_hour+one_block)[0][-1]
-        last_hour = pd.to_datetime(df.time_of_prediction[end_indx_hour])
-        
-        
-        # slice data to get data belonging to the same day 
-        data_of_day = df.iloc[start_indx_hour:end_indx_hour]
-        data_of_day.reset_index(inplace=True, drop=True)
-        
-        # summarize by adding together the average rainfall over the day
-        aggregate_of_day = pd.DataFrame()
-        aggregate_of_day['hours_ahead'] = [f'hr-{hours_predicted_ahead}']
-        aggregate_of_day['tot_rainfall_mm'] = [data_of_day[aggregate_by].sum()]
-        
-        # combine days into single output 
-        daily_totals = pd.concat([daily_totals, aggregate_of_day])
-        
-        # progress number days we could predict for 
-        hours_predicted_ahead += 24
-        # reset loop: Start from the start of the next day 
-        start_indx_hour = end_indx_hour + 1
+    table = pd.DataFrame({key: df[key].to_numpy() for key in groupby})
+    table['time'] = pd.to_datetime(df['time_of_prediction']).to_numpy()
+    table['value'] = df[aggregate_by].to_numpy()
+    if 'predicted_hrs_ahead' in df.columns:
+        table['duration'] = df['predicted_hrs_ahead'].to_numpy(dtype=np.float64)
+    table = table.sort_values(groupby + ['time'], kind='stable').reset_index(drop=True)
+    by_series = table.groupby(groupby, sort=False)['time'] if groupby else table['time']
+
+    # --- lead time (hours) since the first prediction of the series --- 
+    first_hour = by_series.transform('min') if groupby else by_series.min()
+    hours_ahead = ((table['time'] - first_hour) / pd.Timedelta(hours=1)).to_numpy()
+
+    # --- length of every interval (hours): otherwise the step to the next prediction (last one: the step before) --- 
+    if 'duration' not in table.columns:
+        step_to_next = -by_series.diff(-1) / pd.Timedelta(hours=1)
+        step_to_previous = by_series.diff() / pd.Timedelta(hours=1)
+        table['duration'] = step_to_next.fillna(step_to_previous).fillna(0.)
+    duration = table['duration'].to_numpy(dtype=np.float64)
+
+    # --- bin into days, split intervals that cross the end of a day --- 
+    day = np.floor(hours_ahead / hours_per_day).astype(np.int64)
+    hours_left_in_day = (day + 1) * hours_per_day - hours_ahead
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share_in_day = np.where(duration > hours_left_in_day, hours_left_in_day / duration, 1.)
+    value = table['value'].to_numpy(dtype=np.float64)
+    keys = table[groupby]
+    crossing = share_in_day < 1.
+    binned = pd.concat([
+        keys.assign(day=day, tot_rainfall_mm=value * share_in_day),
+        keys[crossing].assign(day=day[crossing] + 1, tot_rainfall_mm=value[crossing] * (1. - share_in_day[crossing])),
+        ])
+
+    daily_totals = binned.groupby(groupby + ['day'])['tot_rainfall_mm'].sum().reset_index()
+    daily_totals.insert(0, 'hours_ahead', [f'hr-{hours_per_day * (d + 1)}' for d in daily_totals['day']])
+    return daily_totals[['hours_ahead', 'tot_rainfall_mm'] + groupby]
+
 
-    return daily_totals 
+def _init_plot_worker():
+    # every plotting process starts with its own matplotlib state: non-interactive backend, no figures inherited from the parent
+    mpl.use('Agg')
+    plt.close('all')
 
 
-def daily_aggregates_per_admin(df, settings, rainfall_thresholds, save_to_file, save_fig_to_png, destination_fldr, timestamp):
-    print('destination_fldr: ', destination_fldr)
-    print('save_to_file: ', save_to_file)
+def plot_process_pool(max_workers):
+    # processes drawing figures, can be shared by several PlotPools (e.g. the countries of a batch)
+    return ProcessPoolExecutor(max_workers=max_workers, 
+                               initializer=_init_plot_worker)
+
+
+# matplotlib is not thread-safe: figures drawn in this process are drawn one at a time
+_render_lock = threading.Lock()
+
+
+def render_png(plot_function, *args):
+    buffer = io.BytesIO()
+    plot_function(*args, save_to_file=buffer)
+    return buffer.getvalue()
+
+
+class PlotPool:
     """
-    aggregate predicted rainfall per day (per catchment area)
+    render figures (PNG) in a pool of worker processes
+    ----
+    max_workers: number of processes drawing figures at the same time (1: draw right away, in this process)
+    executor: process pool shared with other PlotPools (see plot_process_pool()); it is not shut down by close()
+
+    Every figure is drawn by a plain function from its own (picklable) inputs into a PNG buffer, 
+    so a figure comes out byte-for-byte the same whether it is rendered here or in a worker. 
+    The PNG is written to the output storage by this (main) process.
+    Call close() (or use as context manager) to wait until all figures are written. 
+    """
+
+    def __init__(self, max_workers=1, executor=None):
+        self.max_workers = max(1, max_workers or 1)
+        self._executor = executor
+        self._own_executor = executor is None and self.max_workers > 1
+        self._futures = []
+        if self._own_executor:
+            self._executor = plot_process_pool(self.max_workers)
+
+    def submit(self, storage, save_to_file, plot_function, *args):
+        """
+        render plot_function(*args, save_to_file=<buffer>) and write the PNG to save_to_file in storage
+        """
+        if self._executor is None:
+            with _render_lock:
+                png = render_png(plot_function, *args)
+            storage.write_bytes(save_to_file, png)
+        else:
+            future = self._executor.submit(render_png, plot_function, *args)
+            self._futures.append((storage, save_to_file, future))
+
+    def wait(self):
+        # re-raises the error of a failed figure in the main process
+        futures, self._futures = self._futures, []
+        for storage, save_to_file, future in futures:
+            storage.write_bytes(save_to_file, future.result())
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self._own_executor:
+                self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def daily_aggregates_per_admin(combine_areas_daily, settings, save_to_file, save_fig_to_png, timestamp, plot_pool=None, dpi=300, storage=None):
+    """
+    store the predicted rainfall per day per catchment area (as returned by daily_aggregates(), with the `trigger` column 
+    of TriggerEvaluation.daily_trigger())
+    ----
+    save_fig_to_png: filename of the barplot (None: no barplot)
+    plot_pool: PlotPool rendering the barplot (default: render right away, in this process)
+    dpi: resolution of the barplot PNG
+    storage: output storage the CSV (save_to_file) and PNG (save_fig_to_png) are written to (default: local file system)
 
-    returns resulting dataframe 
     creates PNG with barplot 
     """
     production_time = pd.to_datetime(timestamp, format="%Y%m%d%H").strftime(format="%H:00 %d-%m-%Y")    
     map_settings = settings['mapSettings']
-    
-    combine_areas_daily = pd.DataFrame()
-    for area, group in df.groupby('name'):
-        one_area_daily = daily_aggregates(group, aggregate_by='mean')
-        one_area_daily['name'] = area
-        combine_areas_daily =  pd.concat([combine_areas_daily, one_area_daily])
-    combine_areas_daily['trigger'] = np.where(combine_areas_daily['tot_rainfall_mm'] > rainfall_thresholds['one_day'], 1 , 0)
 
-    combine_areas = combine_areas_daily.fillna(0).groupby(['name'])['tot_rainfall_mm'].sum().reset_index()
-    combine_areas['trigger'] = np.where(combine_areas['tot_rainfall_mm'] > rainfall_thresholds['three_day'], 1 , 0)
+    storage = storage or LocalStorage()
+    storage.write_bytes(save_to_file, combine_areas_daily.to_csv(index=False).encode())
+
+    if save_fig_to_png is not None:
+        plot_pool = plot_pool or PlotPool()
+        plot_pool.submit(storage, save_fig_to_png, plot_daily_bar_chart, combine_areas_daily, map_settings, production_time, dpi)
+
+
+class TriggerThresholds:
+    """
+    thresholds (mm) on the rainfall summed over windows of consecutive days (e.g. 50 mm in one day, 150 mm in three days)
+    ----
+    windows: list of dicts with `days` (length of the window), `mm` (triggered when the sum is above it) 
+             and optionally `name` (default: "ONE-DAY", "THREE-DAY", ...)
+
+    Use evaluate() to check all thresholds for every area of every admin level at once. 
+    """
+    day_words = ['ZERO', 'ONE', 'TWO', 'THREE', 'FOUR', 'FIVE', 'SIX', 'SEVEN', 'EIGHT', 'NINE', 'TEN']
+
+    def __init__(self, windows):
+        self.windows = []
+        for window in windows:
+            days = int(window['days'])
+            if days < 1:
+                raise ValueError(f"a trigger window is at least 1 day long, not {days}")
+            name = window.get('name') or f"{self.day_words[days] if days < len(self.day_words) else days}-DAY"
+            self.windows.append(dict(name=name, days=days, mm=window['mm']))
+
+    @classmethod
+    def from_settings(cls, rainfall_thresholds):
+        """
+        the `windows` of the rainfallThreshold settings, or else its `one_day` and `three_day` thresholds
+        """
+        windows = rainfall_thresholds.get('windows')
+        if not windows:
+            windows = [dict(days=days, mm=rainfall_thresholds[key]) for days, key in [(1, 'one_day'), (3, 'three_day')] 
+                       if rainfall_thresholds.get(key) not in (None, '', False)]
+        return cls(windows)
+
+    def evaluate(self, daily_by_admin):
+        """
+        sum the daily totals over every window and compare them to the thresholds, for all admin levels in one go 
+        ----
+        daily_by_admin: {admin_lvl: daily totals per area (as returned by daily_aggregates(..., groupby=['name']))}
+
+        return a TriggerEvaluation
+        """
+        # --- one (area, day) cube: the areas of all admin levels below each other --- 
+        day_hours = {admin_lvl: daily['hours_ahead'].str.slice(3).astype(int).to_numpy() 
+                     for admin_lvl, daily in daily_by_admin.items()}
+        hours = np.unique(np.concatenate(list(day_hours.values()))) if day_hours else np.array([], dtype=int)
+        areas, rows, offset = {}, {}, 0
+        for admin_lvl, daily in daily_by_admin.items():
+            area_idx, names = pd.factorize(daily['name'])
+            areas[admin_lvl] = (offset, list(names))
+            rows[admin_lvl] = (area_idx + offset, np.searchsorted(hours, day_hours[admin_lvl]))
+            offset += len(names)
+        cube = np.zeros((offset, len(hours)))
+        for admin_lvl, daily in daily_by_admin.items():
+            # areas without rainfall data count as dry 
+            cube[rows[admin_lvl]] = np.nan_to_num(daily['tot_rainfall_mm'].to_numpy(dtype=np.float64))
 
-    # save_to_file = os.path.join(destination_fldr, save_to_file)
-    combine_areas_daily.to_csv(save_to_file, index=False)
+        # --- sums over every window length at once: differences of the cumulative sums along the days --- 
+        # (column j: the window that ends on day j + days - 1). One day is taken as is: no rounding in the sums 
+        cumulative = np.concatenate([np.zeros((offset, 1)), np.cumsum(cube, axis=1)], axis=1)
+        sums = {days: cube if days == 1 else cumulative[:, days:] - cumulative[:, :-days] 
+                for days in set(window['days'] for window in self.windows)}
+        exceeded = [sums[window['days']] > window['mm'] for window in self.windows]
+        return TriggerEvaluation(self.windows, [f"hr-{h}" for h in hours], areas, rows, sums, exceeded)
 
+
+class TriggerEvaluation:
+    """
+    result of TriggerThresholds.evaluate(): for every threshold, which areas exceeded it in which windows 
+    ----
+    windows: the thresholds (name, days, mm)
+    days: labels of the days ("hr-24", "hr-48", ...)
+    areas: {admin_lvl: (first row in the cube, names of the areas)}
+    sums: {days: window sums (area, window)}
+    exceeded: per threshold, (area, window) booleans
+    """
+
+    def __init__(self, windows, days, areas, rows, sums, exceeded):
+        self.windows = windows
+        self.days = days
+        self.areas = areas
+        self._rows = rows
+        self.sums = sums
+        self.exceeded = exceeded
+
+    def daily_trigger(self, admin_lvl):
+        """
+        for every row of the daily totals of the admin level: 1 if the day exceeded a one-day threshold, else 0 
+        """
+        area_rows, day_idx = self._rows[admin_lvl]
+        one_day = [exceeded for window, exceeded in zip(self.windows, self.exceeded) if window['days'] == 1]
+        if not one_day:
+            return np.zeros(len(area_rows), dtype=int)
+        return np.where(np.logical_or.reduce(one_day)[area_rows, day_idx], 1, 0)
+
+    def triggered(self, admin_lvl, window_idx):
+        first, names = self.areas[admin_lvl]
+        return self.exceeded[window_idx][first:first + len(names)].any(axis=1)
+
+    def states(self):
+        """
+        the trigger state of every threshold per admin level ("TRIGGER <name>: True/False")
+        """
+        return [f"TRIGGER {window['name']}: {bool(self.triggered(admin_lvl, window_idx).any())}" 
+                for admin_lvl in self.areas for window_idx, window in enumerate(self.windows)]
+
+    def report(self, **details):
+        """
+        compact trigger report (JSON-serialisable): per threshold, the areas of every admin level that exceeded it, 
+        with their highest sum and the windows above the threshold (labelled by their last day) 
+        ----
+        details: added to the top of the report (e.g. timestamp, statistic)
+        """
+        triggers = []
+        for window_idx, window in enumerate(self.windows):
+            window_days = self.days[window['days'] - 1:]
+            sums = self.sums[window['days']]
+            areas = {}
+            for admin_lvl, (first, names) in self.areas.items():
+                exceeded = self.exceeded[window_idx][first:first + len(names)]
+                areas[admin_lvl] = [dict(name=names[area],
+                                         max_mm=round(float(sums[first + area].max()), 2),
+                                         windows=[window_days[day] for day in np.flatnonzero(exceeded[area])])
+                                    for area in np.flatnonzero(exceeded.any(axis=1))]
+            triggers.append(dict(window, 
+                                 triggered=any(len(exceeding) for exceeding in areas.values()), 
+                                 areas=areas))
+        return dict(details, days=self.days, triggers=triggers)
+
+
+def plot_daily_bar_chart(combine_areas_daily, map_settings, production_time, dpi=300, save_to_file=None):
+    """
+    barplot of the daily rainfall per area (one bar per day ahead)
+    ----
+    save_to_file: PNG filename or writable buffer
+    """
     plt.figure(figsize=(10,5))
     sns.barplot(x = 'name', 
                 y = 'tot_rainfall_mm', 
@@ -315,38 +1531,36 @@ def daily_aggregates_per_admin(df, settings, rainfall_thresholds, save_to_file,
     plt.subplots_adjust(top=0.85)
     plt.ylabel("Rainfall (mm)")
     sns.despine();
-    plt.savefig(save_fig_to_png, 
-                format='png', dpi=300,
+    plt.savefig(save_to_file, 
+                format='png', dpi=dpi,
                 bbox_inches='tight');
-
-    return combine_areas_daily, combine_areas
+    plt.close()
 
 
-def daily_aggregates_per_location(gdf, save_to_file=None):
+def daily_aggregates_per_location(gdf, save_to_file=None, grid_index=None, storage=None):
     """
     Aggregate raw data by day and store into TIF. 
     Also produce PNGs with daily totals with overlay of catchment areas 
+    ----
+    grid_index: GridIndex of the grid points (computed from the table if not given)
+    storage: output storage the TIF is written to (default: local file system)
     """
 
     # just use the predictions for 1 hour ahead (not for 6 hours ahead)
     gdf = gdf[gdf['predicted_hrs_ahead'] == 1]
 
-    # because df.groupby() is much faster in pandas vs geopandas, convert back and forth 
-    df = pd.DataFrame(gdf)  
-    combine_locations_daily = pd.DataFrame()
-    for (lat,long), group in df.groupby(['latitude','longtitude']):
-        one_location_daily = daily_aggregates(group,'rain_in_mm')
-        one_location_daily['latitude'] = lat
-        one_location_daily['longtitude'] = long
-        one_location_daily['geometry'] = group['geometry'].iloc[0]
-        combine_locations_daily = pd.concat([combine_locations_daily, one_location_daily])
-    combine_locations_daily = gpd.GeoDataFrame(combine_locations_daily)
+    # all locations at once (no geometry needed: the grid index places them in the raster)
+    combine_locations_daily = daily_aggregates(gdf[['time_of_prediction', 'predicted_hrs_ahead', 'rain_in_mm', 'latitude', 'longtitude']], 
+                                               'rain_in_mm', 
+                                               groupby=['latitude', 'longtitude'])
 
     # Convert to TIF in order to make plot
     combine_locations_daily_arr = gdf_to_rasterfile(combine_locations_daily, \
         key_values='tot_rainfall_mm' , \
         key_index = 'hours_ahead', \
-        save_to_file = save_to_file)
+        save_to_file = save_to_file, \
+        grid_index = grid_index, \
+        storage = storage)
 
     # # Convert to TIF for other uses
     # for day in np.unique(combine_locations_daily['hours_ahead']):
@@ -359,33 +1573,143 @@ def daily_aggregates_per_location(gdf, save_to_file=None):
     return combine_locations_daily_arr 
 
 
-def plot_rainfall_map_per_day(rainfall_da, settings, shapefile_fldr, destination_fldr, timestamp):
+def daily_aggregates_per_location_in_chunks(forecast_store, save_to_file=None, grid_index=None, storage=None, chunk_points=None):
+    """
+    same as daily_aggregates_per_location(forecast_store.to_geodataframe(), ...), chunk_points grid points at a time
+    (the daily totals of a location only depend on its own predictions)
+    """
+    daily_parts = []
+    for part in forecast_store.chunks(chunk_points or len(forecast_store.points)):
+        table = part.to_dataframe()
+        # just use the predictions for 1 hour ahead (not for 6 hours ahead)
+        table = table[table['predicted_hrs_ahead'] == 1]
+        daily_parts.append(daily_aggregates(table, 'rain_in_mm', groupby=['latitude', 'longtitude']))
+
+    return gdf_to_rasterfile(pd.concat(daily_parts, ignore_index=True), 
+                             key_values='tot_rainfall_mm', 
+                             key_index='hours_ahead', 
+                             save_to_file=save_to_file, 
+                             grid_index=grid_index, 
+                             storage=storage)
+
+
+class BasemapImage:
+    """
+    basemap decoded once (warped to the map projection), to be drawn underneath every map
+    """
+
+    def __init__(self, image, extent, attribution=None):
+        self.image = image
+        self.extent = extent
+        self.attribution = attribution
+
+    def plot(self, ax):
+        # same as contextily.add_basemap(), without downloading/decoding the tiles again 
+        xmin, xmax, ymin, ymax = ax.axis()
+        ax.imshow(self.image, 
+                  extent=self.extent, 
+                  interpolation='bilinear', 
+                  aspect=ax.get_aspect())
+        ax.axis((xmin, xmax, ymin, ymax))
+        if self.attribution:
+            cx.add_attribution(ax, self.attribution, font_size=8)
+
+
+# basemaps read (and warped) by this process: {(GeoTIFF, crs): BasemapImage}
+_basemap_images = {}
+
+
+class BasemapCache:
+    """
+    local store of basemap tiles: one GeoTIFF (Web Mercator) per provider, zoom level and bounding box 
+    ----
+    cache_dir: folder holding the GeoTIFFs (kept between runs; copy it to plot without network access)
+    source: contextily provider name, e.g. 'OpenStreetMap.Mapnik'
+    zoom: tile zoom level ('auto': derived from the bounding box by contextily)
+    """
+
+    def __init__(self, cache_dir, source='OpenStreetMap.Mapnik', zoom='auto'):
+        self.cache_dir = cache_dir
+        self.provider = cx.providers.query_name(source)
+        self.zoom = zoom
+
+    def path(self, bbox):
+        west, south, east, north = bbox
+        provider_name = re.sub(r'[^A-Za-z0-9]+', '-', self.provider.name)
+        return os.path.join(self.cache_dir, 
+                            f"{provider_name}_z{self.zoom}_{west:.4f}_{south:.4f}_{east:.4f}_{north:.4f}.tif")
+
+    def fetch(self, bbox):
+        """
+        download the tiles covering bbox (west, south, east, north in lon/lat) into the store, unless already there 
+        returns the GeoTIFF 
+        """
+        filename = self.path(bbox)
+        if not os.path.exists(filename):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write next to the final file first: an interrupted download never ends up in the store 
+            partial_file = filename + '.part'
+            west, south, east, north = bbox
+            cx.bounds2raster(west, south, east, north, partial_file, 
+                             zoom=self.zoom, 
+                             source=self.provider, 
+                             ll=True)
+            os.replace(partial_file, filename)
+        return filename
+
+    def load(self, bbox, crs):
+        """
+        read the basemap of bbox from the store (fetching it if needed) and warp it to crs 
+        returns BasemapImage, or None if the tiles can be neither found nor downloaded 
+        (decoded once per process: later calls for the same basemap return the same image)
+        """
+        try:
+            filename = self.fetch(bbox)
+        except Exception as e:
+            print(f"basemap not available ({e}): plotting maps without it")
+            return None
+        key = (filename, str(crs))
+        if key not in _basemap_images:
+            _basemap_images[key] = self._read(filename, crs)
+        return _basemap_images[key]
+
+    def _read(self, filename, crs):
+        with rasterio.open(filename) as raster:
+            image, transform = raster.read(), raster.transform
+            if crs is not None and raster.crs != crs:
+                image, transform = cx.warp_img_transform(image, transform, raster.crs, crs)
+        height, width = image.shape[1:]
+        west, north = transform * (0, 0)
+        east, south = transform * (width, height)
+        image = image.transpose(1, 2, 0)
+        return BasemapImage(image, 
+                            extent=(west, east, south, north), 
+                            attribution=self.provider.get('attribution'))
+
+
+def plot_rainfall_map_per_day(rainfall_da, settings, shapefile_fldr, destination_fldr, timestamp, plot_pool=None, dpi=300, storage=None, layers=None):
     """
     create colormap of rainfall in mm per day
     will save the image into png 
+    ----
+    plot_pool: PlotPool rendering the maps (default: render one after another, in this process)
+    dpi: resolution of the PNGs (use a low value for quick previews)
+    storage: output storage the PNGs are written to, in destination_fldr (default: local file system)
+    layers: MapLayers kept from an earlier call (the plotting processes re-use the figures they drew for it)
     """
-    # --- get settings --- 
-    country = settings['geoCoordinates']['country_code'].lower()
     map_settings = settings['mapSettings']
-    
+    storage = storage or LocalStorage()
+    if layers is None:
+        # --- boundaries, labels, etc. are the same every day: prepare once --- 
+        layers = map_layers(settings, shapefile_fldr, crs=rainfall_da.rio.crs)
     production_time = pd.to_datetime(timestamp, format="%Y%m%d%H").strftime(format="%H:00 %d-%m-%Y")    
-    levels = [0, 5, 20, 40, 60, 80, 100]
-    cmap = (mpl.colors.ListedColormap(
-        ['#FFFFFF', '#ffffcc', '#a1dab4', '#41b6c4', '#2c7fb8', '#253494'])
-        ).with_extremes(over='#1C286E') # YlGnBu 1+5 scale
-    cbar_kwargs = {
-        'label': f'{map_settings["colorBarLabel"]}',
-        'extend': 'max',
-        'spacing': 'proportional',
-        'fraction': 0.046,
-        'pad': 0.04
-    }
 
     rainfall_ds = rainfall_da.to_dataset('hours_ahead')
     rainfall_ds = rainfall_ds.rename(
          {nmbr_days:nmbr_days for nmbr_days in rainfall_ds}
          )
     # --- for every prediction --- 
+    plot_pool = plot_pool or PlotPool()
     for nmbr_days in tqdm(rainfall_da.hours_ahead.values):
         # --- fetch the proper daily prediction --- 
         hour_range = int(nmbr_days[3:])
@@ -393,83 +1717,174 @@ def plot_rainfall_map_per_day(rainfall_da, settings, shapefile_fldr, destination
         forecast_end_time = forecast_start_time + pd.Timedelta(hours=24)
         forecast_start_time = forecast_start_time.strftime(format="%H:00 %d-%m-%Y")
         forecast_end_time = forecast_end_time.strftime(format="%H:00 %d-%m-%Y ")
-        
-        # --- build plot: show rainfall prediction ----
-        plt.figure(figsize=(map_settings['pageWidth'], map_settings['pageHeight']))
-        ax = plt.gca()
-        rainfall_ds[nmbr_days].plot(ax=ax, 
-                                    cmap=cmap,
-                                    vmax=150, vmin=5, 
-                                    alpha=0.5,
-                                    levels=levels,
-                                    cbar_kwargs=cbar_kwargs)
-        plt.subplots_adjust(left=0.05, 
-                            right=0.85)
+        title = (f'{map_settings["titleLine1"]} \n'
+            f'{map_settings["titleLine2"]} {forecast_start_time} - {forecast_end_time} \n'
+            f'{map_settings["titleLine3"]} {production_time}')
 
-        # --- overlay with available admin boundaries, rivers, catchment areas etc. ---- 
+        basename = f"{timestamp}_{nmbr_days}"
+        filename = os.path.join(destination_fldr, f"{basename}.png")
+        plot_pool.submit(storage, filename, plot_rainfall_map, rainfall_ds[nmbr_days], layers, title, dpi)
+
+
+def map_layers(settings, shapefile_fldr, crs=None):
+    """
+    MapLayers of the daily maps, with the basemap (if switched on) warped to crs 
+    """
+    map_settings = settings['mapSettings']
+    # --- basemap: taken from the local tile store and decoded once for all days --- 
+    basemap = None
+    if settings['geoCoordinates']['basemap']:
+        basemap_cache = BasemapCache(
+            cache_dir=map_settings.get('basemapCacheDir', os.path.join(shapefile_fldr, 'basemap')),
+            source=map_settings.get('basemapSource', 'OpenStreetMap.Mapnik'),
+            zoom=map_settings.get('basemapZoom', 'auto'))
+        bbox = (map_settings['bboxWest'], map_settings['bboxSouth'], map_settings['bboxEast'], map_settings['bboxNorth'])
+        basemap = basemap_cache.load(bbox, crs=crs)
+    return MapLayers(settings, shapefile_fldr, basemap=basemap)
+
+
+class MapLayers:
+    """
+    everything on the daily rainfall maps that is the same for every day: 
+    admin boundaries with their labels, basemap, bounding box, titles and colour bar 
+    ----
+    settings: global settings (mapSettings and the admin levels from geoCoordinates)
+    shapefile_fldr: folder with the {country}_adm{i}.geojson files
+    basemap: BasemapImage drawn underneath (None: no basemap)
+
+    The shapefiles are read (and the label positions computed) once per run. Every process draws 
+    the static figure once and then only swaps the rainfall layer per day (see plot_rainfall_map). 
+    """
+    levels = [0, 5, 20, 40, 60, 80, 100]
+    colors = ['#FFFFFF', '#ffffcc', '#a1dab4', '#41b6c4', '#2c7fb8', '#253494'] # YlGnBu 1+5 scale
+
+    def __init__(self, settings, shapefile_fldr, basemap=None):
+        self.map_settings = settings['mapSettings']
+        self.basemap = basemap
+        # identifies the figure drawn from these layers (a new run gets a new figure)
+        self.key = f"{os.getpid()}-{time.time_ns()}"
+
+        country = settings['geoCoordinates']['country_code'].lower()
+        self.admin_layers = []
         admin_levels = [f"adm{i}" for i in range(1,5)]  
         for admin_lvl in admin_levels:
             if settings['geoCoordinates'][admin_lvl]: 
-
                 basename = f"{country}_{admin_lvl}.geojson"
-                file_admin_shapefile = os.path.join(shapefile_fldr, basename)
-                adm = gpd.read_file(file_admin_shapefile)
-                projection = adm.crs
-                adm['coords'] = adm['geometry'].apply(lambda x: x.representative_point().coords[:])
-                adm['coords'] = [coords[0] for coords in adm['coords']]
-                # Try to show boundaries as areas 
-                try:
-                    adm.boundary.plot(ax = ax, 
-                                        color="black", 
-                                        linewidth = 0.75)
-                    for idx, row in adm.iterrows():
-                        ax.annotate(row[f'{admin_lvl}_EN'.upper()], 
-                                    xy=row['coords'], 
-                                    horizontalalignment='center')
-                # Otherwise it is a point/ a city  
-                except: 
-                    ax.scatter(data=adm, 
-                               x='x_mean', 
-                               y='y_mean', 
-                               label='group_village_head_name')
-                    for x, y, label in zip(adm.geometry.x, adm.geometry.y, adm.group_village_head_name):
-                        ax.annotate(label, 
-                                    xy=(x, y), 
-                                    xytext=(3, 3), 
-                                    textcoords="offset points")
-                        
-        # --- overlay with available admin boundaries, rivers, catchment areas etc. ---- 
-        if settings['geoCoordinates']['basemap']:
-            cx.add_basemap(ax, 
-                           crs=projection,
-                           source=cx.providers.OpenStreetMap.Mapnik)
-        
+                adm = gpd.read_file(os.path.join(shapefile_fldr, basename))
+                adm['coords'] = [point.coords[0] for point in adm['geometry'].representative_point()]
+                self.admin_layers.append((admin_lvl, adm))
+
+    def raster_kwargs(self):
+        cmap = mpl.colors.ListedColormap(self.colors).with_extremes(over='#1C286E')
+        return dict(cmap=cmap,
+                    vmax=150, vmin=5, 
+                    alpha=0.5,
+                    levels=self.levels)
+
+    def draw(self, rainfall_day):
+        """
+        draw the static figure (rainfall_day is only used to set up the colour bar and is removed again)
+        returns the figure 
+        """
+        map_settings = self.map_settings
+        cbar_kwargs = {
+            'label': f'{map_settings["colorBarLabel"]}',
+            'extend': 'max',
+            'spacing': 'proportional',
+            'fraction': 0.046,
+            'pad': 0.04
+        }
+        fig = plt.figure(figsize=(map_settings['pageWidth'], map_settings['pageHeight']))
+        ax = fig.gca()
+        # the colour bar only depends on the (fixed) levels, not on the data of the day 
+        rainfall_day.plot(ax=ax, 
+                          cbar_kwargs=cbar_kwargs,
+                          **self.raster_kwargs()).remove()
+        fig.subplots_adjust(left=0.05, 
+                            right=0.85)
+
         # --- overlay with available admin boundaries, rivers, catchment areas etc. ---- 
+        for admin_lvl, adm in self.admin_layers:
+            # Try to show boundaries as areas 
+            try:
+                adm.boundary.plot(ax = ax, 
+                                    color="black", 
+                                    linewidth = 0.75)
+                for label, coords in zip(adm[f'{admin_lvl}_EN'.upper()], adm['coords']):
+                    ax.annotate(label, 
+                                xy=coords, 
+                                horizontalalignment='center')
+            # Otherwise it is a point/ a city  
+            except: 
+                ax.scatter(data=adm, 
+                           x='x_mean', 
+                           y='y_mean', 
+                           label='group_village_head_name')
+                for x, y, label in zip(adm.geometry.x, adm.geometry.y, adm.group_village_head_name):
+                    ax.annotate(label, 
+                                xy=(x, y), 
+                                xytext=(3, 3), 
+                                textcoords="offset points")
+
+        # --- basemap underneath --- 
+        if self.basemap is not None:
+            self.basemap.plot(ax)
+
         suptitle = f"{map_settings['suptitle']} {map_settings['locationName']}".upper()
-        plt.suptitle(
+        fig.suptitle(
             suptitle,
             fontweight='bold', 
             fontsize=16, 
             fontfamily='Open Sans')
-        title = (f'{map_settings["titleLine1"]} \n'
-            f'{map_settings["titleLine2"]} {forecast_start_time} - {forecast_end_time} \n'
-            f'{map_settings["titleLine3"]} {production_time}')
-        plt.title(
+        fig.subplots_adjust(top=0.9)
+        return fig
+
+    def finish_axes(self, ax, title):
+        # (re)set what plotting the rainfall layer overwrites: title, axis labels and bounding box 
+        map_settings = self.map_settings
+        ax.set_title(
             title,
             fontsize=10, 
             fontfamily='Open Sans')
-        plt.subplots_adjust(top=0.9)
-        plt.xlabel(f'{map_settings["xLabel"]}')
-        plt.ylabel(f'{map_settings["yLabel"]}')
-        plt.ylim([map_settings['bboxSouth'], map_settings['bboxNorth']])
-        plt.xlim([map_settings['bboxWest'], map_settings['bboxEast']])
+        ax.set_xlabel(f'{map_settings["xLabel"]}')
+        ax.set_ylabel(f'{map_settings["yLabel"]}')
+        ax.set_ylim([map_settings['bboxSouth'], map_settings['bboxNorth']])
+        ax.set_xlim([map_settings['bboxWest'], map_settings['bboxEast']])
 
-        basename = f"{timestamp}_{nmbr_days}"
-        filename = os.path.join(destination_fldr, f"{basename}.png")
-        plt.savefig(filename, 
+
+# static map figures of this process: {MapLayers.key: Figure}, the most recently used last
+_static_maps = {}
+# kept at once (one per country of a batch, see batch_forecast.py)
+max_static_maps = 4
+
+
+def plot_rainfall_map(rainfall_day, layers, title, dpi=300, save_to_file=None):
+    """
+    colormap of the rainfall of a single day on top of the static map layers
+    ----
+    rainfall_day: DataArray (y, x) with the rainfall in mm of that day
+    layers: MapLayers; the static figure is drawn at the first day and re-used for the next days
+    dpi: resolution of the PNG (use a low value for quick previews)
+    save_to_file: PNG filename or writable buffer
+    """
+    fig = _static_maps.pop(layers.key, None)
+    if fig is None:
+        while len(_static_maps) >= max_static_maps:
+            plt.close(_static_maps.pop(next(iter(_static_maps))))
+        fig = layers.draw(rainfall_day)
+    _static_maps[layers.key] = fig
+    ax = fig.axes[0]
+
+    rainfall_layer = rainfall_day.plot(ax=ax, 
+                                       add_colorbar=False, 
+                                       **layers.raster_kwargs())
+    layers.finish_axes(ax, title)
+    try:
+        fig.savefig(save_to_file, 
                     format="png",
-                    dpi=300)
-        plt.close();
+                    dpi=dpi)
+    finally:
+        rainfall_layer.remove()
  
 
 def timestamp_str(timestamp, fmt = "%m/%d/%Y, %H:%M:%S"):
@@ -477,57 +1892,626 @@ def timestamp_str(timestamp, fmt = "%m/%d/%Y, %H:%M:%S"):
     return timestring.strftime(format=fmt)
 
 
+@functools.lru_cache(maxsize=None)
+def azure_container_client(credentials_file="credentials/env.yml"):
+    """
+    client of the data container in Azure's blob storage. 
+    Created once and shared by all up- and downloads (one connection pool, credentials read once) 
+    -----
+    credentials_file: YAML with `connectionString` and `DataContainer`. The connection string may 
+                      also point to a local emulator, e.g. Azurite ('UseDevelopmentStorage=true')
+    """
+    with open(credentials_file,"r") as env:
+        secrets = yaml.safe_load(env)
+ 
+    # --- Create instance of BlobServiceClient to connect to Azure's data storage ---
+    blob_service_client = azure_blob.BlobServiceClient.from_connection_string(secrets['connectionString'])
+    return blob_service_client.get_container_client(secrets['DataContainer'])
+
+
+def file_md5(filename, chunk_size=1024*1024):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.digest()
+
+
+class CloudUploader:
+    """
+    upload files to Azure's blob storage with a bounded pool of threads, skipping blobs that are already identical
+    -----
+    container_client: ContainerClient of the data container (see azure_container_client)
+    max_workers: number of files uploaded at the same time
+
+    The MD5 of every file is stored as the Content-MD5 of its blob: 
+    a file is only sent when the blob is missing or has a different Content-MD5. 
+    """
+
+    def __init__(self, container_client, max_workers=4):
+        self.container_client = container_client
+        self.max_workers = max(1, max_workers or 1)
+        self.counts = {"uploaded": 0, "unchanged": 0}
+        self.bytes_uploaded = 0
+        self.seconds = 0.
+        self._lock = threading.Lock()
+
+    def upload(self, local_filename, cloud_filename):
+        """
+        upload a single file (unless the blob already has the same content)
+        returns "uploaded" or "unchanged"
+        """
+        with open(local_filename, "rb") as upload_file:
+            return self._upload(upload_file, file_md5(local_filename), os.path.getsize(local_filename), cloud_filename)
+
+    def upload_bytes(self, data, cloud_filename):
+        """
+        same as upload(), for content that is in memory (no local file needed)
+        """
+        return self._upload(data, hashlib.md5(data).digest(), len(data), cloud_filename)
+
+    def _upload(self, data, content_md5, size, cloud_filename):
+        blob_client = self.container_client.get_blob_client(cloud_filename)
+        try:
+            stored_md5 = blob_client.get_blob_properties().content_settings.content_md5
+        except azure_core.exceptions.ResourceNotFoundError:
+            stored_md5 = None
+        
+        if stored_md5 is not None and bytes(stored_md5) == content_md5:
+            status = "unchanged"
+        else:
+            # --- write data to cloud --- 
+            blob_client.upload_blob(data, 
+                                    overwrite=True, 
+                                    content_settings=azure_blob.ContentSettings(content_md5=bytearray(content_md5)))
+            status = "uploaded"
+        with self._lock:
+            self.counts[status] += 1
+            if status == "uploaded":
+                self.bytes_uploaded += size
+        return status
+
+    def upload_files(self, files):
+        """
+        upload many files concurrently
+        -----
+        files: list of (local_filename, cloud_filename)
+        returns list with the status of every file ("uploaded" or "unchanged") 
+        """
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            statuses = list(executor.map(lambda pair: self.upload(*pair), files))
+        self.seconds += time.perf_counter() - start
+        return statuses
+
+    def summary(self):
+        megabytes = self.bytes_uploaded / 1024**2
+        return (f"cloud upload: {self.counts['uploaded']} files ({megabytes:.1f} MB) in {self.seconds:.1f} s, "
+                f"{self.counts['unchanged']} unchanged (skipped)")
+
+
+class LocalStorage:
+    """
+    output storage on the local file system
+    ----
+    root: folder the output names are relative to ('': names are plain paths)
+    """
+
+    def __init__(self, root=''):
+        self.root = root
+        self.counts = {"files_written": 0, "bytes_written": 0}
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write_bytes(self, name, data):
+        filename = self.path(name)
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as f:
+            f.write(data)
+        with self._lock:
+            self.counts["files_written"] += 1
+            self.counts["bytes_written"] += len(data)
+
+    def write_file(self, name, local_filename):
+        """
+        store a file written elsewhere (e.g. a temporary file too large to keep in memory), without loading it
+        """
+        filename = self.path(name)
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        shutil.copyfile(local_filename, filename)
+        with self._lock:
+            self.counts["files_written"] += 1
+            self.counts["bytes_written"] += os.path.getsize(local_filename)
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return None
+
+    def metrics(self):
+        return dict(self.counts)
+
+
+class MemoryStorage:
+    """
+    output storage that keeps every output in a dictionary {name: bytes} (e.g. to check outputs without writing files)
+    """
+
+    def __init__(self):
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def write_bytes(self, name, data):
+        with self._lock:
+            self.files[name] = bytes(data)
+
+    def write_file(self, name, local_filename):
+        with open(local_filename, "rb") as f:
+            self.write_bytes(name, f.read())
+
+    def close(self):
+        pass
+
+    def summary(self):
+        return f"in memory: {len(self.files)} files ({sum(map(len, self.files.values())) / 1024**2:.1f} MB)"
+
+    def metrics(self):
+        return {"files_written": len(self.files), "bytes_written": sum(map(len, self.files.values()))}
+
+
+class AzureBlobStorage:
+    """
+    output storage in Azure's blob storage: outputs are uploaded straight from memory, in the background 
+    ----
+    cloud_dir: folder in the data container the output names are relative to
+    container_client: ContainerClient of the data container (default: azure_container_client())
+    max_workers: number of uploads running at the same time
+    flatten: drop the sub-folders of the output names (all outputs of a run in one cloud folder)
+
+    Uploads go through a CloudUploader (blobs with identical content are skipped). 
+    close() waits for the uploads still running, shuts down their threads and re-raises the first failure 
+    (a next write starts new threads). 
+    """
+
+    def __init__(self, cloud_dir, container_client=None, max_workers=4, flatten=False):
+        self.cloud_dir = cloud_dir
+        self.flatten = flatten
+        self.uploader = CloudUploader(container_client or azure_container_client(), max_workers=max_workers)
+        self._executor = None
+        self._futures = []
+        self._start = None
+
+    def path(self, name):
+        if self.flatten:
+            name = os.path.basename(name)
+        return os.path.join(self.cloud_dir, name)
+
+    def write_bytes(self, name, data):
+        if self._start is None:
+            self._start = time.perf_counter()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.uploader.max_workers)
+        self._futures.append(self._executor.submit(self.uploader.upload_bytes, bytes(data), self.path(name)))
+
+    def write_file(self, name, local_filename):
+        # streamed from disk, right away (the file may be removed once this returns)
+        if self._start is None:
+            self._start = time.perf_counter()
+        self.uploader.upload(local_filename, self.path(name))
+
+    def close(self):
+        futures, self._futures = self._futures, []
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            if self._start is not None:
+                self.uploader.seconds += time.perf_counter() - self._start
+                self._start = None
+
+    def summary(self):
+        return self.uploader.summary()
+
+    def metrics(self):
+        return {"files_uploaded": self.uploader.counts["uploaded"],
+                "files_unchanged": self.uploader.counts["unchanged"],
+                "bytes_uploaded": self.uploader.bytes_uploaded,
+                "upload_seconds": round(self.uploader.seconds, 3)}
+
+
+class MultiStorage:
+    """
+    write every output to several storages at once (e.g. a local copy and the cloud)
+    """
+
+    def __init__(self, storages):
+        self.storages = list(storages)
+
+    def write_bytes(self, name, data):
+        for storage in self.storages:
+            storage.write_bytes(name, data)
+
+    def write_file(self, name, local_filename):
+        for storage in self.storages:
+            storage.write_file(name, local_filename)
+
+    def close(self):
+        for storage in self.storages:
+            storage.close()
+
+    def summary(self):
+        summaries = [storage.summary() for storage in self.storages]
+        return "\n".join(summary for summary in summaries if summary) or None
+
+    def metrics(self):
+        metrics = {}
+        for storage in self.storages:
+            for key, value in storage.metrics().items():
+                metrics[key] = metrics.get(key, 0) + value
+        return metrics
+
+
+class RecordingStorage:
+    """
+    output storage that passes every output on to `storage` and keeps the MD5 of what was written since the last take_written() 
+    (the outputs of a stage, see StageCheckpoints)
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._written = {}
+        self._lock = threading.Lock()
+
+    def write_bytes(self, name, data):
+        self.storage.write_bytes(name, data)
+        with self._lock:
+            self._written[name] = hashlib.md5(data).hexdigest()
+
+    def write_file(self, name, local_filename):
+        self.storage.write_file(name, local_filename)
+        with self._lock:
+            self._written[name] = file_md5(local_filename).hex()
+
+    def take_written(self):
+        # {name: MD5} of the outputs written since the previous call
+        with self._lock:
+            written, self._written = self._written, {}
+        return written
+
+    def __getattr__(self, attribute):
+        # path(), close(), summary(), metrics(), ... of the wrapped storage
+        return getattr(self.storage, attribute)
+
+
+def content_key(*parts):
+    """
+    digest (SHA-256) of the inputs of a stage: strings, bytes or anything JSON can write (e.g. settings, {name: MD5} of files)
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        elif not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True, default=str).encode()
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+class StageCheckpoints:
+    """
+    record of the stages a run completed: {stage: {key: digest of its inputs, outputs: {name: MD5}}}, kept in a JSON file 
+    ----
+    filename: the record
+    output_dir: local folder the output names are relative to
+
+    A stage counts as completed when it was recorded with the same key (same inputs and settings) 
+    and all its outputs are still in output_dir with the same content. 
+    The outputs of a stage are content-addressed: their MD5s go into the keys of the stages after it. 
+    """
+
+    def __init__(self, filename, output_dir):
+        self.filename = filename
+        self.output_dir = output_dir
+        self.stages = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.stages = json.load(f)
+
+    def completed(self, stage, key):
+        """
+        {name: MD5} of the outputs of the stage if it was completed with this key, else None
+        """
+        record = self.stages.get(stage)
+        if record is None or record['key'] != key:
+            return None
+        for name, md5 in record['outputs'].items():
+            filename = os.path.join(self.output_dir, name)
+            if not os.path.exists(filename) or file_md5(filename).hex() != md5:
+                return None
+        return record['outputs']
+
+    def record(self, stage, key, outputs):
+        self.stages[stage] = {'key': key, 'outputs': outputs}
+        # replaced at once: a run that fails while writing leaves the previous record
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        partial_file = f"{self.filename}.part"
+        with open(partial_file, 'w') as f:
+            json.dump(self.stages, f, indent=2)
+        os.replace(partial_file, self.filename)
+
+
+def current_rss_mb():
+    """
+    resident memory (MB) of this process right now (from /proc: Linux only, None elsewhere)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return round(resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024**2, 1)
+
+
+class RssSampler:
+    """
+    high-water mark of the resident memory while it runs: a background thread samples current_rss_mb()
+    ----
+    interval: seconds between the samples (a peak shorter than this can be missed)
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.start_mb = current_rss_mb()
+        self.peak_mb = self.start_mb
+        self._stop = threading.Event()
+        self._thread = None
+        if self.start_mb is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._update()
+
+    def _update(self):
+        rss_mb = current_rss_mb()
+        if rss_mb is not None and rss_mb > self.peak_mb:
+            self.peak_mb = rss_mb
+
+    def stop(self):
+        # stop sampling (with a last sample); returns (start_mb, peak_mb), both None where current_rss_mb() is not available
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._update()
+        return self.start_mb, self.peak_mb
+
+
+def peak_rss_mb(who=None):
+    """
+    highest resident memory (MB) of this process so far (who='children': of its finished child processes, e.g. the plot workers)
+    None where the resource module is missing (Windows)
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if who == 'children' else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return round(usage.ru_maxrss / (1024**2 if sys.platform == 'darwin' else 1024), 1)
+
+
+class RunMetrics:
+    """
+    timings and counts of a run of the pipeline, per stage, for the run report (JSON) and Prometheus 
+    ----
+    labels: identify the run in the report and in every Prometheus metric (e.g. country and run)
+    profile_dir: write a cProfile of every stage into this folder (<stage>.prof) and list its hottest functions 
+                 in the report (None: no profiling)
+
+    A stage that is entered several times (e.g. plotting) adds up its seconds. 
+    The memory of a stage is sampled while it runs (see RssSampler): rss_start_mb at its entry, rss_peak_mb its 
+    high-water mark and rss_increase_mb the peak above the entry (the largest over its calls). The resident memory 
+    is the one of the whole process: stages of other countries running at the same time (batch_forecast.py) count too. 
+    process_peak_rss_mb in the report is the high-water mark of the process since it started (ru_maxrss). 
+    """
+    profile_top = 10
+
+    def __init__(self, labels=None, profile_dir=None):
+        self.labels = dict(labels or {})
+        self.profile_dir = profile_dir
+        self.started = time.time()
+        self.stages = {}
+        self.counts = {}
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profiler = self._start_profile()
+        sampler = RssSampler()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            start_mb, peak_mb = sampler.stop()
+            with self._lock:
+                stage = self.stages.setdefault(name, {'seconds': 0., 'calls': 0, 
+                                                      'rss_start_mb': start_mb, 'rss_peak_mb': None, 'rss_increase_mb': None})
+                stage['seconds'] += seconds
+                stage['calls'] += 1
+                if peak_mb is not None:
+                    stage['rss_peak_mb'] = max(peak_mb, stage['rss_peak_mb'] or 0.)
+                    stage['rss_increase_mb'] = max(round(peak_mb - start_mb, 1), stage['rss_increase_mb'] or 0.)
+                if profiler is not None:
+                    if name in self._profiles:
+                        self._profiles[name].add(profiler)
+                    else:
+                        self._profiles[name] = pstats.Stats(profiler)
+
+    def _start_profile(self):
+        if self.profile_dir is None:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is active (e.g. a stage of another country in the same process): not profiled
+            return None
+        return profiler
+
+    def count(self, **counts):
+        # add to the counts of the run
+        with self._lock:
+            for key, value in counts.items():
+                self.counts[key] = self.counts.get(key, 0) + value
+
+    def set(self, **values):
+        # replace values of the run (e.g. totals kept elsewhere, rates)
+        with self._lock:
+            self.counts.update(values)
+
+    def report(self, status='ok'):
+        """
+        the run report: a dictionary that can be written as JSON
+        """
+        report = dict(self.labels)
+        report.update({'status': status,
+                       'started': datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                       'seconds': round(time.time() - self.started, 3),
+                       'process_peak_rss_mb': peak_rss_mb(),
+                       'process_peak_rss_children_mb': peak_rss_mb('children'),
+                       'stages': {name: dict(stage, seconds=round(stage['seconds'], 3)) for name, stage in self.stages.items()},
+                       'counts': dict(self.counts)})
+        for name, stats in self._profiles.items():
+            report['stages'][name]['profile'] = self._hottest_functions(stats)
+        return report
+
+    def _hottest_functions(self, stats):
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.profile_top]
+        return [{'function': f"{os.path.basename(filename)}:{line}({function})", 
+                 'calls': calls, 
+                 'own_seconds': round(own_seconds, 3), 
+                 'cumulative_seconds': round(cumulative_seconds, 3)}
+                for (filename, line, function), (_, calls, own_seconds, cumulative_seconds, _) in functions]
+
+    def write_profiles(self):
+        """
+        the profile of every stage as <profile_dir>/<stage>.prof (open with pstats or snakeviz); returns the files
+        """
+        if self.profile_dir is None:
+            return []
+        os.makedirs(self.profile_dir, exist_ok=True)
+        filenames = []
+        for name, stats in self._profiles.items():
+            filenames.append(os.path.join(self.profile_dir, f"{name}.prof"))
+            stats.dump_stats(filenames[-1])
+        return filenames
+
+    def to_prometheus(self, status='ok', prefix='rainfall_forecast'):
+        """
+        the metrics in the text format of Prometheus (for the textfile collector of node_exporter)
+        """
+        def labels(**extra):
+            pairs = dict(self.labels, **extra)
+            return "{" + ",".join(f'{key}="{value}"' for key, value in pairs.items()) + "}"
+
+        report = self.report(status)
+        lines = []
+        def gauge(name, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.extend(f"{prefix}_{name}{sample_labels} {value}" for sample_labels, value in samples if value is not None)
+
+        gauge('last_run_timestamp_seconds', "moment the run started (unix time)", [(labels(), round(self.started, 3))])
+        gauge('last_run_success', "whether the run finished without errors", [(labels(), int(status == 'ok'))])
+        gauge('run_seconds', "duration of the run", [(labels(), report['seconds'])])
+        gauge('stage_seconds', "time spent in a stage of the run",
+              [(labels(stage=name), stage['seconds']) for name, stage in report['stages'].items()])
+        gauge('stage_peak_rss_bytes', "highest resident memory of the process while in a stage of the run",
+              [(labels(stage=name), None if stage['rss_peak_mb'] is None else int(stage['rss_peak_mb'] * 1024**2)) 
+               for name, stage in report['stages'].items()])
+        gauge('stage_rss_increase_bytes', "growth of the resident memory during a stage of the run (peak above its start)",
+              [(labels(stage=name), None if stage['rss_increase_mb'] is None else int(stage['rss_increase_mb'] * 1024**2)) 
+               for name, stage in report['stages'].items()])
+        gauge('process_peak_rss_bytes', "highest resident memory since the process started (process: main, children: plot workers)",
+              [(labels(process='main'), None if report['process_peak_rss_mb'] is None else int(report['process_peak_rss_mb'] * 1024**2)),
+               (labels(process='children'), None if report['process_peak_rss_children_mb'] is None else int(report['process_peak_rss_children_mb'] * 1024**2))])
+        for key, value in sorted(report['counts'].items()):
+            gauge(key, f"{key.replace('_', ' ')} during the run", [(labels(), value)])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, dirname, status='ok'):
+        """
+        write the metrics as <dirname>/rainfall_forecast_<labels>.prom (replaced at once, never read half-written)
+        """
+        os.makedirs(dirname, exist_ok=True)
+        filename = os.path.join(dirname, "_".join(['rainfall_forecast', *map(str, self.labels.values())]) + '.prom')
+        partial_file = f"{filename}.{os.getpid()}.part"
+        with open(partial_file, 'w') as f:
+            f.write(self.to_prometheus(status))
+        os.replace(partial_file, filename)
+        return filename
+
+    def summary(self):
+        return "stages: " + ", ".join(f"{name} {stage['seconds']:.1f} s" for name, stage in self.stages.items())
+
+
 def write_to_azure_cloud_storage(local_filename, cloud_filename):
     """
-    write resulting .csv file to cloud storrage of Azure. 
+    write resulting .csv file to cloud storrage of Azure (skipped if the blob is already identical). 
 
     data container: ibf 
     -----
     local_filename: Path to the file on your computer (or inside Docker Container)
     cloud_filename: Path to the destination in Azure 
     """
-
-    with open("credentials/env.yml","r") as env:
-        secrets = yaml.safe_load(env)
- 
-    # --- Create instance of BlobServiceClient to connect to Azure's data storage ---
-    blob_service_client = BlobServiceClient.from_connection_string(secrets['connectionString'])
-    blob_client = blob_service_client.get_blob_client(container=secrets['DataContainer'], blob=cloud_filename)
-
-    # --- write data to cloud --- 
-    with open(local_filename, "rb") as upload_file:
-        blob_client.upload_blob(upload_file, overwrite=True)
+    return CloudUploader(azure_container_client()).upload(local_filename, cloud_filename)
     
 
 def download_from_azure_cloud_storage(cloud_filename, local_filename):
     """
-    download input zip file from Azure cloud storage. 
+    download input zip file from Azure cloud storage, unless the local copy is still current. 
 
     data container: ibf 
     -----
     cloud_filename: Path to the file in Azure 
-    """
-
-    with open("credentials/env.yml","r") as env:
-        secrets = yaml.safe_load(env)
- 
-    # --- Create instance of BlobServiceClient to connect to Azure's data storage ---
-    blob_service_client = BlobServiceClient.from_connection_string(secrets['connectionString'])
-    blob_client = blob_service_client.get_blob_client(container=secrets['DataContainer'], blob=cloud_filename)
-
-    # --- Download data --- 
-    with open(local_filename, "wb") as download_file:
-        download_file.write(blob_client.download_blob().readall())
+    local_filename: destination; the ETag of the downloaded blob is kept in "<local_filename>.etag"
 
+    returns True if the file was (re)downloaded, False if the local copy was up to date 
+    The download is conditional on the stored ETag (one request, no transfer when unchanged) 
+    and is streamed to disk in chunks. 
+    """
+    blob_client = azure_container_client().get_blob_client(cloud_filename)
+    etag_file = local_filename + '.etag'
+    etag = None
+    if os.path.exists(local_filename) and os.path.exists(etag_file):
+        with open(etag_file, 'r') as f:
+            etag = f.read().strip() or None
 
-def check_threshold(df_rain, num_days, save_to_file):
+    # --- Download data (only if the blob differs from our copy) --- 
+    try:
+        if etag is None:
+            downloader = blob_client.download_blob()
+        else:
+            downloader = blob_client.download_blob(etag=etag, match_condition=azure_core.MatchConditions.IfModified)
+    except azure_core.exceptions.ResourceNotModifiedError:
+        return False
 
-    if max(df_rain['trigger']) == 1:
-        trigger = True
-    else:
-        trigger = False
-    trigger_state = f"TRIGGER {num_days}: {str(trigger)}"
-    
-    with open(save_to_file + '.txt', "a+") as text_file:
-        text_file.write(trigger_state + "\n")
-        text_file.close()
\ No newline at end of file
+    partial_file = local_filename + '.part'
+    with open(partial_file, "wb") as download_file:
+        for chunk in downloader.chunks():
+            download_file.write(chunk)
+    os.replace(partial_file, local_filename)
+    with open(etag_file, 'w') as f:
+        f.write(downloader.properties.etag)
+    return True